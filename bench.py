@@ -0,0 +1,531 @@
+import argparse
+import asyncio
+import base64
+import collections
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import time
+import zlib
+
+import aiohttp
+
+BENCH_PASSWORD = 'bench'
+BENCH_HISTORY_ROOM = 'bench-history'
+BENCH_TIMEOUT = 30
+BENCH_PREFILL_WINDOW = 100
+# 压测图片的宽度（像素），高度按文件大小计算
+BENCH_IMAGE_WIDTH = 256
+SCENARIOS = ('connect', 'chat', 'binary_upload', 'legacy_upload', 'history', 'http_upload')
+
+def percentile(samples, fraction):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+def summarize(latencies, duration, errors=0, **extra):
+    count = len(latencies)
+    result = {
+        'count': count,
+        'errors': errors,
+        'duration_s': round(duration, 4),
+        'throughput_per_s': round(count / duration, 2) if duration > 0 else None,
+        'latency_ms': {
+            'mean': round(sum(latencies) / count * 1000, 3) if count else None,
+            'p50': round(percentile(latencies, 0.50) * 1000, 3) if count else None,
+            'p90': round(percentile(latencies, 0.90) * 1000, 3) if count else None,
+            'p99': round(percentile(latencies, 0.99) * 1000, 3) if count else None,
+            'max': round(max(latencies) * 1000, 3) if count else None,
+        },
+    }
+    result.update(extra)
+    return result
+
+def process_memory(pid):
+    # 仅在Linux上可用，其余平台返回None
+    memory = {}
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in ('VmRSS', 'VmHWM'):
+                    memory['rss_kb' if key == 'VmRSS' else 'peak_rss_kb'] = int(value.split()[0])
+    except OSError:
+        return None
+    return memory
+
+def parse_metrics(text):
+    values = {}
+    for line in text.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        name, _, value = line.rpartition(' ')
+        try:
+            values[name] = float(value)
+        except ValueError:
+            pass
+    return values
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def random_png(size):
+    # 随机像素的RGB图片几乎无法压缩，文件大小接近size；服务器会真正解码生成缩略图，内容也不会因为相同而去重
+    row_size = 1 + BENCH_IMAGE_WIDTH * 3
+    height = max(1, size // row_size)
+    pixels = b''.join(b'\x00' + os.urandom(row_size - 1) for _ in range(height))
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', BENCH_IMAGE_WIDTH, height, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(pixels, 1))
+            + chunk(b'IEND', b''))
+
+def prepare_workdir(source_dir):
+    workdir = tempfile.mkdtemp(prefix='chatroom-bench-')
+    for name in ('static', 'fonts'):
+        source = os.path.join(source_dir, name)
+        if os.path.isdir(source):
+            os.symlink(source, os.path.join(workdir, name))
+        else:
+            os.makedirs(os.path.join(workdir, name))
+    os.symlink(os.path.join(source_dir, 'index.html'), os.path.join(workdir, 'index.html'))
+    return workdir
+
+def run_server(workdir, port, log_level, rate_limits):
+    # 在独立进程中运行服务器，压测客户端不会与服务器争用同一个事件循环
+    os.chdir(workdir)
+    import server
+    from aiohttp import web
+    server.setup_logging(log_level)
+    if not rate_limits:
+        server.rate_limiter.limits = {kind: (None, None, None, None) for kind in server.RATE_LIMITS}
+    web.run_app(server.init_app(), host='127.0.0.1', port=port, print=None)
+
+class BenchClient:
+    def __init__(self, base_url, username):
+        self.base_url = base_url
+        self.username = username
+        self.session = aiohttp.ClientSession(cookie_jar=aiohttp.CookieJar(unsafe=True))
+        self.ws = None
+        self.frames = 0
+        self.throttled = 0
+        self.waiters = {}
+        self.transfer_seq = 0
+        self._reader = None
+
+    async def post(self, path, payload):
+        async with self.session.post(self.base_url + path, json=payload) as response:
+            return await response.json()
+
+    async def login(self):
+        await self.post('/register', {'username': self.username, 'password': BENCH_PASSWORD})
+        result = await self.post('/login', {'username': self.username, 'password': BENCH_PASSWORD})
+        if not result.get('success'):
+            raise RuntimeError(f"登录失败：{self.username}")
+
+    async def connect(self, room_number):
+        self.ws = await self.session.ws_connect(self.base_url + '/ws', max_msg_size=0)
+        self._reader = asyncio.create_task(self._read())
+        history = self.expect('history')
+        await self.ws.send_json({'type': 'connect', 'username': self.username, 'roomNumber': room_number})
+        return await asyncio.wait_for(history, BENCH_TIMEOUT)
+
+    def expect(self, key):
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[key] = future
+        return future
+
+    def _resolve(self, key, value):
+        future = self.waiters.pop(key, None)
+        if future and not future.done():
+            future.set_result(value)
+
+    async def _read(self):
+        async for msg in self.ws:
+            if msg.type != aiohttp.WSMsgType.TEXT:
+                continue
+            self.frames += 1
+            data = json.loads(msg.data)
+            message_type = data.get('type')
+            if message_type in ('history', 'history_page'):
+                self._resolve(message_type, data)
+            elif message_type == 'rate_limited':
+                self.throttled += 1
+            elif message_type == 'transfer_error':
+                future = self.waiters.pop('media', None)
+                if future and not future.done():
+                    future.set_exception(RuntimeError(data.get('message')))
+            elif data.get('sender') == self.username:
+                if message_type == 'text':
+                    self._resolve(('text', data.get('message')), time.perf_counter())
+                elif message_type in ('image', 'audio'):
+                    self._resolve('media', time.perf_counter())
+
+    async def send_text(self, message):
+        echo = self.expect(('text', message))
+        await self.ws.send_json({'type': 'text', 'message': message})
+        return echo
+
+    async def upload_binary(self, kind, mime_type, payload, chunk_size):
+        self.transfer_seq += 1
+        transfer_id = self.transfer_seq
+        done = self.expect('media')
+        await self.ws.send_json({'type': 'transfer_start', 'transferId': transfer_id, 'kind': kind,
+                                 'mimeType': mime_type, 'size': len(payload)})
+        header = struct.pack('!I', transfer_id)
+        for offset in range(0, len(payload), chunk_size):
+            await self.ws.send_bytes(header + payload[offset:offset + chunk_size])
+        await self.ws.send_json({'type': 'transfer_end', 'transferId': transfer_id})
+        return await asyncio.wait_for(done, BENCH_TIMEOUT)
+
+    async def upload_legacy(self, kind, data_url, chunk_size):
+        done = self.expect('media')
+        chunks = [data_url[i:i + chunk_size] for i in range(0, len(data_url), chunk_size)]
+        for index, chunk in enumerate(chunks):
+            await self.ws.send_json({'type': kind, kind: chunk, 'chunkIndex': index, 'chunkTotal': len(chunks)})
+        return await asyncio.wait_for(done, BENCH_TIMEOUT)
+
+    async def upload_file(self, file_name, payload, chunk_size):
+        async with self.session.post(self.base_url + '/uploads',
+                                     json={'fileName': file_name, 'size': len(payload)}) as response:
+            created = await response.json()
+            if response.status != 201:
+                raise RuntimeError(f"创建上传失败：{created.get('message')}")
+        upload_url = f"{self.base_url}/uploads/{created['uploadId']}"
+        offset = 0
+        while offset < len(payload):
+            async with self.session.patch(upload_url, data=payload[offset:offset + chunk_size],
+                                          headers={'Upload-Offset': str(offset)}) as response:
+                result = await response.json()
+                if response.status != 200:
+                    raise RuntimeError(f"上传失败：{result.get('message')}")
+            offset = result['offset']
+        async with self.session.post(upload_url + '/complete') as response:
+            if response.status != 200:
+                raise RuntimeError(f"完成上传失败：HTTP {response.status}")
+            return await response.json()
+
+    async def load_history(self, before, limit):
+        page = self.expect('history_page')
+        await self.ws.send_json({'type': 'load_history', 'before': before, 'limit': limit})
+        return await asyncio.wait_for(page, BENCH_TIMEOUT)
+
+    async def close(self):
+        if self.ws is not None:
+            await self.ws.close()
+        if self._reader is not None:
+            with contextlib.suppress(Exception):
+                await self._reader
+        await self.session.close()
+
+async def gather_timed(coroutines):
+    started = time.perf_counter()
+    results = await asyncio.gather(*coroutines, return_exceptions=True)
+    duration = time.perf_counter() - started
+    latencies = [result for result in results if isinstance(result, float)]
+    return latencies, len(results) - len(latencies), duration
+
+async def timed(coroutine):
+    started = time.perf_counter()
+    await coroutine
+    return time.perf_counter() - started
+
+async def bench_connect(clients, rooms):
+    async def connect(index, client):
+        return await timed(client.connect(rooms[index % len(rooms)]))
+
+    latencies, errors, duration = await gather_timed(connect(i, c) for i, c in enumerate(clients))
+    return summarize(latencies, duration, errors)
+
+async def bench_chat(clients, messages, rate):
+    interval = 1 / rate if rate else 0
+    frames_before = sum(client.frames for client in clients)
+    throttled_before = sum(client.throttled for client in clients)
+
+    async def chat(client):
+        throttled = client.throttled
+        echoes = []
+        for seq in range(messages):
+            sent_at = time.perf_counter()
+            echo = await client.send_text(f"{client.username}:{seq}")
+            echoes.append((sent_at, echo))
+            if interval:
+                await asyncio.sleep(interval)
+        # 被限流的消息没有回显，收齐回显或限流通知后即可结束等待
+        deadline = time.perf_counter() + BENCH_TIMEOUT
+        pending = {echo for _, echo in echoes}
+        while pending and len(echoes) - len(pending) + client.throttled - throttled < len(echoes):
+            if time.perf_counter() > deadline:
+                raise asyncio.TimeoutError()
+            _, pending = await asyncio.wait(pending, timeout=0.1)
+        return [echo.result() - sent_at for sent_at, echo in echoes if echo.done()]
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(chat(client) for client in clients), return_exceptions=True)
+    duration = time.perf_counter() - started
+    latencies = [latency for result in results if isinstance(result, list) for latency in result]
+    errors = sum(messages for result in results if isinstance(result, BaseException))
+    delivered = sum(client.frames for client in clients) - frames_before
+    throttled = sum(client.throttled for client in clients) - throttled_before
+    return summarize(latencies, duration, errors, frames_delivered=delivered,
+                     frames_per_s=round(delivered / duration, 2) if duration > 0 else None, throttled=throttled)
+
+async def bench_uploads(clients, count, size, upload):
+    async def run(client):
+        uploads = []
+        for _ in range(count):
+            payload = random_png(size)
+            uploads.append((await timed(upload(client, payload)), len(payload)))
+        return uploads
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(run(client) for client in clients), return_exceptions=True)
+    duration = time.perf_counter() - started
+    uploads = [item for result in results if isinstance(result, list) for item in result]
+    latencies = [latency for latency, _ in uploads]
+    errors = sum(count for result in results if isinstance(result, BaseException))
+    total = sum(length for _, length in uploads)
+    return summarize(latencies, duration, errors, bytes=total,
+                     mb_per_s=round(total / duration / 1e6, 3) if duration > 0 else None)
+
+async def bench_history(readers, page_size):
+    # 每个读取者从最新消息开始向前翻页，直到读完整个房间
+    async def read_all(reader):
+        latencies = []
+        page = await reader.connect(BENCH_HISTORY_ROOM)
+        while page['hasMore'] and page['messages']:
+            started = time.perf_counter()
+            page = await reader.load_history(page['messages'][0]['id'], page_size)
+            latencies.append(time.perf_counter() - started)
+        return latencies
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(read_all(reader) for reader in readers), return_exceptions=True)
+    duration = time.perf_counter() - started
+    latencies = [latency for result in results if isinstance(result, list) for latency in result]
+    errors = sum(1 for result in results if isinstance(result, BaseException))
+    return summarize(latencies, duration, errors, page_size=page_size)
+
+async def prefill_history(client, count):
+    await client.connect(BENCH_HISTORY_ROOM)
+    started = time.perf_counter()
+    # 限制未回显的消息数，像真实客户端一样边发边收
+    window = collections.deque()
+    for seq in range(count):
+        if len(window) >= BENCH_PREFILL_WINDOW:
+            await asyncio.wait_for(window.popleft(), BENCH_TIMEOUT)
+        window.append(await client.send_text(f"{client.username}:{seq}"))
+    await asyncio.wait_for(asyncio.gather(*window), BENCH_TIMEOUT)
+    return time.perf_counter() - started
+
+async def bench_http_upload(clients, uploads, concurrency, size, chunk_size):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def upload(index):
+        async with semaphore:
+            client = clients[index % len(clients)]
+            return await timed(client.upload_file(f'bench-{index}.bin', os.urandom(size), chunk_size))
+
+    latencies, errors, duration = await gather_timed(upload(i) for i in range(uploads))
+    total = len(latencies) * size
+    return summarize(latencies, duration, errors, bytes=total,
+                     mb_per_s=round(total / duration / 1e6, 3) if duration > 0 else None)
+
+async def wait_until_ready(base_url, process):
+    async with aiohttp.ClientSession() as session:
+        deadline = time.monotonic() + BENCH_TIMEOUT
+        while time.monotonic() < deadline:
+            if not process.is_alive():
+                raise RuntimeError("服务器进程启动失败")
+            with contextlib.suppress(aiohttp.ClientError):
+                async with session.get(base_url + '/check_session') as response:
+                    if response.status == 200:
+                        return
+            await asyncio.sleep(0.1)
+    raise RuntimeError("等待服务器启动超时")
+
+async def fetch_metrics(base_url):
+    async with aiohttp.ClientSession() as session:
+        async with session.get(base_url + '/metrics') as response:
+            return parse_metrics(await response.text())
+
+def log(message):
+    print(message, file=sys.stderr, flush=True)
+
+async def run_bench(args, base_url, server_pid):
+    scenarios = set(args.scenarios)
+    report = {'scenarios': {}, 'memory': {'start': process_memory(server_pid)}}
+
+    def sample_memory(name):
+        report['memory'][name] = process_memory(server_pid)
+
+    clients = [BenchClient(base_url, f'bench{i}') for i in range(args.users)]
+    try:
+        for start in range(0, len(clients), 100):
+            await asyncio.gather(*(client.login() for client in clients[start:start + 100]))
+        rooms = ['1'] + [f'bench-room-{i}' for i in range(1, args.rooms)]
+        for index, client in enumerate(clients):
+            room_number = rooms[index % len(rooms)]
+            if room_number != '1':
+                await client.post('/add_room', {'username': client.username, 'roomNumber': room_number})
+
+        log(f"已准备 {len(clients)} 个用户，{len(rooms)} 个房间")
+        if scenarios & {'connect', 'chat', 'binary_upload', 'legacy_upload'}:
+            report['scenarios']['connect'] = await bench_connect(clients, rooms)
+            sample_memory('after_connect')
+            log("连接风暴完成")
+
+        connected = [client for client in clients if client.ws is not None and not client.ws.closed]
+        if 'chat' in scenarios:
+            report['scenarios']['chat'] = await bench_chat(connected, args.messages, args.rate)
+            sample_memory('after_chat')
+            log("文字聊天完成")
+
+        uploaders = connected[:args.uploaders]
+        if 'binary_upload' in scenarios:
+            report['scenarios']['binary_upload'] = await bench_uploads(
+                uploaders, args.uploads, args.upload_size,
+                lambda client, payload: client.upload_binary('image', 'image/png', payload, args.chunk_size))
+            sample_memory('after_binary_upload')
+            log("二进制上传完成")
+
+        if 'legacy_upload' in scenarios:
+            report['scenarios']['legacy_upload'] = await bench_uploads(
+                uploaders, args.uploads, args.upload_size,
+                lambda client, payload: client.upload_legacy(
+                    'image', 'data:image/png;base64,' + base64.b64encode(payload).decode(), 50000))
+            sample_memory('after_legacy_upload')
+            log("分片上传完成")
+
+        if 'history' in scenarios:
+            writer = BenchClient(base_url, 'bench-history-writer')
+            readers = [BenchClient(base_url, f'bench-history-reader{i}') for i in range(args.history_readers)]
+            try:
+                for client in [writer] + readers:
+                    await client.login()
+                    await client.post('/add_room', {'username': client.username, 'roomNumber': BENCH_HISTORY_ROOM})
+                prefill = await prefill_history(writer, args.history_size)
+                report['history_prefill'] = {
+                    'messages': args.history_size,
+                    'duration_s': round(prefill, 4),
+                    'throughput_per_s': round(args.history_size / prefill, 2) if prefill > 0 else None,
+                }
+                report['scenarios']['history'] = await bench_history(readers, args.history_page)
+            finally:
+                for client in [writer] + readers:
+                    await client.close()
+            sample_memory('after_history')
+            log("历史记录加载完成")
+
+        if 'http_upload' in scenarios:
+            report['scenarios']['http_upload'] = await bench_http_upload(
+                clients, args.http_uploads, args.http_concurrency, args.upload_size, args.http_chunk_size)
+            sample_memory('after_http_upload')
+            log("HTTP上传完成")
+
+        report['server_metrics'] = await fetch_metrics(base_url)
+    finally:
+        for start in range(0, len(clients), 100):
+            await asyncio.gather(*(client.close() for client in clients[start:start + 100]),
+                                 return_exceptions=True)
+
+    sample_memory('end')
+    return report
+
+def compare(baseline, report):
+    # 与基准结果对比，输出吞吐量和p99延迟的变化比例
+    changes = {}
+    for name, current in report['scenarios'].items():
+        previous = baseline.get('scenarios', {}).get(name)
+        if not previous:
+            continue
+        change = {}
+        for key, old, new in (
+                ('throughput_per_s', previous.get('throughput_per_s'), current.get('throughput_per_s')),
+                ('p99_ms', previous['latency_ms'].get('p99'), current['latency_ms'].get('p99'))):
+            if old and new is not None:
+                change[key] = round((new - old) / old, 4)
+        changes[name] = change
+    return changes
+
+def main():
+    parser = argparse.ArgumentParser(description="聊天室服务器压测")
+    parser.add_argument('--users', type=int, default=200, help="模拟用户数")
+    parser.add_argument('--rooms', type=int, default=10, help="房间数（含公共聊天室）")
+    parser.add_argument('--messages', type=int, default=20, help="每个用户发送的文字消息数")
+    parser.add_argument('--rate', type=float, default=0, help="每个用户每秒发送的消息数，0表示不限速")
+    parser.add_argument('--uploaders', type=int, default=10, help="同时上传图片的用户数")
+    parser.add_argument('--uploads', type=int, default=3, help="每个上传用户的上传次数")
+    parser.add_argument('--upload-size', type=int, default=256 * 1024, help="单个文件大小（字节）")
+    parser.add_argument('--chunk-size', type=int, default=64 * 1024, help="二进制传输的分片大小（字节）")
+    parser.add_argument('--history-size', type=int, default=5000, help="历史记录压测房间的消息数")
+    parser.add_argument('--history-page', type=int, default=50, help="每页加载的历史消息数")
+    parser.add_argument('--history-readers', type=int, default=10, help="同时翻页读取历史记录的用户数")
+    parser.add_argument('--http-uploads', type=int, default=50, help="HTTP文件上传次数")
+    parser.add_argument('--http-concurrency', type=int, default=10, help="HTTP文件上传并发数")
+    parser.add_argument('--http-chunk-size', type=int, default=1024 * 1024, help="HTTP续传的分片大小（字节）")
+    parser.add_argument('--scenarios', nargs='+', default=list(SCENARIOS), choices=SCENARIOS)
+    parser.add_argument('--log-level', default='WARNING', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    parser.add_argument('--output', help="结果写入的JSON文件，默认输出到标准输出")
+    parser.add_argument('--compare', help="用于对比的上一次结果JSON文件")
+    parser.add_argument('--rate-limits', action='store_true', help="保留服务器的限流设置（默认关闭限流以测量最大吞吐量）")
+    parser.add_argument('--keep', action='store_true', help="保留临时数据目录")
+    args = parser.parse_args()
+
+    source_dir = os.path.dirname(os.path.abspath(__file__))
+    workdir = prepare_workdir(source_dir)
+    port = free_port()
+    base_url = f'http://127.0.0.1:{port}'
+    context = multiprocessing.get_context('spawn')
+    process = context.Process(target=run_server, args=(workdir, port, args.log_level, args.rate_limits))
+    process.start()
+    try:
+        async def bench():
+            await wait_until_ready(base_url, process)
+            return await run_bench(args, base_url, process.pid)
+
+        started = time.time()
+        report = asyncio.run(bench())
+    finally:
+        process.terminate()
+        process.join(BENCH_TIMEOUT)
+        if args.keep:
+            log(f"数据目录：{workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report['config'] = {key: value for key, value in vars(args).items() if key not in ('output', 'compare', 'keep')}
+    report['environment'] = {
+        'python': platform.python_version(),
+        'aiohttp': aiohttp.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'started_at': started,
+    }
+    if args.compare:
+        with open(args.compare) as f:
+            report['compare'] = compare(json.load(f), report)
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
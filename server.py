@@ -1,46 +1,2107 @@
+import argparse
+import asyncio
+import atexit
+import base64
+import binascii
+import collections
+import concurrent.futures
+import contextlib
+import fcntl
+import gzip
 import hashlib
+import ipaddress
 import json
+import logging
+import logging.handlers
+import mimetypes
+import multiprocessing
+import multiprocessing.connection
 import os
+import posixpath
+import queue
+import random
+import re
 import secrets
+import signal
+import struct
 import time
+import urllib.parse
 
 import aiosqlite
-from aiohttp import web
+from aiohttp import web, WSCloseCode, ClientError, ClientSession, ClientTimeout
 from aiohttp_session import setup, get_session, session_middleware
 from aiohttp_session.cookie_storage import EncryptedCookieStorage
 
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 DB_PATH_META = 'meta.db'
 DB_PATH_DATA = 'data.db'
+DB_PATH_ARCHIVE = 'archive.db'
+
+MESSAGES_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS messages (
+        seq INTEGER PRIMARY KEY,
+        room_number TEXT NOT NULL,
+        id INTEGER NOT NULL,
+        sender TEXT,
+        message TEXT,
+        image TEXT,
+        audio TEXT,
+        file_name TEXT,
+        timestamp REAL,
+        preview TEXT,
+        UNIQUE (room_number, id)
+    );
+    ''',
+    "CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages (timestamp)"
+]
+MESSAGES_FTS_SCHEMA = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+    "message, content='messages', content_rowid='seq', tokenize='trigram')",
+    '''
+    CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages
+    WHEN new.message IS NOT NULL BEGIN
+        INSERT INTO messages_fts (rowid, message) VALUES (new.seq, new.message);
+    END;
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages
+    WHEN old.message IS NOT NULL BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, message) VALUES ('delete', old.seq, old.message);
+    END;
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF message ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, message)
+            SELECT 'delete', old.seq, old.message WHERE old.message IS NOT NULL;
+        INSERT INTO messages_fts (rowid, message)
+            SELECT new.seq, new.message WHERE new.message IS NOT NULL;
+    END;
+    '''
+]
+# 少于3个字的查询无法使用trigram索引，另建一个按单字分词的索引，按相邻单字的短语匹配
+MESSAGES_CHARS_SCHEMA = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_chars USING fts5(message, content='', tokenize='unicode61')",
+    '''
+    CREATE TRIGGER IF NOT EXISTS messages_chars_insert AFTER INSERT ON messages
+    WHEN new.message IS NOT NULL BEGIN
+        INSERT INTO messages_chars (rowid, message) VALUES (new.seq, search_chars(new.message));
+    END;
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS messages_chars_delete AFTER DELETE ON messages
+    WHEN old.message IS NOT NULL BEGIN
+        INSERT INTO messages_chars (messages_chars, rowid, message)
+            VALUES ('delete', old.seq, search_chars(old.message));
+    END;
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS messages_chars_update AFTER UPDATE OF message ON messages BEGIN
+        INSERT INTO messages_chars (messages_chars, rowid, message)
+            SELECT 'delete', old.seq, search_chars(old.message) WHERE old.message IS NOT NULL;
+        INSERT INTO messages_chars (rowid, message)
+            SELECT new.seq, search_chars(new.message) WHERE new.message IS NOT NULL;
+    END;
+    '''
+]
+MESSAGES_CHARS_FILL = ("INSERT INTO messages_chars (rowid, message) "
+                       "SELECT seq, search_chars(message) FROM messages WHERE message IS NOT NULL")
+# 每个房间分配过的最大id和写入过、被保留策略删除的消息数：删除消息后id也不会回退，未读数 = 房间消息数 - 已读时的消息数
+ROOM_SEQUENCES_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS room_sequences (
+        room_number TEXT PRIMARY KEY,
+        last_id INTEGER NOT NULL,
+        message_count INTEGER NOT NULL DEFAULT 0,
+        expired_count INTEGER NOT NULL DEFAULT 0
+    );
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS messages_sequence AFTER INSERT ON messages BEGIN
+        INSERT INTO room_sequences (room_number, last_id, message_count) VALUES (new.room_number, new.id, 1)
+            ON CONFLICT (room_number) DO UPDATE SET last_id = MAX(last_id, excluded.last_id),
+                                                    message_count = message_count + 1;
+    END;
+    '''
+]
+DATA_MIGRATIONS = [
+    MESSAGES_SCHEMA + MESSAGES_FTS_SCHEMA + MESSAGES_CHARS_SCHEMA + ROOM_SEQUENCES_SCHEMA
+]
+
+META_MIGRATIONS = [
+    [
+        # 已读位置和已读时房间的消息数，加入房间时写入；升级前的记录为NULL，启动时按当前消息数计为全部已读
+        "ALTER TABLE user_rooms ADD COLUMN last_read_id INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE user_rooms ADD COLUMN read_count INTEGER"
+    ]
+]
+
+SEARCH_PAGE_SIZE = 20
+SEARCH_PAGE_MAX = 100
+SEARCH_MIN_QUERY_LENGTH = 3
+SEARCH_SNIPPET_TOKENS = 16
+
+RETENTION_DAYS = None
+RETENTION_MODE = 'archive'
+RETENTION_INTERVAL = 3600
+RETENTION_BATCH_SIZE = 500
+
+HISTORY_PAGE_SIZE = 50
+HISTORY_PAGE_MAX = 200
+SQLITE_MAX_INTEGER = 2 ** 63 - 1
+
+RECENT_MESSAGES_PER_ROOM = HISTORY_PAGE_SIZE
+RECENT_ROOM_MAX_BYTES = 1024 * 1024
+RECENT_MAX_BYTES = 64 * 1024 * 1024
+
+BROADCAST_SEND_TIMEOUT = 5
+
+WS_HEARTBEAT = 30
+WS_SEND_QUEUE_FRAMES = 256
+WS_SEND_QUEUE_BYTES = 4 * 1024 * 1024
+WS_SLOW_CONSUMER_POLICY = 'close'
+
+# 类型: (每个用户每秒, 用户突发, 每个房间每秒, 房间突发)，None表示不限制
+RATE_LIMITS = {
+    'message': (5, 20, 50, 200),
+    'chunk': (400, 800, 2000, 4000),
+    'user_list': (1, 5, None, None),
+    'read': (2, 10, None, None)
+}
+RATE_LIMIT_MAX_BUCKETS = 100000
+
+# 只有这些地址可以读取/metrics，部署在反向代理后面时不要把代理的地址加进来
+METRICS_ALLOWED_NETWORKS = ('127.0.0.0/8', '::1/128')
+# 按房间连接数统计房间数的分桶上界
+METRICS_ROOM_SOCKET_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+BLOB_DIR = 'blobs'
+BLOB_URL_PREFIX = '/blobs/'
+BLOB_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# 类型: {MIME类型: 扩展名}，图片和语音只接受这些格式，其他内容不带扩展名保存，按二进制文件下载
+BLOB_TYPES = {
+    'image': {'image/png': '.png', 'image/jpeg': '.jpg', 'image/gif': '.gif', 'image/webp': '.webp',
+              'image/bmp': '.bmp'},
+    'audio': {'audio/webm': '.weba', 'audio/ogg': '.oga', 'audio/mp4': '.m4a', 'audio/mpeg': '.mp3',
+              'audio/wav': '.wav', 'audio/x-wav': '.wav', 'audio/aac': '.aac'}
+}
+BLOB_CONTENT_TYPES = {extension: mime_type for types in BLOB_TYPES.values()
+                      for mime_type, extension in reversed(types.items())}
+BLOB_SECURITY_HEADERS = {'X-Content-Type-Options': 'nosniff', 'Content-Security-Policy': "default-src 'none'; sandbox"}
+
+TRANSFER_MAX_SIZE = 20 * 1024 * 1024
+TRANSFER_USER_MAX_BYTES = 50 * 1024 * 1024
+TRANSFER_USER_MAX_COUNT = 4
+TRANSFER_TIMEOUT = 60
+TRANSFER_HEADER = struct.Struct('!I')
+TRANSFER_KINDS = ('image', 'audio')
+TRANSFER_LEGACY_CHUNK_SIZE = 50000
+TRANSFER_LEGACY_MAX_CHUNKS = TRANSFER_MAX_SIZE * 4 // 3 // TRANSFER_LEGACY_CHUNK_SIZE + 1
+
+UPLOAD_DIR = 'uploads'
+UPLOAD_MAX_SIZE = 100 * 1024 * 1024
+UPLOAD_USER_MAX_COUNT = 4
+UPLOAD_USER_MAX_BYTES = 500 * 1024 * 1024
+UPLOAD_READ_SIZE = 256 * 1024
+UPLOAD_EXPIRY = 24 * 3600
+UPLOAD_REAP_INTERVAL = 3600
+
+THUMBNAIL_SIZE = 320
+THUMBNAIL_QUALITY = 80
+THUMBNAIL_SUFFIX = '.thumb.webp'
+THUMBNAIL_MAX_PIXELS = 64 * 1024 * 1024
+THUMBNAIL_WORKERS = 2
+THUMBNAIL_TIMEOUT = 30
+THUMBNAIL_CACHE_SIZE = 10000
+
+STATIC_DIR = 'static'
+STATIC_URL_PREFIX = '/static/'
+STATIC_INDEX_TEMPLATE = 'index.html'
+STATIC_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+STATIC_HASH_LENGTH = 12
+STATIC_COMPRESS_TYPES = ('text/', 'application/javascript', 'application/json', 'image/svg+xml',
+                         'image/vnd.microsoft.icon', 'font/ttf')
+STATIC_COMPRESS_MIN_SIZE = 256
+STATIC_GZIP_LEVEL = 9
+STATIC_BROTLI_QUALITY = 11
+
+# static目录下的第三方文件: 下载地址，版本与仓库中的文件一致，python server.py --vendor 重新下载；缺少的文件页面直接从该地址加载
+VENDOR_ASSETS = {
+    'vendor/sweetalert2.all.min.js': 'https://cdn.jsdelivr.net/npm/sweetalert2@11.4.0/dist/sweetalert2.all.min.js',
+    'vendor/sweetalert2-dark.css': 'https://cdn.jsdelivr.net/npm/@sweetalert2/theme-dark@5/dark.css',
+    'vendor/fontawesome/css/all.min.css':
+        'https://cdnjs.cloudflare.com/ajax/libs/font-awesome/5.15.3/css/all.min.css',
+    **{f'vendor/fontawesome/webfonts/{font}.{ext}':
+           f'https://cdnjs.cloudflare.com/ajax/libs/font-awesome/5.15.3/webfonts/{font}.{ext}'
+       for font in ('fa-solid-900', 'fa-regular-400', 'fa-brands-400') for ext in ('woff2', 'woff')}
+}
+VENDOR_DOWNLOAD_TIMEOUT = 60
+
+METADATA_CACHE_SIZE = 10000
+
+PRESENCE_FLUSH_INTERVAL = 30
+READ_FLUSH_INTERVAL = 30
+
+BACKPLANE_SOCKET = 'backplane.sock'
+BACKPLANE_HEADER = struct.Struct('!I')
+# 工作进程意外退出后，等待这么多秒再重新启动
+WORKER_RESTART_DELAY = 1
+
+LOG_LEVEL = 'INFO'
+LOG_MESSAGE_SAMPLE_RATE = 0.01
+
+mimetypes.add_type('audio/webm', '.weba')
+mimetypes.add_type('image/webp', '.webp')
 
 from datetime import datetime, timezone, timedelta
 
-def format_time():
-    tz = timezone(timedelta(hours=8))
-    return datetime.now(tz).strftime("[%Y-%m-%d %H:%M:%S CST]")
+CST = timezone(timedelta(hours=8))
+
+class CSTFormatter(logging.Formatter):
+    def formatTime(self, record, datefmt=None):
+        return datetime.fromtimestamp(record.created, CST).strftime("[%Y-%m-%d %H:%M:%S CST]")
+
+logger = logging.getLogger('chatroom')
+log_listener = None
+
+def setup_logging(level=None):
+    global log_listener
+    if level is not None:
+        logger.setLevel(level)
+    elif logger.level == logging.NOTSET:
+        logger.setLevel(LOG_LEVEL)
+    if log_listener is not None:
+        return
+    handler = logging.StreamHandler()
+    handler.setFormatter(CSTFormatter('%(asctime)s %(message)s'))
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.propagate = False
+    log_listener = logging.handlers.QueueListener(log_queue, handler)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+
+def log_message_event(message, *args):
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(message, *args)
+    elif random.random() < LOG_MESSAGE_SAMPLE_RATE:
+        logger.info(message, *args)
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help_text, label=None):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.values = {}
+
+    def inc(self, amount=1, label_value=None):
+        self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def samples(self):
+        for label_value, value in self.values.items():
+            yield self.name, {self.label: label_value} if self.label else {}, value
+
+class Gauge:
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, callback, label=None):
+        self.name = name
+        self.help_text = help_text
+        self.callback = callback
+        self.label = label
+
+    def samples(self):
+        value = self.callback()
+        if self.label is None:
+            yield self.name, {}, value
+            return
+        for label_value, item in value.items():
+            yield self.name, {self.label: label_value}, item
+
+class Histogram:
+    kind = 'histogram'
+    default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, help_text, buckets=default_buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+
+    @contextlib.contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def samples(self):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f"{self.name}_bucket", {'le': repr(float(bound))}, cumulative
+        yield f"{self.name}_bucket", {'le': '+Inf'}, self.count
+        yield f"{self.name}_sum", {}, self.sum
+        yield f"{self.name}_count", {}, self.count
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, label=None):
+        return self.register(Counter(name, help_text, label))
+
+    def gauge(self, name, help_text, callback, label=None):
+        return self.register(Gauge(name, help_text, callback, label))
+
+    def histogram(self, name, help_text, buckets=Histogram.default_buckets):
+        return self.register(Histogram(name, help_text, buckets))
+
+    @staticmethod
+    def _escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def _format_labels(self, labels):
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{key}="{self._escape(value)}"' for key, value in labels.items()) + '}'
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{self._format_labels(labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+messages_received = metrics.counter('chat_messages_received_total', '收到的聊天消息数', 'type')
+message_ingest_seconds = metrics.histogram('chat_message_ingest_seconds', '从收到消息到广播完成的耗时')
+db_write_seconds = metrics.histogram('chat_db_write_seconds', '批量写入消息的耗时')
+db_write_batch_rows = metrics.histogram('chat_db_write_batch_rows', '每批写入的消息数',
+                                        buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+db_write_batches = metrics.counter('chat_db_write_batches_total', '成功写入的消息批次数')
+db_write_rows = metrics.counter('chat_db_write_rows_total', '成功写入的消息数')
+db_write_failed_rows = metrics.counter('chat_db_write_failed_rows_total', '写入失败被丢弃的消息数')
+broadcast_seconds = metrics.histogram('chat_broadcast_seconds', '单次广播扇出的耗时')
+broadcast_frames = metrics.counter('chat_broadcast_frames_total', '发送给客户端的广播帧数')
+broadcast_timeouts = metrics.counter('chat_broadcast_timeouts_total', '广播发送超时次数')
+slow_consumers = metrics.counter('chat_slow_consumers_total', '发送队列已满的连接数', 'action')
+ws_reaped = metrics.counter('chat_ws_reaped_total', '心跳超时被清理的连接数')
+throttled = metrics.counter('chat_throttled_total', '被限流的请求数', 'kind')
+history_load_seconds = metrics.histogram('chat_history_load_seconds', '读取一页历史消息的耗时')
+uploads = metrics.counter('chat_uploads_total', '完成的上传数', 'kind')
+upload_bytes = metrics.counter('chat_upload_bytes_total', '上传的字节数', 'kind')
+upload_errors = metrics.counter('chat_upload_errors_total', '失败的上传数')
+
+def search_chars(text):
+    if text is None:
+        return None
+    return ' '.join(text)
 
 class Database:
-    def __init__(self, db_path):
+    def __init__(self, db_path, read_connections=4, cached_statements=256):
         self.db_path = db_path
+        self.read_connections = read_connections
+        self.cached_statements = cached_statements
+        self._writer = None
+        self._readers = None
+        self._write_lock = asyncio.Lock()
+
+    async def _open(self):
+        db = await aiosqlite.connect(self.db_path, cached_statements=self.cached_statements)
+        await db.execute("PRAGMA busy_timeout=5000")
+        await db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        await db.execute("PRAGMA journal_mode=WAL")
+        await db.execute("PRAGMA synchronous=NORMAL")
+        await db.create_function('search_chars', 1, search_chars, deterministic=True)
+        return db
+
+    async def connect(self):
+        if self._writer is not None:
+            return
+        self._writer = await self._open()
+        self._readers = asyncio.Queue()
+        for _ in range(self.read_connections):
+            self._readers.put_nowait(await self._open())
+
+    async def close(self):
+        if self._writer is None:
+            return
+        async with self._write_lock:
+            await self._writer.close()
+            self._writer = None
+        while not self._readers.empty():
+            await self._readers.get_nowait().close()
+        self._readers = None
+
+    @staticmethod
+    def _is_read(query):
+        return query.lstrip()[:6].upper() == 'SELECT'
+
+    async def _read(self, method, query, params):
+        db = await self._readers.get()
+        try:
+            async with getattr(db, method)(query, params) as cursor:
+                return await cursor.fetchall()
+        finally:
+            self._readers.put_nowait(db)
+
+    async def _write(self, method, query, params):
+        async with self._write_lock:
+            try:
+                async with getattr(self._writer, method)(query, params) as cursor:
+                    rows = await cursor.fetchall()
+                await self._writer.commit()
+                return rows
+            except Exception:
+                await self._writer.rollback()
+                raise
 
     async def execute(self, query, params=()):
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute(query, params) as cursor:
-                await db.commit()
-                return await cursor.fetchall()
+        await self.connect()
+        if self._is_read(query):
+            return await self._read('execute', query, params)
+        return await self._write('execute', query, params)
 
     async def executemany(self, query, params):
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.executemany(query, params) as cursor:
-                await db.commit()
-                return await cursor.fetchall()
+        await self.connect()
+        return await self._write('executemany', query, params)
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        await self.connect()
+        async with self._write_lock:
+            try:
+                yield self._writer
+                await self._writer.commit()
+            except Exception:
+                await self._writer.rollback()
+                raise
+
+class MessageWriter:
+    def __init__(self, db, flush_interval=0.005, batch_size=200):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._queue = asyncio.Queue()
+        self._next_ids = {}
+        self._task = None
+        self.id_offset = 0
+        self.id_stride = 1
+        self.pending = 0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is None:
+            return
+        self._queue.put_nowait(None)
+        await self._task
+        self._task = None
+
+    def _next_after(self, message_id):
+        message_id += 1
+        return message_id + (self.id_offset - message_id) % self.id_stride
+
+    async def _allocate_id(self, room_number):
+        if room_number not in self._next_ids:
+            result = await self.db.execute("SELECT last_id FROM room_sequences WHERE room_number = ?", (room_number,))
+            self._next_ids.setdefault(room_number, self._next_after(result[0][0] if result else 0))
+        message_id = self._next_ids[room_number]
+        self._next_ids[room_number] = self._next_after(message_id)
+        return message_id
+
+    def observe_id(self, room_number, message_id):
+        if room_number in self._next_ids and message_id >= self._next_ids[room_number]:
+            self._next_ids[room_number] = self._next_after(message_id)
+
+    async def enqueue(self, room_number, sender, timestamp, message=None, image=None, audio=None, file_name=None,
+                      preview=None):
+        message_id = await self._allocate_id(room_number)
+        self.pending += 1
+        self._queue.put_nowait((room_number, message_id, sender, message, image, audio, file_name, timestamp, preview))
+        return message_id
+
+    async def flush(self):
+        if self._task is None or not self.pending:
+            return
+        done = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(done)
+        await done
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._write_batch(batch)
+
+    async def _write_batch(self, batch):
+        waiters = [item for item in batch if isinstance(item, asyncio.Future)]
+        rows = [item for item in batch if not isinstance(item, asyncio.Future)]
+        row_count = len(rows)
+
+        if rows:
+            try:
+                with db_write_seconds.time():
+                    await self._insert(rows)
+                db_write_batch_rows.observe(row_count)
+                db_write_batches.inc()
+                db_write_rows.inc(row_count)
+            except Exception as e:
+                logger.warning(f"批量写入 {row_count} 条消息失败，改为逐条写入: {str(e)}")
+                await self._write_rows(rows)
+        self.pending -= row_count
+
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def _insert(self, rows):
+        await self.db.executemany(
+            "INSERT INTO messages (room_number, id, sender, message, image, audio, file_name, "
+            "timestamp, preview) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    async def _write_rows(self, rows):
+        # 一条消息写入失败时不连累同一批次的其他消息
+        failed = []
+        for row in rows:
+            try:
+                await self._insert([row])
+                db_write_rows.inc()
+            except Exception as e:
+                failed.append((row[0], row[1]))
+                logger.error(f"写入房间 {row[0]} 的消息 {row[1]} 失败: {str(e)}")
+        if failed:
+            db_write_failed_rows.inc(len(failed))
+            await discard_messages(failed)
+
+class RetentionWorker:
+    def __init__(self, db, archive_db, days=RETENTION_DAYS, mode=RETENTION_MODE,
+                 interval=RETENTION_INTERVAL, batch_size=RETENTION_BATCH_SIZE):
+        self.db = db
+        self.archive_db = archive_db
+        self.days = days
+        self.mode = mode
+        self.interval = interval
+        self.batch_size = batch_size
+        self.enabled = True
+        self.archived = 0
+        self.deleted = 0
+        self._task = None
+
+    async def start(self):
+        if self.days is None or not self.enabled or self._task is not None:
+            return
+        if self.mode == 'archive':
+            async with self.archive_db.transaction() as db:
+                for statement in MESSAGES_SCHEMA:
+                    await db.execute(statement)
+            # 旧版本归档时没有记录最大id，从归档中补上，避免重复使用已归档的id
+            rows = await self.archive_db.execute("SELECT room_number, MAX(id) FROM messages GROUP BY room_number")
+            await self.db.executemany(
+                "INSERT INTO room_sequences (room_number, last_id) VALUES (?, ?) "
+                "ON CONFLICT (room_number) DO UPDATE SET last_id = MAX(last_id, excluded.last_id)",
+                [tuple(row) for row in rows])
+        self._task = asyncio.create_task(self._run_forever())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.archive_db.close()
+
+    async def run_once(self):
+        cutoff = time.time() - self.days * 86400
+        removed = 0
+        while True:
+            rows = await self.db.execute(
+                "SELECT room_number, id, sender, message, image, audio, file_name, timestamp FROM messages "
+                "WHERE timestamp < ? ORDER BY timestamp LIMIT ?", (cutoff, self.batch_size))
+            if not rows:
+                break
+            if self.mode == 'archive':
+                await self.archive_db.executemany(
+                    "INSERT OR IGNORE INTO messages (room_number, id, sender, message, image, audio, file_name, timestamp) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                self.archived += len(rows)
+            else:
+                self.deleted += len(rows)
+            await self.db.executemany("DELETE FROM messages WHERE room_number = ? AND id = ?",
+                                      [(row[0], row[1]) for row in rows])
+            await self.db.executemany(
+                "UPDATE room_sequences SET expired_count = expired_count + ? WHERE room_number = ?",
+                [(count, room_number) for room_number, count in collections.Counter(row[0] for row in rows).items()])
+            await expire_messages([(row[0], row[1]) for row in rows])
+            removed += len(rows)
+            await asyncio.sleep(0.05)
+
+        if removed:
+            await self.db.execute("PRAGMA incremental_vacuum")
+            logger.info(f"已{'归档' if self.mode == 'archive' else '删除'} {removed} 条过期消息")
+
+    async def _run_forever(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"清理过期消息失败: {str(e)}")
+            await asyncio.sleep(self.interval)
+
+class BlobStore:
+    name_pattern = re.compile(r'^[0-9a-f]{64}(\.thumb)?(\.[0-9a-z]+)?$')
+    data_url_pattern = re.compile(r'^data:([\w.+-]+/[\w.+-]+)?(?:;[^;,]*)*;base64,', re.IGNORECASE)
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, name):
+        return os.path.join(self.root, name[:2], name)
+
+    @staticmethod
+    def allowed(kind, mime_type):
+        return isinstance(mime_type, str) and mime_type.split(';')[0].strip().lower() in BLOB_TYPES.get(kind, {})
+
+    @staticmethod
+    def extension(kind, mime_type):
+        if not isinstance(mime_type, str):
+            return ''
+        return BLOB_TYPES.get(kind, {}).get(mime_type.split(';')[0].strip().lower(), '')
+
+    @staticmethod
+    def content_type(path):
+        return BLOB_CONTENT_TYPES.get(os.path.splitext(path)[1], 'application/octet-stream')
+
+    def temp_path(self):
+        tmp_dir = os.path.join(self.root, 'tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+        return os.path.join(tmp_dir, secrets.token_hex(16))
+
+    def _write(self, data, extension):
+        name = hashlib.sha256(data).hexdigest() + extension
+        path = self.path(name)
+        if os.path.exists(path):
+            return name
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{secrets.token_hex(4)}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return name
+
+    def _move(self, name, tmp_path):
+        path = self.path(name)
+        if os.path.exists(path):
+            os.remove(tmp_path)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+
+    async def put_bytes(self, data, kind, mime_type=None):
+        # 计算哈希和写文件都在线程中完成，几十MB的图片也不会阻塞事件循环
+        name = await asyncio.to_thread(self._write, data, self.extension(kind, mime_type))
+        return BLOB_URL_PREFIX + name
+
+    async def put_file(self, tmp_path, digest, kind, mime_type=None):
+        name = digest + self.extension(kind, mime_type)
+        await asyncio.to_thread(self._move, name, tmp_path)
+        return BLOB_URL_PREFIX + name
+
+    async def put_data_url(self, data_url, kind):
+        match = self.data_url_pattern.match(data_url) if isinstance(data_url, str) else None
+        if not match:
+            raise TransferError("无效的图片或语音数据")
+        try:
+            data = await asyncio.to_thread(self._decode, data_url, match.end())
+        except (binascii.Error, ValueError):
+            raise TransferError("无效的图片或语音数据")
+        return await self.put_bytes(data, kind, match.group(1))
+
+    @staticmethod
+    def _decode(data_url, start):
+        return base64.b64decode(data_url[start:], validate=True)
+
+    def resolve(self, name):
+        if not self.name_pattern.match(name):
+            return None
+        return self.path(name)
+
+def render_thumbnail(source_path, target_path, size, quality, max_pixels):
+    # 在进程池中执行，返回False表示原图已经足够小，不需要缩略图
+    if os.path.exists(target_path):
+        return True
+    Image.MAX_IMAGE_PIXELS = max_pixels
+    with Image.open(source_path) as image:
+        if not getattr(image, 'is_animated', False) and image.width <= size and image.height <= size:
+            return False
+        image.thumbnail((size, size))
+        frame = ImageOps.exif_transpose(image)
+        has_alpha = 'A' in frame.getbands() or 'transparency' in frame.info
+        frame = frame.convert('RGBA' if has_alpha else 'RGB')
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        tmp_path = f"{target_path}.{secrets.token_hex(4)}.tmp"
+        frame.save(tmp_path, 'WEBP', quality=quality)
+    os.replace(tmp_path, target_path)
+    return True
+
+class Thumbnailer:
+    def __init__(self, store, size=THUMBNAIL_SIZE, workers=THUMBNAIL_WORKERS, timeout=THUMBNAIL_TIMEOUT):
+        self.store = store
+        self.size = size
+        self.workers = workers
+        self.timeout = timeout
+        self.cache = LRUCache(THUMBNAIL_CACHE_SIZE)
+        self.generated = 0
+        self.failed = 0
+        self._pending = {}
+        self._tasks = set()
+        self._pool = None
+
+    def start(self):
+        if Image is None:
+            logger.warning("未安装Pillow，图片消息将不生成缩略图")
+            return
+        if self._pool is None:
+            self._pool = concurrent.futures.ProcessPoolExecutor(
+                self.workers, mp_context=multiprocessing.get_context('spawn'))
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._pool is not None:
+            pool, self._pool = self._pool, None
+            await asyncio.to_thread(pool.shutdown, cancel_futures=True)
+
+    def attach(self, reference, callback):
+        # 在后台生成缩略图，完成后回调，消息广播不等待
+        task = asyncio.create_task(self._attach(reference, callback))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _attach(self, reference, callback):
+        preview = await self.preview(reference)
+        if preview is None:
+            return
+        try:
+            await callback(preview)
+        except Exception as e:
+            logger.error(f"保存缩略图 {preview} 失败: {str(e)}")
+
+    async def preview(self, reference):
+        if self._pool is None or not reference or not reference.startswith(BLOB_URL_PREFIX):
+            return None
+        name = reference[len(BLOB_URL_PREFIX):]
+        if self.store.resolve(name) is None:
+            return None
+        digest = name.split('.')[0]
+        cached = self.cache.get(digest)
+        if cached is not LRUCache.missing:
+            return cached
+        if digest not in self._pending:
+            self._pending[digest] = asyncio.create_task(self._render(name, digest))
+        return await asyncio.shield(self._pending[digest])
+
+    async def _render(self, name, digest):
+        preview_name = digest + THUMBNAIL_SUFFIX
+        loop = asyncio.get_running_loop()
+        try:
+            rendered = await asyncio.wait_for(loop.run_in_executor(
+                self._pool, render_thumbnail, self.store.path(name), self.store.path(preview_name),
+                self.size, THUMBNAIL_QUALITY, THUMBNAIL_MAX_PIXELS), self.timeout)
+            result = BLOB_URL_PREFIX + preview_name if rendered else None
+            self.generated += rendered
+        except Exception as e:
+            logger.warning(f"生成缩略图失败 {name}: {e!r}")
+            self.failed += 1
+            result = None
+        finally:
+            del self._pending[digest]
+        self.cache.set(digest, result)
+        return result
+
+class TransferError(Exception):
+    pass
+
+class Transfer:
+    def __init__(self, username, room_number, kind, mime_type, size, path):
+        self.username = username
+        self.room_number = room_number
+        self.kind = kind
+        self.mime_type = mime_type
+        self.size = size
+        self.path = path
+        self.received = 0
+        self.digest = hashlib.sha256()
+        self.file = open(path, 'wb')
+        self.last_activity = time.monotonic()
+
+class LegacyTransfer:
+    # 旧版客户端把data URL切成文本分片发送，收齐之前分片留在内存中，按可能的最大长度计入用户的传输额度
+    def __init__(self, username, room_number, kind, chunk_total):
+        self.username = username
+        self.room_number = room_number
+        self.kind = kind
+        self.size = chunk_total * TRANSFER_LEGACY_CHUNK_SIZE
+        self.chunks = [None] * chunk_total
+        self.missing = chunk_total
+        self.received = 0
+        self.last_activity = time.monotonic()
+
+class TransferManager:
+    def __init__(self, store, max_size=TRANSFER_MAX_SIZE, user_max_bytes=TRANSFER_USER_MAX_BYTES,
+                 user_max_count=TRANSFER_USER_MAX_COUNT, timeout=TRANSFER_TIMEOUT):
+        self.store = store
+        self.max_size = max_size
+        self.user_max_bytes = user_max_bytes
+        self.user_max_count = user_max_count
+        self.timeout = timeout
+        self.transfers = {}
+        self.user_bytes = {}
+        self.user_counts = {}
+        self.expired = 0
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._reap_forever())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for key in list(self.transfers):
+            await self._discard(key)
+
+    async def begin(self, owner, transfer_id, username, room_number, kind, mime_type, size):
+        key = (owner, transfer_id)
+        if not isinstance(transfer_id, int) or not 0 <= transfer_id < 2 ** 32:
+            raise TransferError("无效的传输编号")
+        if kind not in TRANSFER_KINDS:
+            raise TransferError("不支持的传输类型")
+        if not self.store.allowed(kind, mime_type):
+            raise TransferError("不支持的图片或语音格式")
+        if key in self.transfers:
+            raise TransferError("传输编号重复")
+        if not isinstance(size, int) or size <= 0 or size > self.max_size:
+            raise TransferError("文件过大")
+        self._check_quota(username, size)
+
+        path = await asyncio.to_thread(self.store.temp_path)
+        self._add(key, await asyncio.to_thread(Transfer, username, room_number, kind, mime_type, size, path))
+
+    async def write_legacy(self, owner, username, room_number, kind, chunk_index, chunk_total, chunk):
+        # 每个连接每种类型同时只有一个旧版分片传输，收齐后返回 (transfer, reference)，否则返回None
+        if kind not in TRANSFER_KINDS:
+            raise TransferError("不支持的传输类型")
+        key = (owner, kind)
+        transfer = self.transfers.get(key)
+        if transfer is None:
+            if not isinstance(chunk_total, int) or not 0 < chunk_total <= TRANSFER_LEGACY_MAX_CHUNKS:
+                raise TransferError("文件过大")
+            self._check_quota(username, chunk_total * TRANSFER_LEGACY_CHUNK_SIZE)
+            transfer = LegacyTransfer(username, room_number, kind, chunk_total)
+            self._add(key, transfer)
+        if not isinstance(chunk, str) or len(chunk) > TRANSFER_LEGACY_CHUNK_SIZE or \
+                not isinstance(chunk_index, int) or not 0 <= chunk_index < len(transfer.chunks):
+            await self._discard(key)
+            raise TransferError("无效的数据分片")
+        previous = transfer.chunks[chunk_index]
+        if previous is None:
+            transfer.missing -= 1
+        else:
+            transfer.received -= len(previous)
+        transfer.chunks[chunk_index] = chunk
+        transfer.received += len(chunk)
+        transfer.last_activity = time.monotonic()
+        if transfer.missing:
+            return None
+        self._release(key)
+        reference = await self.store.put_data_url(''.join(transfer.chunks), kind)
+        return transfer, reference
+
+    async def write(self, owner, frame):
+        if len(frame) < TRANSFER_HEADER.size:
+            raise TransferError("无效的数据帧")
+        (transfer_id,) = TRANSFER_HEADER.unpack_from(frame)
+        transfer = self.transfers.get((owner, transfer_id))
+        if transfer is None:
+            return
+        chunk = frame[TRANSFER_HEADER.size:]
+        if transfer.received + len(chunk) > transfer.size:
+            await self._discard((owner, transfer_id))
+            raise TransferError("数据超过声明的大小")
+        transfer.digest.update(chunk)
+        transfer.received += len(chunk)
+        transfer.last_activity = time.monotonic()
+        await asyncio.to_thread(transfer.file.write, chunk)
+
+    async def finish(self, owner, transfer_id):
+        key = (owner, transfer_id)
+        transfer = self.transfers.get(key)
+        if transfer is None:
+            raise TransferError("传输不存在或已超时")
+        if transfer.received != transfer.size:
+            await self._discard(key)
+            raise TransferError("数据不完整")
+        self._release(key)
+        await asyncio.to_thread(transfer.file.close)
+        reference = await self.store.put_file(transfer.path, transfer.digest.hexdigest(), transfer.kind,
+                                             transfer.mime_type)
+        return transfer, reference
+
+    async def abort(self, owner, transfer_id=None):
+        for key in [key for key in self.transfers if key[0] is owner and transfer_id in (None, key[1])]:
+            await self._discard(key)
+
+    def buffered_bytes(self):
+        return sum(transfer.received for transfer in self.transfers.values())
+
+    def _check_quota(self, username, size):
+        if self.user_counts.get(username, 0) >= self.user_max_count:
+            raise TransferError("同时进行的传输过多")
+        if self.user_bytes.get(username, 0) + size > self.user_max_bytes:
+            raise TransferError("传输中的数据过多")
+
+    def _add(self, key, transfer):
+        self.transfers[key] = transfer
+        self.user_bytes[transfer.username] = self.user_bytes.get(transfer.username, 0) + transfer.size
+        self.user_counts[transfer.username] = self.user_counts.get(transfer.username, 0) + 1
+
+    def _release(self, key):
+        transfer = self.transfers.pop(key)
+        self.user_bytes[transfer.username] -= transfer.size
+        self.user_counts[transfer.username] -= 1
+        if not self.user_counts[transfer.username]:
+            del self.user_bytes[transfer.username]
+            del self.user_counts[transfer.username]
+        return transfer
+
+    async def _discard(self, key):
+        transfer = self._release(key)
+        if isinstance(transfer, Transfer):
+            await asyncio.to_thread(self._remove, transfer)
+
+    @staticmethod
+    def _remove(transfer):
+        transfer.file.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(transfer.path)
+
+    async def _reap_forever(self):
+        while True:
+            await asyncio.sleep(self.timeout / 4)
+            deadline = time.monotonic() - self.timeout
+            for key, transfer in list(self.transfers.items()):
+                if transfer.last_activity < deadline and key in self.transfers:
+                    logger.warning(f"用户 {transfer.username} 的传输超时，已丢弃")
+                    self.expired += 1
+                    await self._discard(key)
+
+class UploadError(Exception):
+    def __init__(self, message, status=400, offset=None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset
+
+class UploadStore:
+    # 未完成的上传按用户分目录，以 <用户>/<id>.part 和 <id>.json 存放在磁盘上，多个工作进程都能续传同一个上传
+    id_pattern = re.compile(r'^[0-9a-f]{32}$')
+    token_pattern = re.compile(r'^[0-9a-f]{16}$')
+
+    def __init__(self, root, max_size=UPLOAD_MAX_SIZE, user_max_count=UPLOAD_USER_MAX_COUNT,
+                 user_max_bytes=UPLOAD_USER_MAX_BYTES, expiry=UPLOAD_EXPIRY):
+        self.root = root
+        self.partial_dir = os.path.join(root, '.partial')
+        self.max_size = max_size
+        self.user_max_count = user_max_count
+        self.user_max_bytes = user_max_bytes
+        self.expiry = expiry
+        self.expired = 0
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._reap_forever())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    @staticmethod
+    def safe_name(file_name):
+        name = os.path.basename(str(file_name or '').replace('\\', '/')).strip()
+        name = ''.join(ch for ch in name if ch.isprintable())[:200]
+        if name in ('', '.', '..'):
+            raise UploadError("无效的文件名")
+        return name
+
+    def _user_dir(self, username):
+        return os.path.join(self.partial_dir, hashlib.sha256(username.encode('utf-8')).hexdigest()[:32])
+
+    def _meta_path(self, upload_id, username):
+        return os.path.join(self._user_dir(username), upload_id + '.json')
+
+    def _data_path(self, upload_id, username):
+        return os.path.join(self._user_dir(username), upload_id + '.part')
+
+    def _read_meta(self, path):
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+
+    def _pending(self, username):
+        # 只需要读取该用户目录下的几个文件，数量受user_max_count限制
+        count = total = 0
+        with contextlib.suppress(FileNotFoundError), os.scandir(self._user_dir(username)) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.json'):
+                    continue
+                try:
+                    meta = self._read_meta(entry.path)
+                except (OSError, ValueError):
+                    continue
+                count += 1
+                total += meta.get('size', 0)
+        return count, total
+
+    def _create(self, username, file_name, size):
+        os.makedirs(self._user_dir(username), exist_ok=True)
+        count, total = self._pending(username)
+        if count >= self.user_max_count:
+            raise UploadError("未完成的上传过多", 429)
+        if total + size > self.user_max_bytes:
+            raise UploadError("未完成的上传数据过多", 413)
+        upload_id = secrets.token_hex(16)
+        open(self._data_path(upload_id, username), 'xb').close()
+        meta_path = self._meta_path(upload_id, username)
+        with open(meta_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'username': username, 'fileName': file_name, 'size': size}, f, ensure_ascii=False)
+        os.replace(meta_path + '.tmp', meta_path)
+        return upload_id
+
+    def _load(self, upload_id, username, f=None):
+        if not username or not self.id_pattern.match(upload_id):
+            raise UploadError("上传不存在", 404)
+        try:
+            meta = self._read_meta(self._meta_path(upload_id, username))
+            if f is not None:
+                meta['offset'] = os.fstat(f.fileno()).st_size
+            else:
+                meta['offset'] = os.path.getsize(self._data_path(upload_id, username))
+        except (OSError, ValueError):
+            raise UploadError("上传不存在或已过期", 404)
+        if meta.get('username') != username:
+            raise UploadError("上传不存在", 404)
+        return meta
+
+    def _finalize(self, upload_id, username, f):
+        meta = self._load(upload_id, username, f)
+        if meta['offset'] != meta['size']:
+            raise UploadError("上传未完成", 409, meta['offset'])
+        token = secrets.token_hex(8)
+        os.makedirs(os.path.join(self.root, token))
+        os.replace(self._data_path(upload_id, username), os.path.join(self.root, token, meta['fileName']))
+        os.remove(self._meta_path(upload_id, username))
+        return f"{token}/{meta['fileName']}", meta['size']
+
+    def _remove(self, upload_id, username):
+        for path in (self._meta_path(upload_id, username), self._data_path(upload_id, username)):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+
+    def _lock(self, upload_id, username):
+        # 用flock锁住.part文件，同一个上传在所有工作进程中同时只有一个请求能写入
+        if not username or not self.id_pattern.match(upload_id):
+            raise UploadError("上传不存在", 404)
+        try:
+            f = open(self._data_path(upload_id, username), 'r+b')
+        except OSError:
+            raise UploadError("上传不存在或已过期", 404)
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            raise UploadError("该上传正在写入", 409)
+        return f
+
+    @contextlib.asynccontextmanager
+    async def _exclusive(self, upload_id, username):
+        f = await asyncio.to_thread(self._lock, upload_id, username)
+        try:
+            yield f
+        finally:
+            await asyncio.to_thread(f.close)
+
+    async def create(self, username, file_name, size):
+        name = self.safe_name(file_name)
+        if not isinstance(size, int) or size < 0:
+            raise UploadError("无效的文件大小")
+        if size > self.max_size:
+            raise UploadError("文件过大", 413)
+        return await asyncio.to_thread(self._create, username, name, size)
+
+    async def status(self, upload_id, username):
+        return await asyncio.to_thread(self._load, upload_id, username)
+
+    async def append(self, upload_id, username, offset, stream):
+        async with self._exclusive(upload_id, username) as f:
+            meta = await asyncio.to_thread(self._load, upload_id, username, f)
+            if offset != meta['offset']:
+                raise UploadError("偏移量不匹配", 409, meta['offset'])
+            remaining = meta['size'] - offset
+            written = 0
+            f.seek(offset)
+            try:
+                async for chunk in stream.iter_chunked(UPLOAD_READ_SIZE):
+                    if written + len(chunk) > remaining:
+                        await asyncio.to_thread(f.truncate, offset)
+                        raise UploadError("数据超过声明的大小", 413, offset)
+                    await asyncio.to_thread(f.write, chunk)
+                    written += len(chunk)
+            finally:
+                # 连接中断时保留已写入的数据，客户端查询偏移量后继续上传
+                await asyncio.to_thread(f.flush)
+                with contextlib.suppress(FileNotFoundError):
+                    await asyncio.to_thread(os.utime, self._meta_path(upload_id, username))
+            return offset + written
+
+    async def finalize(self, upload_id, username):
+        async with self._exclusive(upload_id, username) as f:
+            return await asyncio.to_thread(self._finalize, upload_id, username, f)
+
+    async def abort(self, upload_id, username):
+        async with self._exclusive(upload_id, username) as f:
+            await asyncio.to_thread(self._load, upload_id, username, f)
+            await asyncio.to_thread(self._remove, upload_id, username)
+
+    def resolve(self, file_name):
+        parts = file_name.split('/')
+        if len(parts) > 2 or any(part in ('', '.', '..') or '\\' in part for part in parts):
+            return None
+        if len(parts) == 2 and not self.token_pattern.match(parts[0]):
+            return None
+        if parts[0].startswith('.'):
+            return None
+        return os.path.join(self.root, *parts)
+
+    def _expire(self):
+        deadline = time.time() - self.expiry
+        expired = set()
+
+        def collect(directory):
+            # 用户目录中的上传，以及旧版本直接放在.partial中的上传
+            with contextlib.suppress(FileNotFoundError), os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if directory == self.partial_dir:
+                            collect(entry.path)
+                        continue
+                    upload_id = entry.name.split('.')[0]
+                    with contextlib.suppress(FileNotFoundError):
+                        if self.id_pattern.match(upload_id) and entry.stat().st_mtime < deadline:
+                            expired.add((directory, upload_id))
+
+        collect(self.partial_dir)
+        removed = 0
+        for directory, upload_id in expired:
+            try:
+                f = open(os.path.join(directory, upload_id + '.part'), 'r+b')
+            except FileNotFoundError:
+                f = None
+            try:
+                # 正在写入的上传跳过，下次再清理
+                if f is not None:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                for suffix in ('.json', '.part'):
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(os.path.join(directory, upload_id + suffix))
+                removed += 1
+            except BlockingIOError:
+                pass
+            finally:
+                if f is not None:
+                    f.close()
+        return removed
+
+    async def _reap_forever(self):
+        while True:
+            try:
+                expired = await asyncio.to_thread(self._expire)
+                if expired:
+                    self.expired += expired
+                    logger.info(f"已清理 {expired} 个过期的未完成上传")
+            except Exception as e:
+                logger.error(f"清理未完成的上传失败: {str(e)}")
+            await asyncio.sleep(UPLOAD_REAP_INTERVAL)
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        self.refill(now)
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+class RateLimiter:
+    def __init__(self, limits=RATE_LIMITS, max_buckets=RATE_LIMIT_MAX_BUCKETS):
+        self.limits = limits
+        self.max_buckets = max_buckets
+        self.buckets = {}
+
+    def _buckets(self, kind, username, room_number, now):
+        user_rate, user_burst, room_rate, room_burst = self.limits[kind]
+        buckets = []
+        for key, rate, burst in (((kind, 'user', username), user_rate, user_burst),
+                                 ((kind, 'room', room_number), room_rate, room_burst)):
+            if rate is None:
+                continue
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                if len(self.buckets) >= self.max_buckets:
+                    self._sweep(now)
+                bucket = self.buckets[key] = TokenBucket(rate, burst, now)
+            buckets.append(bucket)
+        return buckets
+
+    def allow(self, kind, username, room_number):
+        now = time.monotonic()
+        buckets = self._buckets(kind, username, room_number, now)
+        if any(bucket.delay(now) > 0 for bucket in buckets):
+            throttled.inc(label_value=kind)
+            return False
+        for bucket in buckets:
+            bucket.tokens -= 1
+        return True
+
+    async def wait(self, kind, username, room_number):
+        # 分片不能丢弃，超出速率时暂停读取该连接，由TCP把压力传回客户端
+        now = time.monotonic()
+        buckets = self._buckets(kind, username, room_number, now)
+        delay = max((bucket.delay(now) for bucket in buckets), default=0)
+        for bucket in buckets:
+            bucket.tokens -= 1
+        if delay > 0:
+            throttled.inc(label_value=kind)
+            await asyncio.sleep(delay)
+
+    def _sweep(self, now):
+        for key, bucket in list(self.buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.burst:
+                del self.buckets[key]
+
+class Outbox:
+    # 每个连接一个有界发送队列，慢速客户端不会拖慢整个房间的广播
+    def __init__(self, ws, max_frames=WS_SEND_QUEUE_FRAMES, max_bytes=WS_SEND_QUEUE_BYTES,
+                 policy=WS_SLOW_CONSUMER_POLICY):
+        self.ws = ws
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.size = 0
+        self.dropped = 0
+        self._queue = collections.deque()
+        self._ready = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    def put(self, frame):
+        if self._task is None or self.ws.closed:
+            return
+        if len(self._queue) >= self.max_frames or self.size + len(frame) > self.max_bytes:
+            slow_consumers.inc(label_value=self.policy)
+            if self.policy == 'drop':
+                self.dropped += 1
+                return
+            logger.warning("客户端接收过慢，关闭连接")
+            self.close()
+            asyncio.create_task(self.ws.close(code=WSCloseCode.TRY_AGAIN_LATER))
+            return
+        self._queue.append(frame)
+        self.size += len(frame)
+        self._ready.set()
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._queue.clear()
+        self.size = 0
+
+    async def _run(self):
+        while True:
+            await self._ready.wait()
+            self._ready.clear()
+            while self._queue:
+                frame = self._queue.popleft()
+                self.size -= len(frame)
+                try:
+                    await asyncio.wait_for(self.ws.send_frame(frame, web.WSMsgType.TEXT), BROADCAST_SEND_TIMEOUT)
+                except asyncio.TimeoutError:
+                    broadcast_timeouts.inc()
+                    logger.warning("广播发送超时，关闭连接")
+                    self._task = None
+                    asyncio.create_task(self.ws.close())
+                    return
+                except ConnectionError:
+                    self._task = None
+                    return
+
+class StaticAsset:
+    def __init__(self, name, body):
+        self.name = name
+        self.content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        if self.content_type.startswith('text/'):
+            self.content_type += '; charset=utf-8'
+        self.digest = hashlib.sha256(body).hexdigest()[:STATIC_HASH_LENGTH]
+        base, extension = posixpath.splitext(name)
+        self.hashed_name = f"{base}.{self.digest}{extension}"
+        # 编码: 内容，None为未压缩的原文
+        self.bodies = {None: body}
+        if self.content_type.startswith(STATIC_COMPRESS_TYPES) and len(body) >= STATIC_COMPRESS_MIN_SIZE:
+            self.bodies['gzip'] = gzip.compress(body, STATIC_GZIP_LEVEL, mtime=0)
+            if brotli is not None:
+                self.bodies['br'] = brotli.compress(body, quality=STATIC_BROTLI_QUALITY)
+            for encoding in ('gzip', 'br'):
+                if len(self.bodies.get(encoding, body)) >= len(body):
+                    self.bodies.pop(encoding, None)
+        self.etags = {encoding: f"{self.digest}-{encoding}" if encoding else self.digest
+                      for encoding in self.bodies}
+
+    @property
+    def size(self):
+        return len(self.bodies[None])
+
+    def negotiate(self, accept_encoding):
+        accepted = set()
+        for part in accept_encoding.lower().split(','):
+            coding, _, params = part.partition(';')
+            if not re.fullmatch(r'\s*q=0(\.0*)?\s*', params):
+                accepted.add(coding.strip())
+        for encoding in ('br', 'gzip'):
+            if encoding in self.bodies and (encoding in accepted or '*' in accepted):
+                return encoding
+        return None
+
+    def response(self, request, cache_control):
+        encoding = self.negotiate(request.headers.get('Accept-Encoding', ''))
+        headers = {'Cache-Control': cache_control, 'ETag': f'"{self.etags[encoding]}"',
+                   'Vary': 'Accept-Encoding'}
+        etags = self.etags.values()
+        if any(etag.value == '*' or etag.value in etags for etag in request.if_none_match or ()):
+            return web.Response(status=304, headers=headers)
+        headers['Content-Type'] = self.content_type
+        if encoding:
+            headers['Content-Encoding'] = encoding
+        return web.Response(body=self.bodies[encoding], headers=headers)
+
+class StaticAssets:
+    # 启动时把静态文件读入内存并预先压缩，文件名加上内容哈希，页面模板和样式表中的引用替换为带哈希的地址
+    css_url_pattern = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+    placeholder_pattern = re.compile(r'\{\{\s*(\S+?)\s*\}\}')
+
+    def __init__(self, directory=STATIC_DIR, url_prefix=STATIC_URL_PREFIX, template=STATIC_INDEX_TEMPLATE):
+        self.directory = directory
+        self.url_prefix = url_prefix
+        self.template = template
+        self.files = {}
+        self.index = None
+
+    def load(self):
+        names = []
+        for root, directories, file_names in os.walk(self.directory):
+            directories[:] = [name for name in directories if not name.startswith('.')]
+            names.extend(os.path.relpath(os.path.join(root, name), self.directory).replace(os.sep, '/')
+                         for name in file_names if not name.startswith('.'))
+        files = {}
+        # 样式表最后处理，其中引用的字体和图片已经有了带哈希的文件名
+        for name in sorted(names, key=lambda name: (name.endswith('.css'), name)):
+            with open(os.path.join(self.directory, name), 'rb') as file:
+                body = file.read()
+            if name.endswith('.css'):
+                body = self._rewrite_css(name, body, files)
+            asset = StaticAsset(name, body)
+            files[name] = files[asset.hashed_name] = asset
+        self.files = files
+
+        with open(self.template, encoding='utf-8') as file:
+            page = self.placeholder_pattern.sub(lambda match: self.url(match.group(1)), file.read())
+        self.index = StaticAsset(self.template, page.encode('utf-8'))
+
+        missing = [name for name in VENDOR_ASSETS if name not in files]
+        if missing:
+            logger.warning(f"缺少 {len(missing)} 个第三方静态文件，页面将从CDN加载，"
+                           f"离线部署前请运行 python server.py --vendor 下载")
+        total = sum(asset.size for name, asset in files.items() if name == asset.name)
+        logger.info(f"已加载 {len(names)} 个静态文件，共 {total} 字节"
+                    f"{'' if brotli is not None else '（未安装brotli，只提供gzip压缩）'}")
+
+    def url(self, name):
+        asset = self.files.get(name)
+        if asset is not None:
+            return self.url_prefix + asset.hashed_name
+        if name in VENDOR_ASSETS:
+            return VENDOR_ASSETS[name]
+        raise ValueError(f"页面模板引用了不存在的静态文件: {name}")
+
+    def _rewrite_css(self, name, body, files):
+        base = posixpath.dirname(name)
+
+        def replace(match):
+            quote, url = match.groups()
+            path, suffix = re.match(r'([^?#]*)(.*)', url).groups()
+            asset = files.get(posixpath.normpath(posixpath.join(base, path))) if path else None
+            if asset is None:
+                return match.group(0)
+            return f"url({quote}{posixpath.relpath(asset.hashed_name, base or '.')}{suffix}{quote})"
+
+        return self.css_url_pattern.sub(replace, body.decode('utf-8')).encode('utf-8')
+
+class LRUCache:
+    missing = object()
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        try:
+            value = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return self.missing
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+class MetadataCache:
+    def __init__(self, db, max_entries=METADATA_CACHE_SIZE):
+        self.db = db
+        self.rooms = LRUCache(max_entries)
+        self.user_rooms = LRUCache(max_entries)
+        self.room_users = LRUCache(max_entries)
+
+    async def get_room(self, room_number):
+        room = self.rooms.get(room_number)
+        if room is LRUCache.missing:
+            rows = await self.db.execute("SELECT room_name, room_password FROM rooms WHERE room_number = ?",
+                                         (room_number,))
+            room = tuple(rows[0]) if rows else None
+            self.rooms.set(room_number, room)
+        return room
+
+    async def get_user_rooms(self, username):
+        room_numbers = self.user_rooms.get(username)
+        if room_numbers is LRUCache.missing:
+            rows = await self.db.execute("""
+                SELECT r.room_number, r.room_name, r.room_password
+                FROM user_rooms ur
+                JOIN rooms r ON ur.room_number = r.room_number
+                WHERE ur.username = ?
+                ORDER BY ur.id
+            """, (username,))
+            for row in rows:
+                self.rooms.set(row[0], (row[1], row[2]))
+            room_numbers = tuple(row[0] for row in rows)
+            self.user_rooms.set(username, room_numbers)
+
+        room_list = []
+        for room_number in room_numbers:
+            room = await self.get_room(room_number)
+            if room is not None:
+                room_list.append({"roomNumber": room_number, "roomName": room[0]})
+        return room_list
+
+    async def get_room_users(self, room_number):
+        usernames = self.room_users.get(room_number)
+        if usernames is LRUCache.missing:
+            rows = await self.db.execute("SELECT username FROM user_rooms WHERE room_number = ? ORDER BY id",
+                                         (room_number,))
+            usernames = tuple(row[0] for row in rows)
+            self.room_users.set(room_number, usernames)
+        return usernames
+
+    def invalidate(self, namespace, key):
+        getattr(self, namespace).invalidate(key)
+
+    def stats(self):
+        return {namespace: getattr(self, namespace).stats() for namespace in ('rooms', 'user_rooms', 'room_users')}
+
+class RoomBuffer:
+    def __init__(self, has_more):
+        self.entries = collections.deque()
+        self.size = 0
+        self.has_more = has_more
+        self.frame = None
+
+class RecentMessages:
+    # 每个房间最近的消息以编码好的JSON保存，进入房间时直接发送拼好的history帧
+    def __init__(self, max_messages=RECENT_MESSAGES_PER_ROOM, room_max_bytes=RECENT_ROOM_MAX_BYTES,
+                 max_bytes=RECENT_MAX_BYTES):
+        self.max_messages = max_messages
+        self.room_max_bytes = room_max_bytes
+        self.max_bytes = max_bytes
+        self.rooms = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._warming = {}
+
+    async def history_frame(self, room_number, since=None):
+        buffer = self.rooms.get(room_number)
+        if buffer is None:
+            self.misses += 1
+            buffer = await self._warm(room_number)
+        else:
+            self.hits += 1
+            self.rooms.move_to_end(room_number)
+        if since is not None and (not buffer.has_more or (buffer.entries and buffer.entries[0][0] <= since)):
+            # 断线重连时缓存覆盖了客户端缺少的消息，只发送since之后的部分，否则发送完整的历史记录
+            return ('{"type": "history", "since": ' + str(since) + ', "messages": ['
+                    + ', '.join(encoded for message_id, encoded in buffer.entries if message_id > since) + ']}')
+        if buffer.frame is None:
+            buffer.frame = ('{"type": "history", "messages": ['
+                            + ', '.join(encoded for _, encoded in buffer.entries)
+                            + '], "hasMore": ' + ('true' if buffer.has_more else 'false') + '}')
+        return buffer.frame
+
+    def append(self, room_number, message_id, encoded):
+        if room_number in self._warming:
+            self._warming[room_number][1].append((message_id, encoded))
+            return
+        buffer = self.rooms.get(room_number)
+        if buffer is None:
+            return
+        size = buffer.size
+        self._insert(buffer, message_id, encoded)
+        self.size += buffer.size - size
+        self.rooms.move_to_end(room_number)
+        self._evict()
+
+    async def _warm(self, room_number):
+        if room_number not in self._warming:
+            self._warming[room_number] = (asyncio.create_task(self._load(room_number)), [])
+        return await asyncio.shield(self._warming[room_number][0])
+
+    async def _load(self, room_number):
+        try:
+            messages, has_more = await fetch_history(room_number, limit=self.max_messages)
+        finally:
+            _, pending = self._warming.pop(room_number)
+        # 加载期间广播的消息先暂存，读完数据库后再合并，避免遗漏
+        buffer = RoomBuffer(has_more)
+        for message in messages:
+            self._insert(buffer, message['id'], json.dumps(message))
+        for message_id, encoded in pending:
+            self._insert(buffer, message_id, encoded)
+        self.rooms[room_number] = buffer
+        self.size += buffer.size
+        self._evict()
+        return buffer
+
+    def _insert(self, buffer, message_id, encoded):
+        entries = buffer.entries
+        if not entries or message_id > entries[-1][0]:
+            entries.append((message_id, encoded))
+        else:
+            # 多进程部署时其他进程的消息可能乱序到达
+            if any(existing == message_id for existing, _ in entries):
+                return
+            if len(entries) >= self.max_messages and message_id < entries[0][0]:
+                buffer.has_more = True
+                return
+            index = len(entries)
+            while index and entries[index - 1][0] > message_id:
+                index -= 1
+            entries.insert(index, (message_id, encoded))
+        buffer.size += len(encoded)
+        buffer.frame = None
+        while len(entries) > self.max_messages or (buffer.size > self.room_max_bytes and len(entries) > 1):
+            _, dropped = entries.popleft()
+            buffer.size -= len(dropped)
+            buffer.has_more = True
+
+    def replace(self, room_number, message_id, encoded):
+        buffer = self.rooms.get(room_number)
+        if buffer is None:
+            return
+        for index, (existing, previous) in enumerate(buffer.entries):
+            if existing == message_id:
+                buffer.entries[index] = (message_id, encoded)
+                buffer.size += len(encoded) - len(previous)
+                self.size += len(encoded) - len(previous)
+                buffer.frame = None
+                return
+
+    def count_after(self, room_number, message_id):
+        buffer = self.rooms.get(room_number)
+        if buffer is None:
+            return 0
+        return sum(1 for existing, _ in buffer.entries if existing > message_id)
+
+    def discard(self, room_number, message_ids):
+        # 广播时已加入缓存但写入失败的消息，从缓存中移除，历史记录与数据库保持一致
+        if room_number in self._warming:
+            pending = self._warming[room_number][1]
+            pending[:] = [entry for entry in pending if entry[0] not in message_ids]
+        buffer = self.rooms.get(room_number)
+        if buffer is None:
+            return
+        removed = sum(len(encoded) for message_id, encoded in buffer.entries if message_id in message_ids)
+        if not removed:
+            return
+        buffer.entries = collections.deque(entry for entry in buffer.entries if entry[0] not in message_ids)
+        buffer.size -= removed
+        self.size -= removed
+        buffer.frame = None
+
+    def expire(self, room_number, message_ids):
+        # 缓存中有消息被保留策略删除时丢弃整个房间的缓存，下次进入房间时重新从数据库加载
+        buffer = self.rooms.get(room_number)
+        if buffer is not None and any(message_id in message_ids for message_id, _ in buffer.entries):
+            del self.rooms[room_number]
+            self.size -= buffer.size
+
+    def _evict(self):
+        while self.size > self.max_bytes and len(self.rooms) > 1:
+            _, buffer = self.rooms.popitem(last=False)
+            self.size -= buffer.size
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            'size': len(self.rooms),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+class Presence:
+    def __init__(self, db, flush_interval=PRESENCE_FLUSH_INTERVAL):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.online = {}
+        self.last_seen = {}
+        self._dirty = {}
+        self._task = None
+
+    async def start(self):
+        rows = await self.db.execute("SELECT username, last_seen FROM user_presence")
+        for username, last_seen in rows:
+            self.last_seen.setdefault(username, last_seen)
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_forever())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    def join(self, room_number, username, persist=True):
+        members = self.online.setdefault(room_number, {})
+        members[username] = members.get(username, 0) + 1
+        self.touch(username, persist)
+        return members[username] == 1
+
+    def leave(self, room_number, username, persist=True):
+        members = self.online.get(room_number)
+        if not members or username not in members:
+            return False
+        members[username] -= 1
+        self.touch(username, persist)
+        if members[username]:
+            return False
+        del members[username]
+        if not members:
+            del self.online[room_number]
+        return True
+
+    def touch(self, username, persist=True):
+        now = time.time()
+        self.last_seen[username] = now
+        if persist:
+            self._dirty[username] = now
+
+    def is_online(self, room_number, username):
+        return username in self.online.get(room_number, ())
+
+    def online_count(self, room_number):
+        return len(self.online.get(room_number, ()))
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        rows, self._dirty = list(self._dirty.items()), {}
+        try:
+            await self.db.executemany(
+                "INSERT INTO user_presence (username, last_seen) VALUES (?, ?) "
+                "ON CONFLICT(username) DO UPDATE SET last_seen = MAX(last_seen, excluded.last_seen)", rows)
+        except Exception as e:
+            logger.error(f"保存最近上线时间失败: {str(e)}")
+            for username, last_seen in rows:
+                self._dirty.setdefault(username, last_seen)
+
+    async def _flush_forever(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+class UnreadCounter:
+    # 房间消息数和每个用户的已读位置都保存在内存中，定期写回数据库，读取房间列表和标记已读都不访问数据库
+    def __init__(self, meta, data, flush_interval=READ_FLUSH_INTERVAL):
+        self.meta = meta
+        self.data = data
+        self.flush_interval = flush_interval
+        # 房间号: [最大id, 消息数, 已删除消息数]
+        self.rooms = {}
+        # (用户名, 房间号): (已读id, 已读时的消息数)
+        self.read = {}
+        self._dirty = {}
+        self._task = None
+
+    async def start(self):
+        rows = await self.data.execute("SELECT room_number, last_id, message_count, expired_count FROM room_sequences")
+        for room_number, last_id, message_count, expired_count in rows:
+            self.rooms[room_number] = [last_id, message_count, expired_count]
+        rows = await self.meta.execute("SELECT username, room_number, last_read_id, read_count FROM user_rooms")
+        for username, room_number, last_read_id, read_count in rows:
+            key = (username, room_number)
+            if read_count is None:
+                self.read[key] = self._dirty[key] = self.baseline(room_number)
+            else:
+                self.read[key] = (last_read_id, read_count)
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_forever())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    def baseline(self, room_number):
+        # 加入房间时已有的消息都算已读
+        last_id, message_count, _ = self.rooms.get(room_number, (0, 0, 0))
+        return last_id, message_count
+
+    def observe(self, room_number, message_id, sender=None):
+        room = self.rooms.setdefault(room_number, [0, 0, 0])
+        room[0] = max(room[0], message_id)
+        room[1] += 1
+        # 自己发的消息不算未读，已读数加一，已读位置不变
+        key = (sender, room_number)
+        current = self.read.get(key)
+        if sender is None or current is None:
+            return None
+        state = (current[0], current[1] + 1)
+        self.read[key] = self._dirty[key] = state
+        return state
+
+    def expire(self, room_number, count):
+        self.rooms.setdefault(room_number, [0, 0, 0])[2] += count
+
+    def discard(self, room_number, count):
+        # 写入失败的消息广播时已经计数，数据库中没有这些消息
+        self.rooms.setdefault(room_number, [0, 0, 0])[1] -= count
+
+    def mark_read(self, username, room_number, message_id, newer=0):
+        # newer为房间中id大于已读位置的消息数，客户端还没有收到，不计入已读
+        last_id, message_count, _ = self.rooms.get(room_number, (0, 0, 0))
+        message_id = min(message_id, last_id)
+        key = (username, room_number)
+        current = self.read.get(key)
+        if current is not None and message_id <= current[0]:
+            return None
+        state = (message_id, max(message_count - newer, current[1] if current else 0))
+        self.read[key] = self._dirty[key] = state
+        return state
+
+    def apply(self, username, room_number, last_read_id, read_count):
+        key = (username, room_number)
+        current = self.read.get(key)
+        if current is None or (last_read_id, read_count) > current:
+            self.read[key] = (last_read_id, read_count)
+
+    def state(self, username, room_number):
+        last_id, message_count, expired_count = self.rooms.get(room_number, (0, 0, 0))
+        # 其他工作进程刚加入的房间，已读位置还没有同步过来
+        last_read_id, read_count = self.read.get((username, room_number), (last_id, message_count))
+        unread = min(message_count - read_count, message_count - expired_count)
+        return {'unread': max(unread, 0), 'lastReadId': last_read_id}
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        rows, self._dirty = list(self._dirty.items()), {}
+        try:
+            await self.meta.executemany(
+                "UPDATE user_rooms SET last_read_id = ?, read_count = ? "
+                "WHERE username = ? AND room_number = ? AND (read_count IS NULL OR last_read_id <= ?)",
+                [(last_read_id, read_count, username, room_number, last_read_id)
+                 for (username, room_number), (last_read_id, read_count) in rows])
+        except Exception as e:
+            logger.error(f"保存已读位置失败: {str(e)}")
+            for key, state in rows:
+                self._dirty.setdefault(key, state)
+
+    async def _flush_forever(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+def encode_envelope(kind, room_number, payload=None, message_id=None):
+    body = json.dumps([kind, room_number, payload, message_id]).encode('utf-8')
+    return BACKPLANE_HEADER.pack(len(body)) + body
+
+async def read_envelope(reader):
+    header = await reader.readexactly(BACKPLANE_HEADER.size)
+    body = await reader.readexactly(BACKPLANE_HEADER.unpack(header)[0])
+    return header + body, json.loads(body)
+
+class LocalBackplane:
+    async def start(self, handler):
+        pass
+
+    async def publish(self, kind, room_number, payload=None, message_id=None):
+        pass
+
+    async def close(self):
+        pass
+
+class UnixSocketBackplane:
+    def __init__(self, path):
+        self.path = path
+        self._writer = None
+        self._task = None
+
+    async def start(self, handler):
+        reader, self._writer = await asyncio.open_unix_connection(self.path)
+        self._task = asyncio.create_task(self._read_forever(reader, handler))
+
+    async def _read_forever(self, reader, handler):
+        try:
+            while True:
+                _, envelope = await read_envelope(reader)
+                try:
+                    await handler(*envelope)
+                except Exception as e:
+                    logger.error(f"处理跨进程消息失败: {str(e)}")
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # 断开期间错过的消息无法补回，在线状态、缓存和未读数都会与其他进程不一致；
+            # 正常关闭后由主进程重新启动，从数据库重新加载
+            logger.error("与消息中转的连接已断开，工作进程退出")
+            os.kill(os.getpid(), signal.SIGTERM)
+
+    async def publish(self, kind, room_number, payload=None, message_id=None):
+        if self._writer is not None and not self._writer.is_closing():
+            self._writer.write(encode_envelope(kind, room_number, payload, message_id))
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+class BackplaneHub:
+    def __init__(self, path):
+        self.path = path
+        self.workers = {}
+        self._tasks = set()
+        self._server = None
+
+    async def start(self):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.path)
+        self._server = await asyncio.start_unix_server(self._serve, path=self.path)
+
+    async def close(self):
+        self._server.close()
+        for writer in list(self.workers):
+            writer.close()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self._server.wait_closed()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.path)
+
+    def _relay(self, source, frame):
+        for writer in self.workers:
+            if writer is not source and not writer.is_closing():
+                writer.write(frame)
+
+    async def _serve(self, reader, writer):
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        presence = {}
+        for other in self.workers.values():
+            for (room_number, username), count in other.items():
+                for _ in range(count):
+                    writer.write(encode_envelope('join', room_number, username))
+        self.workers[writer] = presence
+        try:
+            while True:
+                frame, (kind, room_number, payload, _) = await read_envelope(reader)
+                key = (room_number, payload)
+                if kind == 'join':
+                    presence[key] = presence.get(key, 0) + 1
+                elif kind == 'leave' and key in presence:
+                    presence[key] -= 1
+                    if not presence[key]:
+                        del presence[key]
+                self._relay(writer, frame)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            del self.workers[writer]
+            for (room_number, username), count in presence.items():
+                for _ in range(count):
+                    self._relay(writer, encode_envelope('leave', room_number, username))
+            writer.close()
 
 meta_db = Database(DB_PATH_META)
 data_db = Database(DB_PATH_DATA)
-
-connected = {}
-online_users = set()
-message_fragments = {}
-user_last_online = {}
+unread_counter = UnreadCounter(meta_db, data_db)
+message_writer = MessageWriter(data_db)
+retention_worker = RetentionWorker(data_db, Database(DB_PATH_ARCHIVE, read_connections=1))
+blob_store = BlobStore(BLOB_DIR)
+transfer_manager = TransferManager(blob_store)
+thumbnailer = Thumbnailer(blob_store)
+upload_store = UploadStore(UPLOAD_DIR)
+metadata_cache = MetadataCache(meta_db)
+recent_messages = RecentMessages()
+static_assets = StaticAssets()
+rate_limiter = RateLimiter()
+presence = Presence(meta_db)
+backplane = LocalBackplane()
+session_secret = None
+
+room_sockets = {}
+outboxes = {}
+
+def room_socket_buckets():
+    counts = [len(sockets) for sockets in room_sockets.values()]
+    buckets = {str(bound): sum(count <= bound for count in counts) for bound in METRICS_ROOM_SOCKET_BUCKETS}
+    buckets['+Inf'] = len(counts)
+    return buckets
+
+metrics.gauge('chat_active_sockets', 'WebSocket连接数', lambda: sum(len(sockets) for sockets in room_sockets.values()))
+metrics.gauge('chat_active_rooms', '有WebSocket连接的房间数', lambda: len(room_sockets))
+metrics.gauge('chat_room_sockets', '连接数不超过le的房间数', room_socket_buckets, 'le')
+metrics.gauge('chat_write_queue_depth', '等待写入数据库的消息数', lambda: message_writer.pending)
+metrics.gauge('chat_send_queue_bytes', '各连接发送队列中等待发送的字节数',
+              lambda: sum(outbox.size for outbox in outboxes.values()))
+metrics.gauge('chat_transfer_buffered_bytes', '进行中的二进制传输已接收的字节数', transfer_manager.buffered_bytes)
+metrics.gauge('chat_transfers_active', '进行中的二进制传输数', lambda: len(transfer_manager.transfers))
+metrics.gauge('chat_thumbnails', '缩略图生成结果计数',
+              lambda: {'generated': thumbnailer.generated, 'failed': thumbnailer.failed}, 'result')
+metrics.gauge('chat_metadata_cache_hits', '元数据缓存命中次数',
+              lambda: {name: stats['hits'] for name, stats in cache_stats().items()}, 'cache')
+metrics.gauge('chat_metadata_cache_misses', '元数据缓存未命中次数',
+              lambda: {name: stats['misses'] for name, stats in cache_stats().items()}, 'cache')
+metrics.gauge('chat_recent_messages_bytes', '最近消息缓存占用的内存', lambda: recent_messages.size)
+metrics.gauge('chat_recent_messages_rooms', '最近消息缓存中的房间数', lambda: len(recent_messages.rooms))
+
+def cache_stats():
+    return {**metadata_cache.stats(), 'recent_messages': recent_messages.stats()}
+
+async def invalidate_metadata(*entries):
+    for namespace, key in entries:
+        metadata_cache.invalidate(namespace, key)
+        await backplane.publish('invalidate', None, [namespace, key])
+
+async def user_room_list(username):
+    room_list = await metadata_cache.get_user_rooms(username)
+    return [{**room, **unread_counter.state(username, room['roomNumber'])} for room in room_list]
+
+async def insert_user_room(username, room_number):
+    state = unread_counter.baseline(room_number)
+    await meta_db.execute("INSERT INTO user_rooms (username, room_number, last_read_id, read_count) VALUES (?, ?, ?, ?)",
+                          (username, room_number, *state))
+    return state
+
+async def track_read_state(username, room_number, state):
+    unread_counter.apply(username, room_number, *state)
+    await backplane.publish('read', room_number, [username, *state])
 
 def hash_password(password):
     return hashlib.sha256(password.encode()).hexdigest()
@@ -55,26 +2116,26 @@ async def register(request):
 
     hashed_password = hash_password(password)
 
-    async with aiosqlite.connect(DB_PATH_META) as db:
-        user_exists = await db.execute("SELECT 1 FROM users WHERE username = ?", (username,))
-        if await user_exists.fetchone():
-            return web.json_response({"success": False, "message": "用户已存在！"})
+    user_exists = await meta_db.execute("SELECT 1 FROM users WHERE username = ?", (username,))
+    if user_exists:
+        return web.json_response({"success": False, "message": "用户已存在！"})
 
-        await db.execute("BEGIN TRANSACTION")
-        try:
+    try:
+        async with meta_db.transaction() as db:
             await db.execute("INSERT INTO users (username, password) VALUES (?, ?)",
                              (username, hashed_password))
-            
-            await db.execute("INSERT INTO user_rooms (username, room_number) VALUES (?, ?)",
-                             (username, "1"))
-            
-            await db.commit()
-            print(f"{format_time()} 新用户 {username} 注册成功并被添加到公共聊天室")
-            return web.json_response({"success": True})
-        except Exception as e:
-            await db.rollback()
-            print(f"{format_time()} 注册用户 {username} 时发生错误: {str(e)}")
-            return web.json_response({"success": False, "message": "注册失败，请稍后重试"})
+
+            state = unread_counter.baseline("1")
+            await db.execute("INSERT INTO user_rooms (username, room_number, last_read_id, read_count) "
+                             "VALUES (?, ?, ?, ?)", (username, "1", *state))
+
+        await track_read_state(username, "1", state)
+        await invalidate_metadata(('user_rooms', username), ('room_users', "1"))
+        logger.info(f"新用户 {username} 注册成功并被添加到公共聊天室")
+        return web.json_response({"success": True})
+    except Exception as e:
+        logger.error(f"注册用户 {username} 时发生错误: {str(e)}")
+        return web.json_response({"success": False, "message": "注册失败，请稍后重试"})
 
 async def login(request):
     data = await request.json()
@@ -87,13 +2148,7 @@ async def login(request):
         session = await get_session(request)
         session['username'] = username
         
-        rooms = await meta_db.execute("""
-            SELECT r.room_number, r.room_name 
-            FROM user_rooms ur
-            JOIN rooms r ON ur.room_number = r.room_number
-            WHERE ur.username = ?
-        """, (username,))
-        room_list = [{"roomNumber": row[0], "roomName": row[1]} for row in rooms]
+        room_list = await user_room_list(username)
         
         return web.json_response({
             "success": True,
@@ -110,36 +2165,38 @@ async def add_room(request):
     room_password = data.get('roomPassword', '')
     username = data.get('username')
 
-    print(f"{format_time()} 用户 {username} 请求添加房间：{room_number}")
+    logger.info(f"用户 {username} 请求添加房间：{room_number}")
 
     try:
-        room_result = await meta_db.execute("SELECT room_name, room_password FROM rooms WHERE room_number = ?", (room_number,))
+        room_result = await metadata_cache.get_room(room_number)
         if room_result:
-            stored_room_name, stored_password = room_result[0]
+            stored_room_name, stored_password = room_result
             if stored_password == hash_password(room_password) or (stored_password == '' and room_password == ''):
                 try:
-                    await meta_db.execute("INSERT INTO user_rooms (username, room_number) VALUES (?, ?)", (username, room_number))
-                    print(f"{format_time()} 用户 {username} 成功加入已存在的房间 {room_number}")
+                    state = await insert_user_room(username, room_number)
+                    await track_read_state(username, room_number, state)
+                    await invalidate_metadata(('user_rooms', username), ('room_users', room_number))
+                    logger.info(f"用户 {username} 成功加入已存在的房间 {room_number}")
                     return web.json_response({"success": True, "roomNumber": room_number, "roomName": stored_room_name})
                 except aiosqlite.IntegrityError:
-                    print(f"{format_time()} 用户 {username} 已经在房间 {room_number} 中")
+                    logger.info(f"用户 {username} 已经在房间 {room_number} 中")
                     return web.json_response({"success": True, "roomNumber": room_number, "roomName": stored_room_name, "message": "已在房间中"})
             else:
-                print(f"{format_time()} 用户 {username} 尝试加入房间 {room_number} 失败：密码错误")
+                logger.info(f"用户 {username} 尝试加入房间 {room_number} 失败：密码错误")
                 return web.json_response({"success": False, "message": "密码错误"})
         else:
-            print(f"{format_time()} 创建新房间 {room_number}")
+            logger.info(f"创建新房间 {room_number}")
             hashed_password = hash_password(room_password) if room_password else ''
             await meta_db.execute("INSERT INTO rooms (room_number, room_name, room_password) VALUES (?, ?, ?)",
                                   (room_number, room_name, hashed_password))
-            await meta_db.execute("INSERT INTO user_rooms (username, room_number) VALUES (?, ?)", (username, room_number))
-            print(f"{format_time()} 用户 {username} 成功创建并加入新房间 {room_number}")
+            state = await insert_user_room(username, room_number)
+            await track_read_state(username, room_number, state)
+            await invalidate_metadata(('rooms', room_number), ('user_rooms', username), ('room_users', room_number))
+            logger.info(f"用户 {username} 成功创建并加入新房间 {room_number}")
             return web.json_response({"success": True, "roomNumber": room_number, "roomName": room_name})
 
     except Exception as e:
-        print(f"{format_time()} 添加房间时发生错误：{str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"添加房间时发生错误：{str(e)}")
         return web.json_response({"success": False, "message": f"添加房间失败：{str(e)}"})
 
 
@@ -147,13 +2204,7 @@ async def check_session(request):
     session = await get_session(request)
     username = session.get('username')
     if username:
-        rooms = await meta_db.execute("""
-            SELECT r.room_number, r.room_name 
-            FROM user_rooms ur
-            JOIN rooms r ON ur.room_number = r.room_number
-            WHERE ur.username = ?
-        """, (username,))
-        room_list = [{"roomNumber": row[0], "roomName": row[1]} for row in rooms]
+        room_list = await user_room_list(username)
         return web.json_response({
             "success": True, 
             "username": username,
@@ -172,16 +2223,16 @@ async def get_room_name(request):
     data = await request.json()
     room_number = data.get('roomNumber')
     if room_number:
-        room_name_result = await meta_db.execute("SELECT room_name FROM rooms WHERE room_number = ?",
-                                                 (room_number,))
-        if room_name_result:
-            room_name = room_name_result[0][0]
+        room = await metadata_cache.get_room(room_number)
+        if room:
+            room_name = room[0]
             return web.json_response({"success": True, "roomName": room_name})
     return web.json_response({"success": False, "message": "房间不存在"})
 
 async def websocket_handler(request):
-    ws = web.WebSocketResponse()
+    ws = web.WebSocketResponse(heartbeat=WS_HEARTBEAT)
     await ws.prepare(request)
+    outboxes[ws] = Outbox(ws)
 
     username = None
     room_number = None
@@ -189,38 +2240,40 @@ async def websocket_handler(request):
     try:
         async for msg in ws:
             if msg.type == web.WSMsgType.TEXT:
+                received_at = time.perf_counter()
                 try:
                     data = json.loads(msg.data)
 
                     if data.get('type') == 'connect':
                         username = data.get('username')
                         room_number = data.get('roomNumber')
+                        if not isinstance(username, str) or not isinstance(room_number, str):
+                            username = room_number = None
+                        try:
+                            since = int(data['since']) if data.get('since') is not None else None
+                        except (TypeError, ValueError):
+                            since = None
                         if username and room_number:
-                            connected[(username, room_number)] = ws
-                            online_users.add((username, room_number))
-                            user_last_online[username] = time.time()
-                            print(f"{format_time()} 用户：{username}，连接到房间：{room_number}")
-                            await broadcast_user_list(room_number)
-                            await data_db.execute(f"CREATE TABLE IF NOT EXISTS chat_{room_number} "
-                                                  "(id INTEGER PRIMARY KEY, sender TEXT, message TEXT, image TEXT, audio TEXT, file_name TEXT, timestamp REAL)")
-
-                            history_records = await data_db.execute(
-                                f"SELECT sender, message, image, audio, file_name, timestamp FROM chat_{room_number} ORDER BY timestamp ASC")
-                            for record in history_records:
-                                history_message = {
-                                    'sender': record[0],
-                                    'message': record[1],
-                                    'image': record[2],
-                                    'audio': record[3],
-                                    'fileName': record[4],
-                                    'timestamp': record[5],
-                                    'type': 'history'
-                                }
-                                await ws.send_json(history_message)
+                            room_sockets.setdefault(room_number, set()).add(ws)
+                            joined = presence.join(room_number, username)
+                            await backplane.publish('join', room_number, username)
+                            logger.info(f"用户：{username}，连接到房间：{room_number}")
+                            await ws.send_json({
+                                'type': 'user_count',
+                                'onlineCount': presence.online_count(room_number)
+                            })
+                            if joined:
+                                await broadcast_presence(room_number, username, 'join')
+
+                            await ws.send_str(await recent_messages.history_frame(room_number, since))
                         continue
                         
                     
                     if data.get('type') == 'get_user_list':
+                        if not rate_limiter.allow('user_list', username, room_number):
+                            await ws.send_json({'type': 'rate_limited', 'kind': 'user_list',
+                                                'message': '刷新太频繁，请稍后再试'})
+                            continue
                         users = await get_room_users(room_number)
                         online_count = sum(1 for user in users if user['is_online'])
                         await ws.send_json({
@@ -231,17 +2284,69 @@ async def websocket_handler(request):
                         continue
 
                     if not username or not room_number:
-                        print("错误：未定义用户名或房间号的消息")
+                        logger.warning("未定义用户名或房间号的消息")
+                        continue
+
+                    if data.get('type') == 'read':
+                        try:
+                            message_id = int(data.get('id'))
+                        except (TypeError, ValueError):
+                            continue
+                        if rate_limiter.allow('read', username, room_number):
+                            await mark_read(username, room_number, message_id)
+                        continue
+
+                    if data.get('type') == 'load_history':
+                        # 无论成功与否都要回复，否则客户端会一直处于加载状态
+                        page = {'type': 'history_page'}
+                        try:
+                            page['messages'], page['hasMore'] = await fetch_history(
+                                room_number, data.get('before'), data.get('limit'))
+                        except Exception as e:
+                            logger.error(f"读取房间 {room_number} 的历史记录失败: {str(e)}")
+                            page.update(messages=[], hasMore=True, message='加载历史记录失败，请稍后重试')
+                        await ws.send_json(page)
+                        continue
+
+                    if data.get('type') == 'search':
+                        query = (data.get('query') or '').strip()
+                        if data.get('scope') == 'all':
+                            room_numbers = [room['roomNumber'] for room in await metadata_cache.get_user_rooms(username)]
+                        else:
+                            room_numbers = [room_number]
+                        results, has_more = [], False
+                        if query:
+                            results, has_more = await search_messages(room_numbers, query,
+                                                                      data.get('limit'), data.get('offset'))
+                        await ws.send_json({
+                            'type': 'search_results',
+                            'query': query,
+                            'results': results,
+                            'hasMore': has_more
+                        })
                         continue
 
                     timestamp = time.time()
                     message_type = data.get('type')
 
+                    if 'chunkIndex' in data and 'chunkTotal' in data:
+                        await rate_limiter.wait('chunk', username, room_number)
+                    elif message_type not in ('transfer_end', 'transfer_abort') and \
+                            not rate_limiter.allow('message', username, room_number):
+                        if message_type == 'transfer_start':
+                            await ws.send_json({'type': 'transfer_error', 'transferId': data.get('transferId'),
+                                                'message': '发送太频繁，请稍后再试'})
+                        else:
+                            await ws.send_json({'type': 'rate_limited', 'kind': 'message',
+                                                'message': '发送太频繁，请稍后再试'})
+                        continue
+
                     if message_type == 'update_room_name':
                         new_name = data.get('newName')
                         if new_name:
                             await meta_db.execute("UPDATE rooms SET room_name = ? WHERE room_number = ?",
                                                   (new_name, room_number))
+                            await invalidate_metadata(('rooms', room_number))
                             await broadcast(json.dumps({
                                 'type': 'room_name_updated',
                                 'roomNumber': room_number,
@@ -249,97 +2354,258 @@ async def websocket_handler(request):
                             }), room_number)
                         continue
 
-                    if 'chunkIndex' in data and 'chunkTotal' in data:
-                        chunk_index = data['chunkIndex']
-                        chunk_total = data['chunkTotal']
-                        if username not in message_fragments:
-                            message_fragments[username] = {}
-                        if message_type not in message_fragments[username]:
-                            message_fragments[username][message_type] = [None] * chunk_total
-                        message_fragments[username][message_type][chunk_index] = data[message_type]
-                        if None not in message_fragments[username][message_type]:
-                            full_message = ''.join(message_fragments[username][message_type])
-                            timestamp = time.time()
-                            await data_db.execute(
-                                f"INSERT INTO chat_{room_number} (sender, message, image, audio, timestamp) VALUES (?, ?, ?, ?, ?)",
-                                (username,
-                                 full_message if message_type == 'text' else None,
-                                 full_message if message_type == 'image' else None,
-                                 full_message if message_type == 'audio' else None,
-                                 timestamp))
-
-                            print(
-                                f"{format_time()} 用户：{username}，发送了{'图片' if message_type == 'image' else '语音'}")
+                    if message_type == 'transfer_start':
+                        transfer_id = data.get('transferId')
+                        try:
+                            await transfer_manager.begin(ws, transfer_id, username, room_number, data.get('kind'),
+                                                         data.get('mimeType'), data.get('size'))
+                        except TransferError as e:
+                            upload_errors.inc()
+                            await ws.send_json({'type': 'transfer_error', 'transferId': transfer_id, 'message': str(e)})
+                        continue
 
-                            await broadcast(json.dumps({
-                                'sender': username,
-                                message_type: full_message,
-                                'timestamp': timestamp,
-                                'type': message_type
-                            }), room_number)
+                    if message_type == 'transfer_end':
+                        transfer_id = data.get('transferId')
+                        try:
+                            transfer, reference = await transfer_manager.finish(ws, transfer_id)
+                        except TransferError as e:
+                            upload_errors.inc()
+                            await ws.send_json({'type': 'transfer_error', 'transferId': transfer_id, 'message': str(e)})
+                            continue
+                        uploads.inc(label_value=transfer.kind)
+                        upload_bytes.inc(transfer.size, transfer.kind)
+                        await publish_media(transfer.username, transfer.room_number, transfer.kind, reference, received_at)
+                        continue
+
+                    if message_type == 'transfer_abort':
+                        await transfer_manager.abort(ws, data.get('transferId'))
+                        continue
 
-                            del message_fragments[username][message_type]
+                    if 'chunkIndex' in data and 'chunkTotal' in data:
+                        try:
+                            completed = await transfer_manager.write_legacy(
+                                ws, username, room_number, message_type, data['chunkIndex'], data['chunkTotal'],
+                                data.get(message_type))
+                        except TransferError as e:
+                            upload_errors.inc()
+                            await ws.send_json({'type': 'transfer_error', 'message': str(e)})
+                            continue
+                        if completed is not None:
+                            transfer, reference = completed
+                            uploads.inc(label_value=transfer.kind)
+                            upload_bytes.inc(transfer.received, transfer.kind)
+                            await publish_media(username, room_number, message_type, reference, received_at)
+                        continue
 
                     if message_type == 'file':
                         file_name = data.get('fileName')
-                        await data_db.execute(
-                            f"INSERT INTO chat_{room_number} (sender, file_name, timestamp) VALUES (?, ?, ?)",
-                            (username, file_name, timestamp))
+                        if not isinstance(file_name, str):
+                            logger.warning(f"用户：{username} 发送的文件名格式错误")
+                            continue
+                        message_id = await message_writer.enqueue(room_number, username, timestamp, file_name=file_name)
 
-                        print(f"{format_time()} 用户：{username}，发送了文件 {file_name}")
+                        log_message_event("用户：%s，发送了文件 %s", username, file_name)
 
                         await broadcast(json.dumps({
+                            'id': message_id,
                             'sender': username,
                             'fileName': file_name,
                             'timestamp': timestamp,
                             'type': 'file'
-                        }), room_number)
+                        }), room_number, message_id, username)
+                        messages_received.inc(label_value='file')
+                        message_ingest_seconds.observe(time.perf_counter() - received_at)
                     else:
                         message = data.get('message')
-                        await data_db.execute(
-                            f"INSERT INTO chat_{room_number} (sender, message, timestamp) VALUES (?, ?, ?)",
-                            (username, message, timestamp))
+                        if message is not None and not isinstance(message, str):
+                            logger.warning(f"用户：{username} 发送的消息格式错误")
+                            continue
+                        message_id = await message_writer.enqueue(room_number, username, timestamp, message=message)
 
-                        print(f"{format_time()} 用户：{username}，发送了消息：{message}")
+                        log_message_event("用户：%s，发送了消息：%.50s", username, message)
 
                         await broadcast(json.dumps({
+                            'id': message_id,
                             'sender': username,
                             'message': message,
                             'timestamp': timestamp,
                             'type': message_type
-                        }), room_number)
+                        }), room_number, message_id, username)
+                        messages_received.inc(label_value=message_type)
+                        message_ingest_seconds.observe(time.perf_counter() - received_at)
 
                 except json.JSONDecodeError:
-                    print(f"Error decoding JSON: {msg.data}")
+                    logger.warning(f"无法解析的消息：{msg.data[:200]}")
                 except Exception as e:
-                    print(f"Error processing message: {str(e)}")
+                    logger.exception(f"处理消息时发生错误: {str(e)}")
+            elif msg.type == web.WSMsgType.BINARY:
+                await rate_limiter.wait('chunk', username, room_number)
+                try:
+                    await transfer_manager.write(ws, msg.data)
+                except TransferError as e:
+                    upload_errors.inc()
+                    await ws.send_json({'type': 'transfer_error', 'message': str(e)})
             elif msg.type == web.WSMsgType.ERROR:
-                print(f"WebSocket连接关闭，错误：{ws.exception()}")
+                logger.warning(f"WebSocket连接关闭，错误：{ws.exception()}")
 
     finally:
+        outboxes.pop(ws).close()
+        if isinstance(ws.exception(), asyncio.TimeoutError):
+            ws_reaped.inc()
+        await transfer_manager.abort(ws)
         if username and room_number:
-            if (username, room_number) in connected:
-                del connected[(username, room_number)]
-            if (username, room_number) in online_users:
-                online_users.remove((username, room_number))
-            user_last_online[username] = time.time()
-            print(f"{format_time()} 用户断开连接：{username}，房间号：{room_number}")
-            await broadcast_user_list(room_number)
+            discard_from_room(room_sockets, room_number, ws)
+            left = presence.leave(room_number, username)
+            await backplane.publish('leave', room_number, username)
+            logger.info(f"用户断开连接：{username}，房间号：{room_number}")
+            if left:
+                await broadcast_presence(room_number, username, 'leave')
 
     return ws
 
+async def publish_media(username, room_number, message_type, content, received_at):
+    timestamp = time.time()
+    message_id = await message_writer.enqueue(
+        room_number, username, timestamp,
+        message=content if message_type == 'text' else None,
+        image=content if message_type == 'image' else None,
+        audio=content if message_type == 'audio' else None)
+
+    log_message_event("用户：%s，发送了%s", username, '图片' if message_type == 'image' else '语音')
+
+    message = {
+        'id': message_id,
+        'sender': username,
+        message_type: content,
+        'preview': None,
+        'timestamp': timestamp,
+        'type': message_type
+    }
+    await broadcast(json.dumps(message), room_number, message_id, username)
+    if message_type == 'image':
+        thumbnailer.attach(content, lambda preview: attach_preview(room_number, message, preview))
+    messages_received.inc(label_value=message_type)
+    message_ingest_seconds.observe(time.perf_counter() - received_at)
+
+async def attach_preview(room_number, message, preview):
+    # 缩略图生成后补写到消息记录和各进程的最近消息缓存，之后加载历史记录时使用缩略图
+    await message_writer.flush()
+    await data_db.execute("UPDATE messages SET preview = ? WHERE room_number = ? AND id = ?",
+                          (preview, room_number, message['id']))
+    encoded = json.dumps({**message, 'preview': preview})
+    recent_messages.replace(room_number, message['id'], encoded)
+    await backplane.publish('preview', room_number, encoded, message['id'])
+    await deliver(preview_frame(room_number, message['id'], preview), room_number)
+
+def preview_frame(room_number, message_id, preview):
+    # 已经显示原图的客户端收到后换成缩略图
+    return json.dumps({'type': 'preview', 'roomNumber': room_number, 'id': message_id, 'preview': preview})
+
+async def fetch_history(room_number, before_id=None, limit=None):
+    try:
+        limit = min(max(int(limit), 1), HISTORY_PAGE_MAX)
+    except (TypeError, ValueError):
+        limit = HISTORY_PAGE_SIZE
+    if before_id is not None:
+        try:
+            before_id = int(before_id)
+        except (TypeError, ValueError, OverflowError):
+            return [], False
+        if before_id <= 1:
+            return [], False
+        before_id = min(before_id, SQLITE_MAX_INTEGER)
+
+    with history_load_seconds.time():
+        await message_writer.flush()
+        if before_id is None:
+            records = await data_db.execute(
+                "SELECT id, sender, message, image, audio, file_name, timestamp, preview FROM messages "
+                "WHERE room_number = ? ORDER BY id DESC LIMIT ?", (room_number, limit + 1))
+        else:
+            records = await data_db.execute(
+                "SELECT id, sender, message, image, audio, file_name, timestamp, preview FROM messages "
+                "WHERE room_number = ? AND id < ? ORDER BY id DESC LIMIT ?", (room_number, before_id, limit + 1))
+
+    has_more = len(records) > limit
+    messages = [{
+        'id': record[0],
+        'sender': record[1],
+        'message': record[2],
+        'image': record[3],
+        'audio': record[4],
+        'fileName': record[5],
+        'timestamp': record[6],
+        'preview': record[7]
+    } for record in reversed(records[:limit])]
+    return messages, has_more
+
+async def mark_read(username, room_number, message_id):
+    state = unread_counter.mark_read(username, room_number, message_id,
+                                     recent_messages.count_after(room_number, message_id))
+    if state is not None:
+        await backplane.publish('read', room_number, [username, *state])
+
+def highlight_snippet(text, query, context=SEARCH_SNIPPET_TOKENS // 2):
+    # 与snippet()的格式一致：截取第一处匹配前后的文字，匹配部分用<mark>标出
+    match = re.search(re.escape(query), text, re.IGNORECASE)
+    if match is None:
+        return text[:context * 2] + ('…' if len(text) > context * 2 else '')
+    start = max(match.start() - context, 0)
+    end = min(match.end() + context, len(text))
+    return (('…' if start else '') + text[start:match.start()] + '<mark>' + match.group(0) + '</mark>'
+            + text[match.end():end] + ('…' if end < len(text) else ''))
+
+async def search_messages(room_numbers, query, limit=None, offset=None):
+    try:
+        limit = min(max(int(limit), 1), SEARCH_PAGE_MAX)
+    except (TypeError, ValueError):
+        limit = SEARCH_PAGE_SIZE
+    try:
+        offset = max(int(offset), 0)
+    except (TypeError, ValueError):
+        offset = 0
+    if not room_numbers:
+        return [], False
+
+    await message_writer.flush()
+    placeholders = ', '.join('?' * len(room_numbers))
+    if len(query) >= SEARCH_MIN_QUERY_LENGTH:
+        records = await data_db.execute(
+            "SELECT m.room_number, m.id, m.sender, m.timestamp, "
+            f"snippet(messages_fts, 0, '<mark>', '</mark>', '…', {SEARCH_SNIPPET_TOKENS}) "
+            "FROM messages_fts JOIN messages m ON m.seq = messages_fts.rowid "
+            f"WHERE messages_fts MATCH ? AND m.room_number IN ({placeholders}) "
+            "ORDER BY rank LIMIT ? OFFSET ?",
+            ('"' + query.replace('"', '""') + '"', *room_numbers, limit + 1, offset))
+    else:
+        # 短查询按时间倒序返回，messages_chars按rowid倒序读取，不需要排序
+        records = await data_db.execute(
+            "SELECT m.room_number, m.id, m.sender, m.timestamp, m.message "
+            "FROM messages_chars JOIN messages m ON m.seq = messages_chars.rowid "
+            f"WHERE messages_chars MATCH ? AND m.room_number IN ({placeholders}) "
+            "ORDER BY messages_chars.rowid DESC LIMIT ? OFFSET ?",
+            ('"' + search_chars(query).replace('"', '""') + '"', *room_numbers, limit + 1, offset))
+        records = [(*record[:4], highlight_snippet(record[4], query)) for record in records]
+
+    has_more = len(records) > limit
+    results = [{
+        'roomNumber': record[0],
+        'id': record[1],
+        'sender': record[2],
+        'timestamp': record[3],
+        'snippet': record[4]
+    } for record in records[:limit]]
+    return results, has_more
+
 async def get_room_users(room_number):
     users = []
     current_time = time.time()
     
-    room_users = await meta_db.execute(
-        "SELECT username FROM user_rooms WHERE room_number = ?", (room_number,)
-    )
+    room_users = await metadata_cache.get_room_users(room_number)
     
-    for user in room_users:
-        username = user[0]
-        is_online = (username, room_number) in online_users
-        last_online = user_last_online.get(username, 0)
+    for username in room_users:
+        is_online = presence.is_online(room_number, username)
+        last_online = presence.last_seen.get(username, 0)
         
         if is_online:
             status = "在线"
@@ -362,43 +2628,154 @@ async def get_room_users(room_number):
     
     return users
 
-async def broadcast_user_list(room_number):
-    online_count = sum(1 for (user, room) in online_users if room == room_number)
-    user_list = {
-        'type': 'user_count',
-        'onlineCount': online_count
-    }
-    await broadcast(json.dumps(user_list), room_number)
-
-async def broadcast(message, room_number):
-    for (user, room), user_ws in connected.items():
-        if room == room_number and not user_ws.closed:
-            await user_ws.send_str(message)
-
-async def handle_upload(request):
-    reader = await request.multipart()
-
-    field = await reader.next()
-    assert field.name == 'file'
-
-    filename = field.filename
-    size = 0
-
-    upload_path = os.path.join('uploads', filename)
-    os.makedirs(os.path.dirname(upload_path), exist_ok=True)
+def discard_from_room(registry, room_number, item):
+    members = registry.get(room_number)
+    if members is not None:
+        members.discard(item)
+        if not members:
+            del registry[room_number]
+
+async def handle_backplane_message(kind, room_number, payload, message_id):
+    if kind == 'room':
+        if message_id is not None:
+            message_writer.observe_id(room_number, message_id)
+            unread_counter.observe(room_number, message_id)
+            recent_messages.append(room_number, message_id, payload)
+        await deliver(payload, room_number)
+    elif kind == 'join':
+        presence.join(room_number, payload, persist=False)
+    elif kind == 'leave':
+        presence.leave(room_number, payload, persist=False)
+    elif kind == 'preview':
+        recent_messages.replace(room_number, message_id, payload)
+        await deliver(preview_frame(room_number, message_id, json.loads(payload)['preview']), room_number)
+    elif kind == 'read':
+        unread_counter.apply(payload[0], room_number, payload[1], payload[2])
+    elif kind == 'discard':
+        unread_counter.discard(room_number, len(payload))
+        recent_messages.discard(room_number, set(payload))
+    elif kind == 'expire':
+        unread_counter.expire(room_number, len(payload))
+        recent_messages.expire(room_number, set(payload))
+    elif kind == 'invalidate':
+        metadata_cache.invalidate(*payload)
+
+async def expire_messages(keys):
+    expired = {}
+    for room_number, message_id in keys:
+        expired.setdefault(room_number, []).append(message_id)
+    for room_number, message_ids in expired.items():
+        unread_counter.expire(room_number, len(message_ids))
+        recent_messages.expire(room_number, set(message_ids))
+        await backplane.publish('expire', room_number, message_ids)
+
+async def discard_messages(keys):
+    discarded = {}
+    for room_number, message_id in keys:
+        discarded.setdefault(room_number, []).append(message_id)
+    for room_number, message_ids in discarded.items():
+        unread_counter.discard(room_number, len(message_ids))
+        recent_messages.discard(room_number, set(message_ids))
+        await backplane.publish('discard', room_number, message_ids)
+
+async def broadcast_presence(room_number, username, event):
+    await broadcast(json.dumps({
+        'type': 'presence',
+        'event': event,
+        'username': username,
+        'onlineCount': presence.online_count(room_number)
+    }), room_number)
+
+async def broadcast(message, room_number, message_id=None, sender=None):
+    state = None
+    if message_id is not None:
+        state = unread_counter.observe(room_number, message_id, sender)
+        recent_messages.append(room_number, message_id, message)
+    await backplane.publish('room', room_number, message, message_id)
+    if state is not None:
+        await backplane.publish('read', room_number, [sender, *state])
+    await deliver(message, room_number)
+
+async def deliver(message, room_number):
+    sockets = [user_ws for user_ws in room_sockets.get(room_number, ()) if not user_ws.closed]
+    if not sockets:
+        return
+    frame = message.encode('utf-8')
+    with broadcast_seconds.time():
+        for user_ws in sockets:
+            outbox = outboxes.get(user_ws)
+            if outbox is not None:
+                outbox.put(frame)
+    broadcast_frames.inc(len(sockets))
+    # 让出一次事件循环，发送任务得以及时清空队列，不会被连续到达的消息饿死
+    await asyncio.sleep(0)
+
+async def session_username(request):
+    session = await get_session(request)
+    return session.get('username')
+
+def upload_error_response(error):
+    upload_errors.inc()
+    body = {'status': 'error', 'message': str(error)}
+    if error.offset is not None:
+        body['offset'] = error.offset
+    return web.json_response(body, status=error.status)
+
+async def create_upload(request):
+    username = await session_username(request)
+    if not username:
+        return web.json_response({'status': 'error', 'message': '请先登录'}, status=401)
+    try:
+        data = await request.json()
+    except ValueError:
+        return web.json_response({'status': 'error', 'message': '无效的请求'}, status=400)
+    try:
+        upload_id = await upload_store.create(username, data.get('fileName'), data.get('size'))
+    except UploadError as e:
+        return upload_error_response(e)
+    return web.json_response({'status': 'success', 'uploadId': upload_id, 'offset': 0}, status=201)
 
-    with open(upload_path, 'wb') as f:
-        while True:
-            chunk = await field.read_chunk()
-            if not chunk:
-                break
-            size += len(chunk)
-            f.write(chunk)
+async def upload_status(request):
+    username = await session_username(request)
+    try:
+        meta = await upload_store.status(request.match_info['upload_id'], username)
+    except UploadError as e:
+        return upload_error_response(e)
+    return web.json_response({'status': 'success', 'offset': meta['offset'], 'size': meta['size']},
+                             headers={'Cache-Control': 'no-store'})
+
+async def append_upload(request):
+    username = await session_username(request)
+    try:
+        offset = int(request.headers.get('Upload-Offset', ''))
+    except ValueError:
+        return web.json_response({'status': 'error', 'message': '缺少Upload-Offset'}, status=400)
+    try:
+        offset = await upload_store.append(request.match_info['upload_id'], username, offset, request.content)
+    except UploadError as e:
+        return upload_error_response(e)
+    return web.json_response({'status': 'success', 'offset': offset})
 
-    return web.json_response({'status': 'success', 'filename': filename, 'size': size})
+async def finalize_upload(request):
+    username = await session_username(request)
+    try:
+        file_name, size = await upload_store.finalize(request.match_info['upload_id'], username)
+    except UploadError as e:
+        return upload_error_response(e)
+    uploads.inc(label_value='file')
+    upload_bytes.inc(size, 'file')
+    return web.json_response({'status': 'success', 'filename': file_name, 'size': size})
+
+async def abort_upload(request):
+    username = await session_username(request)
+    try:
+        await upload_store.abort(request.match_info['upload_id'], username)
+    except UploadError as e:
+        return upload_error_response(e)
+    return web.json_response({'status': 'success'})
 
 async def init_db():
-    async with aiosqlite.connect(DB_PATH_META) as db:
+    async with meta_db.transaction() as db:
         await db.execute('''
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -421,6 +2798,12 @@ async def init_db():
         );
         ''')
         await db.execute('''
+        CREATE TABLE IF NOT EXISTS user_presence (
+            username TEXT PRIMARY KEY,
+            last_seen REAL
+        );
+        ''')
+        await db.execute('''
         CREATE TABLE IF NOT EXISTS user_rooms (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             username TEXT,
@@ -428,66 +2811,271 @@ async def init_db():
             UNIQUE(username, room_number)
         );
         ''')
-        await db.commit()
 
         room_check = await db.execute("SELECT 1 FROM rooms WHERE room_number = '1'")
         if not await room_check.fetchone():
             await db.execute("INSERT INTO rooms (room_number, room_name, room_password) VALUES ('1', '公共聊天室', '')")
-            await db.commit()
+
+async def migrate_db(database, migrations):
+    while True:
+        async with database.transaction() as db:
+            if not db.in_transaction:
+                await db.execute("BEGIN IMMEDIATE")
+            # 在写锁内重新读取版本，避免多个工作进程同时执行同一次迁移
+            async with db.execute("PRAGMA user_version") as cursor:
+                version = (await cursor.fetchone())[0]
+            if version >= len(migrations):
+                return
+            for statement in migrations[version]:
+                await db.execute(statement)
+            await db.execute(f"PRAGMA user_version = {version + 1}")
+        logger.info(f"{database.db_path} 已升级到版本 {version + 1}")
+
+async def migrate_legacy_tables(database):
+    # 旧版本每个房间一张chat_<房间号>表，必须在分配消息id之前合并进messages表，否则新消息会占用旧消息的id
+    tables = await database.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'chat\\_%' ESCAPE '\\'")
+    for (table,) in tables:
+        room_number = table[len('chat_'):]
+        async with database.transaction() as db:
+            if not db.in_transaction:
+                await db.execute("BEGIN IMMEDIATE")
+            async with db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)) as cursor:
+                if await cursor.fetchone() is None:
+                    # 其他工作进程已经迁移过
+                    continue
+            async with db.execute(f'SELECT COUNT(*) FROM "{table}"') as cursor:
+                total = (await cursor.fetchone())[0]
+            cursor = await db.execute(
+                "INSERT OR IGNORE INTO messages (room_number, id, sender, message, image, audio, file_name, timestamp) "
+                f'SELECT ?, id, sender, message, image, audio, file_name, timestamp FROM "{table}" ORDER BY id',
+                (room_number,))
+            copied = cursor.rowcount
+            if copied != total:
+                # 抛出异常回滚整个事务，旧表原样保留
+                raise RuntimeError(f"房间 {room_number} 有 {total - copied} 条旧消息的id与messages表中的消息冲突，"
+                                   f"已保留 {table} 表，请处理冲突后重新启动")
+            await db.execute(f'DROP TABLE "{table}"')
+        logger.info(f"已迁移房间 {room_number} 的 {copied} 条消息")
+
+async def migrate_data_db():
+    await data_db.connect()
+    await migrate_db(data_db, DATA_MIGRATIONS)
+    await migrate_legacy_tables(data_db)
+    await data_db.close()
+
+async def rebuild_search_index():
+    await migrate_data_db()
+    await data_db.connect()
+    await data_db.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+    await data_db.execute("INSERT INTO messages_fts (messages_fts) VALUES ('optimize')")
+    await data_db.execute("INSERT INTO messages_chars (messages_chars) VALUES ('delete-all')")
+    await data_db.execute(MESSAGES_CHARS_FILL)
+    await data_db.execute("INSERT INTO messages_chars (messages_chars) VALUES ('optimize')")
+    count = (await data_db.execute("SELECT COUNT(*) FROM messages WHERE message IS NOT NULL"))[0][0]
+    logger.info(f"已为 {count} 条文字消息建立搜索索引")
+    await data_db.close()
+
+async def close_db(app):
+    await backplane.close()
+    await transfer_manager.close()
+    await thumbnailer.close()
+    await upload_store.close()
+    await message_writer.close()
+    await retention_worker.close()
+    await presence.close()
+    await unread_counter.close()
+    await meta_db.close()
+    await data_db.close()
 
 async def get_user_rooms(request):
     data = await request.json()
     username = data.get('username')
 
     try:
-        rooms = await meta_db.execute("""
-            SELECT r.room_number, r.room_name 
-            FROM user_rooms ur
-            JOIN rooms r ON ur.room_number = r.room_number
-            WHERE ur.username = ?
-        """, (username,))
-        room_list = [{"roomNumber": row[0], "roomName": row[1]} for row in rooms]
+        room_list = await user_room_list(username)
         return web.json_response({"success": True, "rooms": room_list})
     except Exception as e:
-        print(f"获取用户房间列表失败: {str(e)}")
+        logger.error(f"获取用户房间列表失败: {str(e)}")
         return web.json_response({"success": False, "message": "获取用户房间列表失败"})
 
 async def download_file(request):
-    file_name = request.match_info['file_name']
-    file_path = os.path.join('uploads', file_name)
-    if os.path.exists(file_path):
-        return web.FileResponse(file_path)
-    else:
+    file_path = upload_store.resolve(request.match_info['file_name'])
+    if file_path is None or not await asyncio.to_thread(os.path.isfile, file_path):
         return web.Response(status=404, text="File not found")
+    file_name = urllib.parse.quote(os.path.basename(file_path))
+    return web.FileResponse(file_path, headers={'Content-Disposition': f"attachment; filename*=UTF-8''{file_name}"})
+
+async def download_blob(request):
+    blob_path = blob_store.resolve(request.match_info['blob_name'])
+    if blob_path is None or not await asyncio.to_thread(os.path.isfile, blob_path):
+        return web.Response(status=404, text="File not found")
+    content_type = blob_store.content_type(blob_path)
+    headers = {'Cache-Control': BLOB_CACHE_CONTROL, 'Content-Type': content_type, **BLOB_SECURITY_HEADERS}
+    if content_type == 'application/octet-stream':
+        headers['Content-Disposition'] = 'attachment'
+    return web.FileResponse(blob_path, headers=headers)
+
+def metrics_allowed(remote):
+    try:
+        address = ipaddress.ip_address(remote)
+    except ValueError:
+        return False
+    address = getattr(address, 'ipv4_mapped', None) or address
+    return any(address in ipaddress.ip_network(network) for network in METRICS_ALLOWED_NETWORKS)
+
+async def metrics_handler(request):
+    if not metrics_allowed(request.remote):
+        return web.Response(status=403, text="Forbidden")
+    return web.Response(body=metrics.render().encode('utf-8'),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+async def static_file(request):
+    name = request.match_info['name']
+    asset = static_assets.files.get(name)
+    if asset is None:
+        return web.Response(status=404, text="File not found")
+    # 带哈希的地址内容不会变化，原文件名每次都要验证ETag
+    return asset.response(request, STATIC_CACHE_CONTROL if name == asset.hashed_name else 'no-cache')
+
+async def favicon(request):
+    return static_assets.files['favicon.ico'].response(request, 'no-cache')
 
 async def index(request):
-    return web.FileResponse('./index.html')
+    return static_assets.index.response(request, 'no-cache')
+
+async def download_vendor_assets():
+    async with ClientSession(timeout=ClientTimeout(total=VENDOR_DOWNLOAD_TIMEOUT)) as session:
+        for name, url in VENDOR_ASSETS.items():
+            path = os.path.join(STATIC_DIR, name)
+            try:
+                async with session.get(url) as response:
+                    response.raise_for_status()
+                    body = await response.read()
+            except (ClientError, asyncio.TimeoutError) as e:
+                logger.error(f"下载 {url} 失败: {str(e)}")
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + '.tmp', 'wb') as file:
+                file.write(body)
+            os.replace(path + '.tmp', path)
+            logger.info(f"已下载 {name}（{len(body)} 字节）")
 
 async def init_app():
+    setup_logging()
+    await asyncio.to_thread(static_assets.load)
+    await meta_db.connect()
+    await data_db.connect()
     await init_db()
+    await migrate_db(meta_db, META_MIGRATIONS)
+    await migrate_db(data_db, DATA_MIGRATIONS)
+    await migrate_legacy_tables(data_db)
+    await retention_worker.start()
+    message_writer.start()
+    transfer_manager.start()
+    thumbnailer.start()
+    upload_store.start()
+    await presence.start()
+    await unread_counter.start()
+    await backplane.start(handle_backplane_message)
     app = web.Application()
+    app.on_cleanup.append(close_db)
     
-    secret_key = secrets.token_bytes(32)
+    secret_key = session_secret or secrets.token_bytes(32)
     setup(app, EncryptedCookieStorage(secret_key))
 
     app.router.add_get('/', index)
+    app.router.add_get(STATIC_URL_PREFIX + '{name:.+}', static_file)
+    app.router.add_get('/favicon.ico', favicon)
     app.add_routes([
-        web.static('/static', './static'),
-        web.static('/fonts', './fonts'),
-        web.static('/favicon.ico', './static', show_index=True)
+        web.static('/fonts', './fonts')
     ])
     app.router.add_post('/register', register)
     app.router.add_post('/login', login)
     app.router.add_post('/logout', logout)
     app.router.add_get('/check_session', check_session)
     app.router.add_get('/ws', websocket_handler)
-    app.router.add_get('/download/{file_name}', download_file)
-    app.router.add_post('/upload', handle_upload)
+    app.router.add_get('/download/{file_name:.+}', download_file)
+    app.router.add_get(BLOB_URL_PREFIX + '{blob_name}', download_blob)
+    app.router.add_post('/uploads', create_upload)
+    app.router.add_get('/uploads/{upload_id}', upload_status)
+    app.router.add_patch('/uploads/{upload_id}', append_upload)
+    app.router.add_delete('/uploads/{upload_id}', abort_upload)
+    app.router.add_post('/uploads/{upload_id}/complete', finalize_upload)
     app.router.add_post('/get_user_rooms', get_user_rooms)
     app.router.add_post('/add_room', add_room)
     app.router.add_post('/get_room_name', get_room_name)
+    app.router.add_get('/metrics', metrics_handler)
 
     return app
 
+def configure_worker(index, count, secret):
+    global backplane, session_secret
+    backplane = UnixSocketBackplane(BACKPLANE_SOCKET)
+    session_secret = secret
+    message_writer.id_offset = index
+    message_writer.id_stride = count
+    retention_worker.enabled = index == 0
+
+def run_worker(index, count, secret, port, log_level):
+    os.setpgrp()
+    setup_logging(log_level)
+    configure_worker(index, count, secret)
+    web.run_app(init_app(), port=port, reuse_port=True,
+                print=lambda message: logger.info(f"工作进程 {index}：{message}"))
+
+async def supervise(workers, port, log_level):
+    hub = BackplaneHub(BACKPLANE_SOCKET)
+    await hub.start()
+
+    secret = secrets.token_bytes(32)
+    context = multiprocessing.get_context('spawn')
+
+    def start_worker(index):
+        process = context.Process(target=run_worker, args=(index, workers, secret, port, log_level))
+        process.start()
+        return process
+
+    processes = [start_worker(index) for index in range(workers)]
+    logger.info(f"已启动 {workers} 个工作进程，端口 {port}")
+
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    try:
+        while True:
+            # 工作进程意外退出（例如与消息中转断开）时用原来的编号重新启动，消息id的分配不会重叠
+            await asyncio.to_thread(multiprocessing.connection.wait, [process.sentinel for process in processes])
+            await asyncio.sleep(WORKER_RESTART_DELAY)
+            for index, process in enumerate(processes):
+                if not process.is_alive():
+                    logger.warning(f"工作进程 {index} 已退出（退出码 {process.exitcode}），重新启动")
+                    processes[index] = start_worker(index)
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        await asyncio.gather(*(asyncio.to_thread(process.join) for process in processes))
+        await hub.close()
+
 if __name__ == '__main__':
-    web.run_app(init_app(), port=18080)
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--migrate', action='store_true')
+    parser.add_argument('--reindex', action='store_true')
+    parser.add_argument('--vendor', action='store_true')
+    parser.add_argument('--log-level', default=LOG_LEVEL, choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    args = parser.parse_args()
+    setup_logging(args.log_level)
+
+    if args.migrate:
+        asyncio.run(migrate_data_db())
+    elif args.reindex:
+        asyncio.run(rebuild_search_index())
+    elif args.vendor:
+        asyncio.run(download_vendor_assets())
+    elif args.workers > 1:
+        # SIGTERM会取消supervise，工作进程都已退出，正常结束
+        with contextlib.suppress(KeyboardInterrupt, asyncio.CancelledError):
+            asyncio.run(supervise(args.workers, args.port, args.log_level))
+    else:
+        web.run_app(init_app(), port=args.port)
\ No newline at end of file
@@ -1,6 +1,12 @@
 const STORAGE_KEY_USERNAME = 'chatApp_username';
 const STORAGE_KEY_ROOM = 'chatApp_room';
 const STORAGE_KEY_SESSION = 'chatApp_session';
+const HISTORY_PAGE_SIZE = 50;
+const BINARY_CHUNK_SIZE = 64 * 1024;
+const BINARY_MAX_BUFFERED = 1024 * 1024;
+const UPLOAD_CHUNK_SIZE = 1024 * 1024;
+const UPLOAD_MAX_RETRIES = 5;
+const READ_REPORT_DELAY = 1000;
 
 const chatApp = {
     socket: null,
@@ -12,6 +18,13 @@ const chatApp = {
     audioChunks: [],
     messageQueue: [],
     onlineUsers: [],
+    oldestMessageId: null,
+    newestMessageId: null,
+    reportedReadId: null,
+    readTimer: null,
+    hasMoreHistory: false,
+    loadingHistory: false,
+    transferSeq: 0,
     loadingIcon: '<i class="fas fa-spinner fa-spin"></i>',
     currentView: null
 };
@@ -28,30 +41,6 @@ const Toast = Swal.mixin({
   }
 });
 
-function loadTheme() {
-    const isDarkMode = window.matchMedia && window.matchMedia('(prefers-color-scheme: dark)').matches;
-    
-    if (isDarkMode) {
-        const link = document.createElement('link');
-        link.rel = 'stylesheet';
-        link.href = 'https://cdn.jsdelivr.net/npm/@sweetalert2/theme-dark/dark.css';
-        document.head.appendChild(link);
-    }
-}
-
-function listenForThemeChanges() {
-    window.matchMedia('(prefers-color-scheme: dark)').addEventListener('change', e => {
-        if (e.matches) {
-            loadTheme();
-        } else {
-            const darkStylesheet = document.querySelector('link[href$$="dark.css"]');
-            if (darkStylesheet) {
-                darkStylesheet.remove();
-            }
-        }
-    });
-}
-
 function showToast(message, icon = 'info') {
   Toast.fire({
     icon: icon,
@@ -60,15 +49,14 @@ function showToast(message, icon = 'info') {
 }
 
 document.addEventListener('DOMContentLoaded', initialize);
+document.addEventListener('visibilitychange', scheduleReadReport);
 
 function initialize() {
     const messageInput = getElementById('messageInput');
     const chatHeader = getElementById('onlineUsers');
     
-    loadTheme();
-    listenForThemeChanges();
-    
     chatHeader.addEventListener('click', showUserList);
+    getElementById('chatMessages').addEventListener('scroll', handleChatScroll);
     messageInput.addEventListener('keypress', handleEnterKey);
     adjustAudioContainers();
 
@@ -307,6 +295,12 @@ async function fetchRoomList() {
                 const roomDiv = document.createElement('div');
                 roomDiv.className = 'room-item';
                 roomDiv.innerText = room.roomName;
+                if (room.unread > 0) {
+                    const badge = document.createElement('span');
+                    badge.className = 'unread-badge';
+                    badge.innerText = room.unread > 99 ? '99+' : room.unread;
+                    roomDiv.appendChild(badge);
+                }
                 roomDiv.onclick = () => joinRoom(room.roomNumber);
                 roomsContainer.appendChild(roomDiv);
             });
@@ -444,10 +438,12 @@ function connectWebSocket() {
     chatApp.socket.onopen = () => {
         console.log('WebSocket 连接已建立');
         getRoomName(chatApp.currentRoom);
+        // 断线重连时只需要补齐最后一条消息之后的部分
         chatApp.socket.send(JSON.stringify({
             type: 'connect',
             username: chatApp.currentUser,
-            roomNumber: chatApp.currentRoom
+            roomNumber: chatApp.currentRoom,
+            since: chatApp.newestMessageId
         }));
     };
 
@@ -461,6 +457,10 @@ async function cleanupWebSocket() {
 
     if (chatApp.socket) {
         if (chatApp.socket.readyState === WebSocket.OPEN) {
+            if (chatApp.readTimer) {
+                clearTimeout(chatApp.readTimer);
+                sendReadPosition();
+            }
             console.log("关闭现有的 WebSocket 连接");
             chatApp.socket.close();
             await new Promise((resolve) => {
@@ -478,6 +478,13 @@ async function cleanupWebSocket() {
     chatApp.lastMessageTime = 0;
     chatApp.messageQueue = [];
     chatApp.onlineUsers = [];
+    chatApp.oldestMessageId = null;
+    chatApp.newestMessageId = null;
+    chatApp.reportedReadId = null;
+    clearTimeout(chatApp.readTimer);
+    chatApp.readTimer = null;
+    chatApp.hasMoreHistory = false;
+    chatApp.loadingHistory = false;
 
     console.log("WebSocket 清理完成");
 }
@@ -490,12 +497,45 @@ function handleSocketMessage(event) {
         case 'user_count':
             updateOnlineUsers(responseData.onlineCount);
             break;
+        case 'presence':
+            console.log(`用户 ${responseData.username} ${responseData.event === 'join' ? '上线' : '下线'}`);
+            updateOnlineUsers(responseData.onlineCount);
+            break;
         case 'user_list':
             updateUserList(responseData.users);
             updateOnlineUsers(responseData.onlineCount);
             break;
         case 'history':
-            loadHistoryMessages(Array.isArray(responseData) ? responseData : [responseData]);
+            if (responseData.since === undefined) {
+                getElementById('chatMessages').innerHTML = '';
+                chatApp.lastMessageTime = 0;
+                updateHistoryCursor(responseData);
+            }
+            loadHistoryMessages(responseData.messages);
+            if (responseData.messages.length > 0) {
+                markRead(responseData.messages[responseData.messages.length - 1].id);
+            }
+            scrollToBottom();
+            break;
+        case 'search_results':
+            showSearchResults(responseData);
+            break;
+        case 'transfer_error':
+            showToast('发送失败：' + responseData.message, 'error');
+            break;
+        case 'rate_limited':
+            showToast(responseData.message, 'warning');
+            break;
+        case 'preview':
+            showPreview(responseData);
+            break;
+        case 'history_page':
+            if (responseData.message) {
+                showToast(responseData.message, 'error');
+            }
+            prependHistoryMessages(responseData.messages);
+            updateHistoryCursor(responseData);
+            chatApp.loadingHistory = false;
             break;
         default:
             handleChunkedMessage(responseData);
@@ -535,31 +575,67 @@ function handleFileUpload(event) {
 }
 
 async function sendFile(file) {
-    const formData = new FormData();
-    formData.append('file', file);
-
     console.log('Uploading file:', file);
 
     try {
-        const response = await fetch('/upload', { method: 'POST', body: formData });
-        const responseData = await response.json();
-
-        if (responseData.status === 'success') {
-            chatApp.socket.send(JSON.stringify({
-                sender: chatApp.currentUser,
-                fileName: responseData.filename,
-                type: 'file',
-                roomNumber: chatApp.currentRoom
-            }));
-        } else {
-            console.error('File upload failed:', responseData.message);
+        const created = await uploadRequest('/uploads', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ fileName: file.name, size: file.size })
+        });
+        const uploadUrl = `/uploads/${created.uploadId}`;
+        let offset = created.offset;
+        let retries = 0;
+
+        while (offset < file.size) {
+            try {
+                const result = await uploadRequest(uploadUrl, {
+                    method: 'PATCH',
+                    headers: { 'Upload-Offset': String(offset), 'Content-Type': 'application/offset+octet-stream' },
+                    body: file.slice(offset, offset + UPLOAD_CHUNK_SIZE)
+                });
+                offset = result.offset;
+                retries = 0;
+            } catch (error) {
+                // 网络中断时向服务器查询已收到的偏移量，从断点继续上传
+                if ((error.status && error.status !== 409) || ++retries > UPLOAD_MAX_RETRIES) {
+                    throw error;
+                }
+                await new Promise(resolve => setTimeout(resolve, 1000 * retries));
+                offset = (await uploadRequest(uploadUrl)).offset;
+            }
         }
+
+        const responseData = await uploadRequest(`${uploadUrl}/complete`, { method: 'POST' });
+        chatApp.socket.send(JSON.stringify({
+            sender: chatApp.currentUser,
+            fileName: responseData.filename,
+            type: 'file',
+            roomNumber: chatApp.currentRoom
+        }));
     } catch (error) {
-        console.error('Error:', error);
+        console.error('File upload failed:', error);
+        showToast(`文件上传失败：${error.message}`, 'error');
+    }
+}
+
+async function uploadRequest(url, options = {}) {
+    const response = await fetch(url, options);
+    const data = await response.json();
+    if (!response.ok) {
+        const error = new Error(data.message);
+        error.status = response.status;
+        throw error;
     }
+    return data;
+}
+
+function fileLink(fileName, color) {
+    const href = '/download/' + fileName.split('/').map(encodeURIComponent).join('/');
+    return `<a href="${href}" style="color: ${color};" download>[ 文件 ] ${fileName.split('/').pop()}</a>`;
 }
 
-function displayMessage(data, isImmediate = false) {
+function displayMessage(data, isImmediate = false, container = getElementById('chatMessages')) {
     const messageDiv = document.createElement('div');
     messageDiv.className = `message ${data.sender === chatApp.currentUser ? 'sent' : 'received'}`;
 
@@ -570,7 +646,7 @@ function displayMessage(data, isImmediate = false) {
             year: 'numeric', month: 'long', day: 'numeric', hour: '2-digit', minute: '2-digit'
         });
         timeElement.style.textAlign = 'center';
-        getElementById('chatMessages').appendChild(timeElement);
+        container.appendChild(timeElement);
     }
 
     let contentHtml = '';
@@ -578,42 +654,155 @@ function displayMessage(data, isImmediate = false) {
         if (data.message) {
             contentHtml = `<div class="message-content">${data.message}</div>`;
         } else if (data.image) {
-            contentHtml = `<div class="message-content"><img src="${data.image}" style="max-width: 100%; border-radius: 8px;"></div>`;
+            contentHtml = `<div class="message-content">${imageHtml(data)}</div>`;
         } else if (data.audio) {
             contentHtml = `<div class="audioContainer"><audio src="${data.audio}" controls></audio></div>`;
         } else if (data.fileName) {
             console.log("FileName:", data.fileName);
-            contentHtml = `<div class="message-content"><a href="/download/${data.fileName}" style="color: white;" download>[ 文件 ] ${data.fileName}</a></div>`;
+            contentHtml = `<div class="message-content">${fileLink(data.fileName, 'white')}</div>`;
         }
     } else {
         if (data.message) {
             contentHtml = `<strong>${data.sender}:</strong><br><div class="message-content"> ${data.message}</div>`;
         } else if (data.image) {
-            contentHtml = `<strong>${data.sender}:</strong><br><div class="message-content"><img src="${data.image}" style="max-width: 100%; border-radius: 8px;"></div>`;
+            contentHtml = `<strong>${data.sender}:</strong><br><div class="message-content">${imageHtml(data)}</div>`;
         } else if (data.audio) {
             contentHtml = `<strong>${data.sender}:</strong><br><div class="audioContainer"><audio src="${data.audio}" controls></audio></div>`;
         } else if (data.fileName) {
             console.log("FileName:", data.fileName);
-            contentHtml = `<strong>${data.sender}:</strong><br><div class="message-content"><a href="/download/${data.fileName}" style="color: black;" download>[ 文件 ] ${data.fileName}</a></div>`;
+            contentHtml = `<strong>${data.sender}:</strong><br><div class="message-content">${fileLink(data.fileName, 'black')}</div>`;
         }
     }
 
     messageDiv.innerHTML = contentHtml;
-    getElementById('chatMessages').appendChild(messageDiv);
+    const image = messageDiv.querySelector('img[data-full]');
+    if (image) {
+        image.addEventListener('click', () => showFullImage(image.dataset.full));
+    }
+    container.appendChild(messageDiv);
     chatApp.lastMessageTime = data.timestamp;
 }
 
-function loadHistoryMessages(messages) {
+function imageHtml(data) {
+    // 有缩略图时列表中只加载缩略图，点击后再加载原图
+    const src = data.preview || data.image;
+    return `<img src="${src}" data-full="${data.image}" data-id="${data.id || ''}" loading="lazy" style="max-width: 100%; border-radius: 8px; cursor: pointer;">`;
+}
+
+function showPreview(data) {
+    // 缩略图在消息广播之后才生成，生成后替换已经显示的原图
+    if (String(data.roomNumber) !== String(chatApp.currentRoom)) {
+        return;
+    }
+    const image = getElementById('chatMessages').querySelector(`img[data-id="${data.id}"]`);
+    if (image) {
+        image.src = data.preview;
+    }
+}
+
+function showFullImage(url) {
+    Swal.fire({
+        imageUrl: url,
+        showConfirmButton: false,
+        showCloseButton: true,
+        heightAuto: false
+    });
+}
+
+function loadHistoryMessages(messages, container = getElementById('chatMessages')) {
     messages.forEach(message => {
         displayMessage({
+            id: message.id,
             sender: message.sender,
             message: message.message || '',
             image: message.image || '',
+            preview: message.preview || '',
             audio: message.audio || '',
             fileName: message.fileName || '',
             timestamp: message.timestamp,
             type: message.type
-        });
+        }, false, container);
+    });
+}
+
+function prependHistoryMessages(messages) {
+    const chatMessages = getElementById('chatMessages');
+    const fragment = document.createDocumentFragment();
+    const lastMessageTime = chatApp.lastMessageTime;
+    const previousHeight = chatMessages.scrollHeight;
+
+    chatApp.lastMessageTime = 0;
+    loadHistoryMessages(messages, fragment);
+    chatApp.lastMessageTime = lastMessageTime;
+
+    chatMessages.insertBefore(fragment, chatMessages.firstChild);
+    chatMessages.scrollTop += chatMessages.scrollHeight - previousHeight;
+}
+
+function updateHistoryCursor(responseData) {
+    if (responseData.messages.length > 0) {
+        chatApp.oldestMessageId = responseData.messages[0].id;
+    }
+    chatApp.hasMoreHistory = responseData.hasMore;
+}
+
+function loadOlderMessages() {
+    if (!chatApp.hasMoreHistory || chatApp.loadingHistory || chatApp.oldestMessageId === null) {
+        return;
+    }
+    if (chatApp.socket && chatApp.socket.readyState === WebSocket.OPEN) {
+        chatApp.loadingHistory = true;
+        chatApp.socket.send(JSON.stringify({
+            type: 'load_history',
+            before: chatApp.oldestMessageId,
+            limit: HISTORY_PAGE_SIZE
+        }));
+    }
+}
+
+function handleChatScroll(event) {
+    if (event.target.scrollTop < 50) {
+        loadOlderMessages();
+    }
+}
+
+function scrollToBottom() {
+    const chatMessages = getElementById('chatMessages');
+    chatMessages.scrollTop = chatMessages.scrollHeight;
+}
+
+async function searchMessages() {
+    const { value: query } = await Swal.fire({
+        title: '搜索聊天记录',
+        input: 'text',
+        inputPlaceholder: '请输入关键词',
+        showCancelButton: true,
+        confirmButtonText: '搜索',
+        cancelButtonText: '取消',
+        heightAuto: false
+    });
+
+    if (!query || !query.trim()) {
+        return;
+    }
+    if (chatApp.socket && chatApp.socket.readyState === WebSocket.OPEN) {
+        chatApp.socket.send(JSON.stringify({ type: 'search', query: query.trim(), scope: 'room' }));
+    } else {
+        showToast('无法搜索，请稍后再试', 'error');
+    }
+}
+
+function showSearchResults(responseData) {
+    const resultsHtml = responseData.results.map(result => {
+        const time = new Date(result.timestamp * 1000).toLocaleString();
+        return `<div style="text-align: left; width: 100%; margin-bottom: 10px;"><strong>${escapeHtml(result.sender)}</strong> <small>${time}</small><br>${snippetHtml(result.snippet)}</div>`;
+    }).join('') || '没有找到相关消息';
+
+    Swal.fire({
+        title: `“${escapeHtml(responseData.query)}”的搜索结果`,
+        html: resultsHtml,
+        confirmButtonText: '确定',
+        heightAuto: false
     });
 }
 
@@ -681,43 +870,46 @@ function stopRecording() {
     }
 }
 
-function sendAudio(base64Audio) {
-    sendChunkedData('audio', base64Audio);
-}
-
 function sendAudioMessage() {
     const audioBlob = new Blob(chatApp.audioChunks, { type: 'audio/webm' });
-    const reader = new FileReader();
-    reader.readAsDataURL(audioBlob);
-    reader.onloadend = () => sendAudio(reader.result);
+    sendBinaryData('audio', audioBlob);
     chatApp.audioChunks = [];
 }
 
 function handleImageUpload(event) {
     const file = event.target.files[0];
     if (file) {
-        const reader = new FileReader();
-        reader.onload = e => sendImage(e.target.result);
-        reader.readAsDataURL(file);
+        sendBinaryData('image', file);
     }
 }
 
-function sendChunkedData(type, data, chunkSize = 50000) {
-    const chunks = splitIntoChunks(data, chunkSize);
-    chunks.forEach((chunk, index) => {
-        chatApp.socket.send(JSON.stringify({
-            sender: chatApp.currentUser,
-            [type]: chunk,
-            chunkIndex: index,
-            chunkTotal: chunks.length,
-            type: type,
-            roomNumber: chatApp.currentRoom
-        }));
-    });
-}
+async function sendBinaryData(type, blob) {
+    const socket = chatApp.socket;
+    const transferId = ++chatApp.transferSeq;
+    socket.send(JSON.stringify({
+        type: 'transfer_start',
+        transferId: transferId,
+        kind: type,
+        mimeType: blob.type,
+        size: blob.size
+    }));
+
+    const buffer = await blob.arrayBuffer();
+    for (let offset = 0; offset < buffer.byteLength; offset += BINARY_CHUNK_SIZE) {
+        while (socket.bufferedAmount > BINARY_MAX_BUFFERED) {
+            await new Promise(resolve => setTimeout(resolve, 20));
+        }
+        if (socket.readyState !== WebSocket.OPEN) {
+            return;
+        }
+        const chunk = new Uint8Array(buffer, offset, Math.min(BINARY_CHUNK_SIZE, buffer.byteLength - offset));
+        const frame = new Uint8Array(4 + chunk.length);
+        new DataView(frame.buffer).setUint32(0, transferId);
+        frame.set(chunk, 4);
+        socket.send(frame);
+    }
 
-function sendImage(base64Image) {
-    sendChunkedData('image', base64Image);
+    socket.send(JSON.stringify({ type: 'transfer_end', transferId: transferId }));
 }
 
 async function getRoomName(roomNumber) {
@@ -767,15 +959,48 @@ function handleChunkedMessage(data) {
         }
     } else {
         displayMessage(data, true);
+        if (data.id) {
+            markRead(data.id);
+        }
+    }
+}
+
+function markRead(messageId) {
+    if (chatApp.newestMessageId !== null && messageId <= chatApp.newestMessageId) {
+        return;
     }
+    chatApp.newestMessageId = messageId;
+    scheduleReadReport();
 }
 
-function splitIntoChunks(data, chunkSize) {
-    const chunks = [];
-    for (let i = 0; i < data.length; i += chunkSize) {
-        chunks.push(data.slice(i, i + chunkSize));
+// 页面在后台时不上报已读，切回前台后再上报
+function scheduleReadReport() {
+    if (document.visibilityState === 'visible' && !chatApp.readTimer) {
+        chatApp.readTimer = setTimeout(sendReadPosition, READ_REPORT_DELAY);
     }
-    return chunks;
+}
+
+function sendReadPosition() {
+    chatApp.readTimer = null;
+    const messageId = chatApp.newestMessageId;
+    if (document.visibilityState !== 'visible' || messageId === null || messageId === chatApp.reportedReadId) {
+        return;
+    }
+    if (chatApp.socket && chatApp.socket.readyState === WebSocket.OPEN) {
+        chatApp.socket.send(JSON.stringify({ type: 'read', id: messageId }));
+        chatApp.reportedReadId = messageId;
+    }
+}
+
+function escapeHtml(text) {
+    const div = document.createElement('div');
+    div.textContent = text;
+    return div.innerHTML;
+}
+
+// 摘要是消息原文，转义后只还原标出匹配位置的<mark>标签
+function snippetHtml(snippet) {
+    return escapeHtml(snippet).replace(/&lt;(\/?)mark&gt;/g, '<$1mark>');
 }
 
 function getElementById(id) {
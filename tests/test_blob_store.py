@@ -0,0 +1,64 @@
+import asyncio
+import base64
+import hashlib
+import os
+
+import pytest
+
+import server
+
+PNG = b'\x89PNG\r\n\x1a\n' + b'0' * 100
+
+
+@pytest.fixture
+def store(tmp_path):
+    return server.BlobStore(str(tmp_path))
+
+
+def data_url(data, mime_type='image/png'):
+    return f'data:{mime_type};base64,' + base64.b64encode(data).decode()
+
+
+def test_put_data_url_stores_by_content_hash(store):
+    reference = asyncio.run(store.put_data_url(data_url(PNG), 'image'))
+    name = hashlib.sha256(PNG).hexdigest() + '.png'
+    assert reference == server.BLOB_URL_PREFIX + name
+    assert open(store.resolve(name), 'rb').read() == PNG
+    # 相同内容只存一份
+    assert asyncio.run(store.put_data_url(data_url(PNG), 'image')) == reference
+    assert os.listdir(os.path.dirname(store.path(name))) == [name]
+
+
+def test_unknown_mime_type_is_stored_without_extension(store):
+    reference = asyncio.run(store.put_data_url(data_url(PNG, 'image/svg+xml'), 'image'))
+    assert reference == server.BLOB_URL_PREFIX + hashlib.sha256(PNG).hexdigest()
+    assert store.content_type(store.resolve(reference[len(server.BLOB_URL_PREFIX):])) == 'application/octet-stream'
+
+
+@pytest.mark.parametrize('value', [
+    'https://example.com/a.png',
+    '/blobs/' + '0' * 64 + '.png',
+    'data:image/png,not-base64',
+    'data:image/png;base64,not base64!',
+    None
+])
+def test_invalid_data_urls_are_rejected(store, tmp_path, value):
+    with pytest.raises(server.TransferError):
+        asyncio.run(store.put_data_url(value, 'image'))
+    assert os.listdir(tmp_path) == []
+
+
+def test_resolve_only_accepts_blob_names(store):
+    name = '0' * 64 + '.png'
+    assert store.resolve(name) == store.path(name)
+    assert store.resolve('0' * 64 + '.thumb.webp') is not None
+    assert store.resolve('../' + name) is None
+    assert store.resolve('0' * 63 + '.png') is None
+
+
+def test_allowed_types(store):
+    assert store.allowed('image', 'image/PNG; charset=binary')
+    assert store.allowed('audio', 'audio/ogg')
+    assert not store.allowed('image', 'audio/ogg')
+    assert not store.allowed('image', None)
+    assert store.extension('audio', 'audio/webm;codecs=opus') == '.weba'
@@ -0,0 +1,47 @@
+import asyncio
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def data_db(tmp_path, monkeypatch):
+    database = server.Database(str(tmp_path / 'data.db'), read_connections=1)
+    monkeypatch.setattr(server, 'data_db', database)
+
+    async def create():
+        await server.migrate_db(database, server.DATA_MIGRATIONS)
+        await database.executemany(
+            "INSERT INTO messages (room_number, id, sender, message, timestamp) VALUES (?, ?, ?, ?, ?)",
+            [('1', message_id, 'a', f'm{message_id}', 100.0 + message_id) for message_id in range(1, 6)])
+
+    asyncio.run(create())
+    yield database
+    asyncio.run(database.close())
+
+
+def page(before=None, limit=None):
+    messages, has_more = asyncio.run(server.fetch_history('1', before, limit))
+    return [message['id'] for message in messages], has_more
+
+
+def test_pages_go_backwards(data_db):
+    assert page(limit=2) == ([4, 5], True)
+    assert page(4, 2) == ([2, 3], True)
+    assert page(2, 2) == ([1], False)
+    assert page('4', '2') == ([2, 3], True)
+
+
+@pytest.mark.parametrize('before', ['abc', [], {}, float('inf'), float('nan'), 0, -5, 1])
+def test_invalid_or_exhausted_cursor_returns_empty_page(data_db, before):
+    assert page(before) == ([], False)
+
+
+def test_huge_cursor_is_clamped(data_db):
+    assert page(10 ** 30, 3) == ([3, 4, 5], True)
+
+
+@pytest.mark.parametrize('limit, expected', [(0, 1), (-3, 1), ('x', 5), (10 ** 6, 5)])
+def test_limit_is_clamped(data_db, limit, expected):
+    assert len(page(limit=limit)[0]) == expected
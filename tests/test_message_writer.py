@@ -0,0 +1,100 @@
+import asyncio
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def discarded(monkeypatch):
+    keys = []
+
+    async def discard_messages(failed):
+        keys.extend(failed)
+
+    monkeypatch.setattr(server, 'discard_messages', discard_messages)
+    return keys
+
+
+def run_writer(tmp_path, check, **kwargs):
+    async def main():
+        database = server.Database(str(tmp_path / 'data.db'), read_connections=1)
+        await server.migrate_db(database, server.DATA_MIGRATIONS)
+        writer = server.MessageWriter(database, **kwargs)
+        writer.start()
+        try:
+            await check(database, writer)
+        finally:
+            await writer.close()
+            await database.close()
+
+    asyncio.run(main())
+
+
+def counter_value(counter):
+    return counter.values.get(None, 0)
+
+
+def test_messages_are_written_in_batches(tmp_path, discarded):
+    batches = counter_value(server.db_write_batches)
+
+    async def check(database, writer):
+        ids = [await writer.enqueue('1', 'a', 100.0 + index, message=f'm{index}') for index in range(5)]
+        ids.append(await writer.enqueue('2', 'b', 200.0, message='other room'))
+        assert ids == [1, 2, 3, 4, 5, 1]
+        assert writer.pending == 6
+        await writer.flush()
+        assert writer.pending == 0
+        rows = await database.execute("SELECT room_number, id, message FROM messages ORDER BY seq")
+        assert [tuple(row) for row in rows] == [('1', 1, 'm0'), ('1', 2, 'm1'), ('1', 3, 'm2'), ('1', 4, 'm3'),
+                                                ('1', 5, 'm4'), ('2', 1, 'other room')]
+
+    run_writer(tmp_path, check, flush_interval=0.05)
+    assert counter_value(server.db_write_batches) == batches + 1
+    assert discarded == []
+
+
+def test_batch_size_limits_each_write(tmp_path, discarded):
+    batches = counter_value(server.db_write_batches)
+
+    async def check(database, writer):
+        for index in range(5):
+            await writer.enqueue('1', 'a', 100.0, message=f'm{index}')
+        await writer.flush()
+        assert (await database.execute("SELECT COUNT(*) FROM messages"))[0][0] == 5
+
+    run_writer(tmp_path, check, flush_interval=0.05, batch_size=2)
+    assert counter_value(server.db_write_batches) == batches + 3
+
+
+def test_failed_row_does_not_lose_the_batch(tmp_path, discarded):
+    failed_rows = counter_value(server.db_write_failed_rows)
+
+    async def check(database, writer):
+        await database.execute("INSERT INTO messages (room_number, id, sender, message) VALUES ('1', 2, 'x', 'old')")
+        # 模拟另一个工作进程已经占用了id 2
+        writer._next_ids['1'] = 1
+        for index in range(3):
+            await writer.enqueue('1', 'a', 100.0, message=f'm{index}')
+        await writer.flush()
+        rows = await database.execute("SELECT id, message FROM messages ORDER BY id")
+        assert [tuple(row) for row in rows] == [(1, 'm0'), (2, 'old'), (3, 'm2')]
+
+    run_writer(tmp_path, check, flush_interval=0.05)
+    assert counter_value(server.db_write_failed_rows) == failed_rows + 1
+    assert discarded == [('1', 2)]
+
+
+def test_ids_continue_after_restart_and_follow_stride(tmp_path, discarded):
+    async def first(database, writer):
+        for index in range(3):
+            await writer.enqueue('1', 'a', 100.0, message=f'm{index}')
+
+    async def second(database, writer):
+        writer.id_offset, writer.id_stride = 1, 2
+        assert [await writer.enqueue('1', 'a', 100.0) for _ in range(2)] == [5, 7]
+        writer.observe_id('1', 10)
+        assert await writer.enqueue('1', 'a', 100.0) == 11
+
+    run_writer(tmp_path, first)
+    run_writer(tmp_path, second)
@@ -0,0 +1,102 @@
+import asyncio
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def meta_db(tmp_path, monkeypatch):
+    database = server.Database(str(tmp_path / 'meta.db'), read_connections=1)
+    monkeypatch.setattr(server, 'meta_db', database)
+
+    async def create():
+        await server.init_db()
+        await server.migrate_db(database, server.META_MIGRATIONS)
+        await database.executemany("INSERT INTO rooms (room_number, room_name, room_password) VALUES (?, ?, ?)",
+                                   [('2', '房间 2', ''), ('3', '房间 3', 'x')])
+        await database.executemany("INSERT INTO user_rooms (username, room_number) VALUES (?, ?)",
+                                   [('a', '1'), ('a', '2'), ('b', '2')])
+
+    asyncio.run(create())
+    yield database
+    asyncio.run(database.close())
+
+
+class CountingDatabase:
+    def __init__(self, database):
+        self.database = database
+        self.queries = 0
+
+    async def execute(self, query, params=()):
+        self.queries += 1
+        return await self.database.execute(query, params)
+
+
+def test_lookups_are_cached(meta_db):
+    db = CountingDatabase(meta_db)
+    cache = server.MetadataCache(db)
+
+    async def check():
+        rooms = await cache.get_user_rooms('a')
+        assert rooms == [{'roomNumber': '1', 'roomName': '公共聊天室'}, {'roomNumber': '2', 'roomName': '房间 2'}]
+        # 房间列表查询顺带填充了房间缓存
+        assert await cache.get_room('2') == ('房间 2', '')
+        assert await cache.get_user_rooms('a') == rooms
+        assert await cache.get_room_users('2') == ('a', 'b')
+        assert await cache.get_room_users('2') == ('a', 'b')
+        assert db.queries == 2
+        # 不存在的房间也会缓存
+        assert await cache.get_room('9') is None
+        assert await cache.get_room('9') is None
+        assert db.queries == 3
+
+    asyncio.run(check())
+
+
+def test_invalidate_reloads_entry(meta_db):
+    cache = server.MetadataCache(meta_db)
+
+    async def check():
+        assert await cache.get_room('3') == ('房间 3', 'x')
+        assert await cache.get_room_users('3') == ()
+        assert len(await cache.get_user_rooms('a')) == 2
+        await meta_db.execute("UPDATE rooms SET room_name = '新名字' WHERE room_number = '3'")
+        await meta_db.execute("INSERT INTO user_rooms (username, room_number) VALUES ('a', '3')")
+        assert await cache.get_room('3') == ('房间 3', 'x')
+        cache.invalidate('rooms', '3')
+        cache.invalidate('room_users', '3')
+        assert await cache.get_room('3') == ('新名字', 'x')
+        assert await cache.get_room_users('3') == ('a',)
+        assert [room['roomNumber'] for room in await cache.get_user_rooms('a')] == ['1', '2']
+        cache.invalidate('user_rooms', 'a')
+        assert [room['roomNumber'] for room in await cache.get_user_rooms('a')] == ['1', '2', '3']
+
+    asyncio.run(check())
+
+
+def test_invalidation_from_other_workers(meta_db, monkeypatch):
+    cache = server.MetadataCache(meta_db)
+    monkeypatch.setattr(server, 'metadata_cache', cache)
+
+    async def check():
+        assert await cache.get_room('2') == ('房间 2', '')
+        await meta_db.execute("UPDATE rooms SET room_name = '改名' WHERE room_number = '2'")
+        await server.handle_backplane_message('invalidate', None, ['rooms', '2'], None)
+        assert await cache.get_room('2') == ('改名', '')
+        await meta_db.execute("UPDATE rooms SET room_name = '再改名' WHERE room_number = '2'")
+        await server.invalidate_metadata(('rooms', '2'))
+        assert await cache.get_room('2') == ('再改名', '')
+
+    asyncio.run(check())
+
+
+def test_lru_eviction():
+    cache = server.LRUCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is server.LRUCache.missing
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    assert cache.stats() == {'size': 2, 'hits': 3, 'misses': 1, 'evictions': 1}
@@ -0,0 +1,20 @@
+import server
+
+
+def test_metrics_only_allowed_from_loopback():
+    assert server.metrics_allowed('127.0.0.1')
+    assert server.metrics_allowed('::1')
+    assert server.metrics_allowed('::ffff:127.0.0.1')
+    assert not server.metrics_allowed('10.0.0.1')
+    assert not server.metrics_allowed(None)
+    assert not server.metrics_allowed('')
+
+
+def test_room_sockets_are_aggregated(monkeypatch):
+    monkeypatch.setattr(server, 'room_sockets', {'1': {object()}, '2': {object() for _ in range(3)}, '3': set()})
+    buckets = server.room_socket_buckets()
+    assert (buckets['1'], buckets['2'], buckets['5'], buckets['+Inf']) == (2, 2, 3, 3)
+    text = server.metrics.render()
+    assert 'chat_active_sockets 4\n' in text
+    assert 'chat_room_sockets{le="5"} 3\n' in text
+    assert 'room=' not in text
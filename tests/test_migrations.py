@@ -0,0 +1,134 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+import server
+
+MESSAGES = [
+    ('1', 1, 'a', '今天天气很好', None, None, None, 100.0),
+    ('1', 2, 'b', None, '/blobs/x.png', None, None, 101.0),
+    ('1', 3, 'a', 'hello world', None, None, None, 102.0),
+    ('2', 1, 'b', '好的', None, None, None, 99.0)
+]
+
+
+async def migrate(path, migrations):
+    database = server.Database(path, read_connections=1)
+    try:
+        await server.migrate_db(database, migrations)
+        await server.migrate_db(database, migrations)
+        return database
+    except Exception:
+        await database.close()
+        raise
+
+
+async def insert_messages(database, messages):
+    await database.executemany(
+        "INSERT INTO messages (room_number, id, sender, message, image, audio, file_name, timestamp) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", messages)
+
+
+def test_data_db_schema(tmp_path, monkeypatch):
+    path = str(tmp_path / 'data.db')
+
+    async def check():
+        database = await migrate(path, server.DATA_MIGRATIONS)
+        monkeypatch.setattr(server, 'data_db', database)
+        try:
+            assert (await database.execute("PRAGMA user_version"))[0][0] == len(server.DATA_MIGRATIONS)
+            await insert_messages(database, MESSAGES)
+            assert [tuple(row) for row in await database.execute(
+                "SELECT room_number, last_id, message_count, expired_count FROM room_sequences ORDER BY room_number")] \
+                == [('1', 3, 3, 0), ('2', 1, 1, 0)]
+
+            results, _ = await server.search_messages(['1', '2'], '天气很')
+            assert [(result['roomNumber'], result['id']) for result in results] == [('1', 1)]
+            results, _ = await server.search_messages(['1', '2'], '好')
+            assert [(result['roomNumber'], result['id']) for result in results] == [('2', 1), ('1', 1)]
+
+            await database.execute("DELETE FROM messages WHERE room_number = '2'")
+            assert (await server.search_messages(['1', '2'], '好的'))[0] == []
+            # 删除消息后id不回退
+            await database.execute("DELETE FROM messages WHERE room_number = '1' AND id = 3")
+            assert [tuple(row) for row in await database.execute(
+                "SELECT last_id, message_count FROM room_sequences WHERE room_number = '1'")] == [(3, 3)]
+        finally:
+            await database.close()
+
+    asyncio.run(check())
+
+
+def legacy_data_db(path, rooms):
+    # 旧版本的data.db：每个房间一张chat_<房间号>表，没有user_version
+    with sqlite3.connect(path) as db:
+        for room_number, messages in rooms.items():
+            db.execute(f"CREATE TABLE chat_{room_number} (id INTEGER PRIMARY KEY, sender TEXT, message TEXT, "
+                       "image TEXT, audio TEXT, file_name TEXT, timestamp REAL)")
+            db.executemany(f"INSERT INTO chat_{room_number} (sender, message, timestamp) VALUES (?, ?, ?)", messages)
+    db.close()
+
+
+def test_legacy_chat_tables(tmp_path, monkeypatch):
+    path = str(tmp_path / 'data.db')
+    legacy_data_db(path, {'1': [('a', 'old1', 1.0), ('b', 'old2', 2.0), ('a', 'old3', 3.0)], '2': [('b', '好的', 4.0)]})
+
+    async def check():
+        database = await migrate(path, server.DATA_MIGRATIONS)
+        monkeypatch.setattr(server, 'data_db', database)
+        try:
+            await server.migrate_legacy_tables(database)
+            await server.migrate_legacy_tables(database)
+            assert await database.execute("SELECT name FROM sqlite_master WHERE name LIKE 'chat%'") == []
+            rows = await database.execute("SELECT room_number, id, sender, message FROM messages ORDER BY seq")
+            assert [tuple(row) for row in rows] == [('1', 1, 'a', 'old1'), ('1', 2, 'b', 'old2'), ('1', 3, 'a', 'old3'),
+                                                    ('2', 1, 'b', '好的')]
+            assert (await server.search_messages(['2'], '好'))[0][0]['id'] == 1
+            # 迁移后新消息的id接在旧消息之后
+            writer = server.MessageWriter(database)
+            assert await writer._allocate_id('1') == 4
+            assert await writer._allocate_id('2') == 2
+        finally:
+            await database.close()
+
+    asyncio.run(check())
+
+
+def test_legacy_table_kept_when_ids_collide(tmp_path):
+    path = str(tmp_path / 'data.db')
+    legacy_data_db(path, {'1': [('a', 'old1', 1.0), ('b', 'old2', 2.0)]})
+
+    async def check():
+        database = await migrate(path, server.DATA_MIGRATIONS)
+        try:
+            await insert_messages(database, [('1', 1, 'a', 'new', None, None, None, 5.0)])
+            with pytest.raises(RuntimeError):
+                await server.migrate_legacy_tables(database)
+            assert [tuple(row) for row in await database.execute("SELECT id, message FROM messages")] == [(1, 'new')]
+            assert [tuple(row) for row in await database.execute("SELECT id, message FROM chat_1")] \
+                == [(1, 'old1'), (2, 'old2')]
+        finally:
+            await database.close()
+
+    asyncio.run(check())
+
+
+def test_legacy_meta_db(tmp_path):
+    path = str(tmp_path / 'meta.db')
+    with sqlite3.connect(path) as db:
+        db.execute("CREATE TABLE user_rooms (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT, room_number TEXT, "
+                   "UNIQUE(username, room_number))")
+        db.executemany("INSERT INTO user_rooms (username, room_number) VALUES (?, ?)", [('a', '1'), ('b', '1')])
+    db.close()
+
+    async def check():
+        database = await migrate(path, server.META_MIGRATIONS)
+        try:
+            assert (await database.execute("PRAGMA user_version"))[0][0] == len(server.META_MIGRATIONS)
+            rows = await database.execute("SELECT username, last_read_id, read_count FROM user_rooms ORDER BY id")
+            assert [tuple(row) for row in rows] == [('a', 0, None), ('b', 0, None)]
+        finally:
+            await database.close()
+
+    asyncio.run(check())
@@ -0,0 +1,86 @@
+import asyncio
+
+import server
+
+
+class Database:
+    def __init__(self, rows=(), fail=False):
+        self.rows = list(rows)
+        self.fail = fail
+        self.written = []
+
+    async def execute(self, query, params=()):
+        return self.rows
+
+    async def executemany(self, query, rows):
+        if self.fail:
+            raise RuntimeError("database is locked")
+        self.written.extend(rows)
+
+
+def test_user_is_online_until_last_socket_leaves():
+    presence = server.Presence(Database())
+    assert presence.join('1', 'a')
+    assert not presence.join('1', 'a')
+    assert presence.join('1', 'b')
+    assert presence.online_count('1') == 2
+    assert not presence.leave('1', 'a')
+    assert presence.is_online('1', 'a')
+    assert presence.leave('1', 'a')
+    assert not presence.is_online('1', 'a')
+    assert presence.leave('1', 'b')
+    assert presence.online == {}
+    # 重复的离开不会变成负数
+    assert not presence.leave('1', 'b')
+
+
+def test_rooms_are_counted_separately():
+    presence = server.Presence(Database())
+    presence.join('1', 'a')
+    presence.join('2', 'a')
+    presence.leave('1', 'a')
+    assert (presence.online_count('1'), presence.online_count('2')) == (0, 1)
+
+
+def test_only_local_events_are_persisted():
+    presence = server.Presence(Database())
+    presence.join('1', 'a')
+    presence.join('1', 'b', persist=False)
+    assert set(presence.last_seen) == {'a', 'b'}
+    assert set(presence._dirty) == {'a'}
+
+
+def test_flush_writes_last_seen_in_one_batch():
+    db = Database()
+    presence = server.Presence(db)
+    presence.join('1', 'a')
+    presence.join('1', 'b')
+    presence.leave('1', 'a')
+    asyncio.run(presence.flush())
+    assert [username for username, _ in db.written] == ['a', 'b']
+    assert db.written[0][1] == presence.last_seen['a']
+    assert presence._dirty == {}
+    asyncio.run(presence.flush())
+    assert len(db.written) == 2
+
+
+def test_failed_flush_is_retried():
+    db = Database(fail=True)
+    presence = server.Presence(db)
+    presence.join('1', 'a')
+    asyncio.run(presence.flush())
+    assert set(presence._dirty) == {'a'}
+    db.fail = False
+    asyncio.run(presence.flush())
+    assert [username for username, _ in db.written] == ['a']
+
+
+def test_start_loads_last_seen():
+    presence = server.Presence(Database([('a', 100.0)]))
+
+    async def check():
+        await presence.start()
+        await presence.close()
+
+    asyncio.run(check())
+    assert presence.last_seen == {'a': 100.0}
@@ -0,0 +1,85 @@
+import asyncio
+
+import pytest
+
+import server
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(server.time, 'monotonic', clock)
+    return clock
+
+
+def test_token_bucket_refills_up_to_burst():
+    bucket = server.TokenBucket(2, 4, 0.0)
+    bucket.tokens = 0
+    bucket.refill(1.0)
+    assert bucket.tokens == 2
+    bucket.refill(10.0)
+    assert bucket.tokens == 4
+
+
+def test_token_bucket_delay_until_next_token():
+    bucket = server.TokenBucket(4, 1, 0.0)
+    assert bucket.delay(0.0) == 0
+    bucket.tokens = 0
+    assert bucket.delay(0.0) == pytest.approx(0.25)
+    assert bucket.delay(0.125) == pytest.approx(0.125)
+
+
+def test_allow_spends_burst_then_throttles(clock):
+    limiter = server.RateLimiter({'message': (1, 3, None, None)})
+    assert [limiter.allow('message', 'a', '1') for _ in range(4)] == [True, True, True, False]
+    # 其他用户有自己的令牌桶
+    assert limiter.allow('message', 'b', '1')
+    clock.now += 1
+    assert limiter.allow('message', 'a', '1')
+    assert not limiter.allow('message', 'a', '1')
+
+
+def test_room_limit_applies_to_all_users(clock):
+    limiter = server.RateLimiter({'message': (10, 10, 1, 2)})
+    assert limiter.allow('message', 'a', '1')
+    assert limiter.allow('message', 'b', '1')
+    assert not limiter.allow('message', 'c', '1')
+    assert limiter.allow('message', 'c', '2')
+
+
+def test_rejected_message_does_not_spend_tokens(clock):
+    limiter = server.RateLimiter({'message': (10, 1, 1, 5)})
+    assert limiter.allow('message', 'a', '1')
+    assert not limiter.allow('message', 'a', '1')
+    # 用户的令牌桶已空，房间的令牌没有被扣掉
+    assert limiter.buckets[('message', 'room', '1')].tokens == 4
+
+
+def test_wait_sleeps_instead_of_dropping(clock, monkeypatch):
+    delays = []
+
+    async def sleep(delay):
+        delays.append(delay)
+
+    monkeypatch.setattr(server.asyncio, 'sleep', sleep)
+    limiter = server.RateLimiter({'chunk': (2, 1, None, None)})
+    asyncio.run(limiter.wait('chunk', 'a', '1'))
+    asyncio.run(limiter.wait('chunk', 'a', '1'))
+    assert delays == [pytest.approx(0.5)]
+
+
+def test_sweep_drops_full_buckets(clock):
+    limiter = server.RateLimiter({'message': (1, 1, None, None)}, max_buckets=2)
+    limiter.allow('message', 'a', '1')
+    limiter.allow('message', 'b', '1')
+    clock.now += 5
+    limiter.allow('message', 'c', '1')
+    assert set(limiter.buckets) == {('message', 'user', 'c')}
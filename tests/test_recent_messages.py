@@ -0,0 +1,115 @@
+import asyncio
+import json
+
+import server
+
+
+def encoded(message_id, text='x'):
+    return json.dumps({'id': message_id, 'message': text})
+
+
+def recent(room_numbers=('1',), has_more=False, **kwargs):
+    messages = server.RecentMessages(**kwargs)
+    for room_number in room_numbers:
+        messages.rooms[room_number] = server.RoomBuffer(has_more)
+    return messages
+
+
+def ids(messages, room_number='1'):
+    return [message_id for message_id, _ in messages.rooms[room_number].entries]
+
+
+def history(messages, room_number='1', since=None):
+    return json.loads(asyncio.run(messages.history_frame(room_number, since)))
+
+
+def test_out_of_order_ids_are_sorted():
+    messages = recent()
+    for message_id in (1, 4, 2, 3):
+        messages.append('1', message_id, encoded(message_id))
+    assert ids(messages) == [1, 2, 3, 4]
+    assert [message['id'] for message in history(messages)['messages']] == [1, 2, 3, 4]
+
+
+def test_duplicate_ids_are_ignored():
+    messages = recent()
+    for message_id in (1, 2, 3, 2, 3):
+        messages.append('1', message_id, encoded(message_id))
+    assert ids(messages) == [1, 2, 3]
+    buffer = messages.rooms['1']
+    assert buffer.size == messages.size == sum(len(text) for _, text in buffer.entries)
+
+
+def test_late_message_older_than_full_buffer_is_dropped():
+    messages = recent(max_messages=3)
+    for message_id in (5, 6, 7):
+        messages.append('1', message_id, encoded(message_id))
+    messages.append('1', 4, encoded(4))
+    assert ids(messages) == [5, 6, 7]
+    assert messages.rooms['1'].has_more
+
+
+def test_message_count_cap_drops_oldest():
+    messages = recent(max_messages=3)
+    for message_id in range(1, 6):
+        messages.append('1', message_id, encoded(message_id))
+    assert ids(messages) == [3, 4, 5]
+    assert history(messages)['hasMore'] is True
+
+
+def test_room_byte_cap_keeps_newest():
+    size = len(encoded(1, 'a' * 100))
+    messages = recent(room_max_bytes=size * 2)
+    for message_id in range(1, 5):
+        messages.append('1', message_id, encoded(message_id, 'a' * 100))
+    assert ids(messages) == [3, 4]
+    assert messages.rooms['1'].size == messages.size == size * 2
+
+
+def test_total_byte_cap_evicts_least_recent_room():
+    size = len(encoded(1, 'a' * 100))
+    messages = recent(('1', '2', '3'), max_bytes=size * 2)
+    messages.append('1', 1, encoded(1, 'a' * 100))
+    messages.append('2', 1, encoded(1, 'a' * 100))
+    messages.append('3', 1, encoded(1, 'a' * 100))
+    assert list(messages.rooms) == ['2', '3']
+    assert messages.evictions == 1
+    assert messages.size == size * 2
+
+
+def test_since_returns_only_newer_messages():
+    messages = recent()
+    for message_id in range(1, 6):
+        messages.append('1', message_id, encoded(message_id))
+    frame = history(messages, since=3)
+    assert frame['since'] == 3
+    assert [message['id'] for message in frame['messages']] == [4, 5]
+    assert history(messages, since=5)['messages'] == []
+
+
+def test_since_before_buffer_sends_full_history():
+    messages = recent(has_more=True)
+    for message_id in range(10, 13):
+        messages.append('1', message_id, encoded(message_id))
+    frame = history(messages, since=5)
+    assert 'since' not in frame
+    assert [message['id'] for message in frame['messages']] == [10, 11, 12]
+    assert frame['hasMore'] is True
+
+
+def test_cached_frame_is_rebuilt_after_append():
+    messages = recent()
+    messages.append('1', 1, encoded(1))
+    assert len(history(messages)['messages']) == 1
+    messages.append('1', 2, encoded(2))
+    assert len(history(messages)['messages']) == 2
+
+
+def test_discard_removes_failed_entries():
+    messages = recent()
+    for message_id in range(1, 5):
+        messages.append('1', message_id, encoded(message_id))
+    messages.discard('1', {2, 4})
+    assert ids(messages) == [1, 3]
+    assert messages.size == sum(len(text) for _, text in messages.rooms['1'].entries)
+    assert [message['id'] for message in history(messages)['messages']] == [1, 3]
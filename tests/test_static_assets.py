@@ -0,0 +1,98 @@
+import gzip
+
+import pytest
+from aiohttp.test_utils import make_mocked_request
+
+import server
+
+SCRIPT = b'console.log("hello");\n' * 50
+
+
+@pytest.fixture
+def assets(tmp_path):
+    static = tmp_path / 'static'
+    (static / 'fonts').mkdir(parents=True)
+    (static / 'css').mkdir()
+    (static / 'app.js').write_bytes(SCRIPT)
+    (static / 'fonts' / 'icon.woff2').write_bytes(b'wOF2' + bytes(range(256)))
+    (static / 'css' / 'style.css').write_text(
+        "@font-face{src:url(../fonts/icon.woff2?v=1) format('woff2'),url('../fonts/missing.ttf')}"
+        "body{background:url(\"data:image/png;base64,AAAA\")}", encoding='utf-8')
+    (static / '.hidden').write_bytes(b'x')
+    template = tmp_path / 'index.html'
+    template.write_text('<script src="{{ app.js }}"></script><link href="{{css/style.css}}">', encoding='utf-8')
+    assets = server.StaticAssets(str(static), '/static/', str(template))
+    assets.load()
+    return assets
+
+
+def request(accept_encoding=None, if_none_match=None):
+    headers = {}
+    if accept_encoding is not None:
+        headers['Accept-Encoding'] = accept_encoding
+    if if_none_match is not None:
+        headers['If-None-Match'] = if_none_match
+    return make_mocked_request('GET', '/', headers=headers)
+
+
+def test_template_references_hashed_names(assets):
+    script = assets.files['app.js']
+    assert script.hashed_name == f'app.{script.digest}.js'
+    assert assets.files[script.hashed_name] is script
+    page = assets.index.bodies[None].decode()
+    assert f'src="/static/{script.hashed_name}"' in page
+    assert f'href="/static/{assets.files["css/style.css"].hashed_name}"' in page
+    assert '.hidden' not in assets.files
+
+
+def test_css_urls_are_rewritten(assets):
+    css = assets.files['css/style.css'].bodies[None].decode()
+    font = assets.files['fonts/icon.woff2']
+    assert f'url(../fonts/{font.hashed_name.split("/")[-1]}?v=1)' in css
+    # 不存在的文件和data URL保持原样
+    assert "url('../fonts/missing.ttf')" in css
+    assert 'url("data:image/png;base64,AAAA")' in css
+
+
+def test_missing_template_reference_fails(assets, tmp_path):
+    (tmp_path / 'index.html').write_text('{{ nothing.js }}', encoding='utf-8')
+    with pytest.raises(ValueError):
+        assets.load()
+
+
+@pytest.mark.parametrize('accept_encoding, expected', [
+    ('gzip, deflate, br', 'br' if server.brotli is not None else 'gzip'),
+    ('gzip', 'gzip'),
+    ('br;q=0, gzip;q=0.5', 'gzip'),
+    ('gzip;q=0', None),
+    ('*', 'br' if server.brotli is not None else 'gzip'),
+    ('', None),
+    ('identity', None)
+])
+def test_encoding_negotiation(assets, accept_encoding, expected):
+    assert assets.files['app.js'].negotiate(accept_encoding) == expected
+
+
+def test_response_is_compressed_and_cached(assets):
+    script = assets.files['app.js']
+    response = script.response(request('gzip'), server.STATIC_CACHE_CONTROL)
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['Vary'] == 'Accept-Encoding'
+    assert response.headers['ETag'] == f'"{script.digest}-gzip"'
+    assert gzip.decompress(response.body) == SCRIPT
+
+    response = script.response(request(), 'no-cache')
+    assert 'Content-Encoding' not in response.headers
+    assert response.body == SCRIPT
+
+
+def test_conditional_request_returns_304(assets):
+    script = assets.files['app.js']
+    for etag in (f'"{script.digest}"', f'"{script.digest}-gzip"', '*'):
+        assert script.response(request('gzip', etag), 'no-cache').status == 304
+    assert script.response(request('gzip', '"other"'), 'no-cache').status == 200
+
+
+def test_small_and_binary_files_are_not_compressed(assets):
+    assert list(assets.files['fonts/icon.woff2'].bodies) == [None]
+    assert assets.files['fonts/icon.woff2'].negotiate('gzip, br') is None
@@ -0,0 +1,158 @@
+import asyncio
+import base64
+import hashlib
+import os
+
+import pytest
+
+import server
+
+PNG = b'\x89PNG\r\n\x1a\n' + b'0' * 100
+
+
+@pytest.fixture
+def manager(tmp_path):
+    return server.TransferManager(server.BlobStore(str(tmp_path)), max_size=1000, user_max_bytes=1500,
+                                  user_max_count=2)
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def frame(transfer_id, data):
+    return server.TRANSFER_HEADER.pack(transfer_id) + data
+
+
+def test_binary_transfer(manager, tmp_path):
+    owner = object()
+
+    async def check():
+        await manager.begin(owner, 1, 'a', '1', 'image', 'image/png', len(PNG))
+        await manager.write(owner, frame(1, PNG[:50]))
+        await manager.write(owner, frame(1, PNG[50:]))
+        assert manager.buffered_bytes() == len(PNG)
+        transfer, reference = await manager.finish(owner, 1)
+        assert (transfer.room_number, transfer.kind) == ('1', 'image')
+        assert reference == server.BLOB_URL_PREFIX + hashlib.sha256(PNG).hexdigest() + '.png'
+        assert open(manager.store.resolve(reference[len(server.BLOB_URL_PREFIX):]), 'rb').read() == PNG
+        assert manager.transfers == {} and manager.user_bytes == {} and manager.user_counts == {}
+
+    run(check())
+
+
+@pytest.mark.parametrize('kind, mime_type, size, message', [
+    ('file', 'image/png', 10, '不支持的传输类型'),
+    ('image', 'image/svg+xml', 10, '不支持的图片或语音格式'),
+    ('image', 'image/png', 0, '文件过大'),
+    ('image', 'image/png', 1001, '文件过大')
+])
+def test_begin_rejects_invalid_transfers(manager, kind, mime_type, size, message):
+    with pytest.raises(server.TransferError, match=message):
+        run(manager.begin(object(), 1, 'a', '1', kind, mime_type, size))
+    assert manager.transfers == {}
+
+
+def test_per_user_limits(manager):
+    owner = object()
+
+    async def check():
+        await manager.begin(owner, 1, 'a', '1', 'image', 'image/png', 1000)
+        with pytest.raises(server.TransferError, match='传输中的数据过多'):
+            await manager.begin(owner, 2, 'a', '1', 'image', 'image/png', 600)
+        await manager.begin(owner, 2, 'a', '1', 'image', 'image/png', 500)
+        with pytest.raises(server.TransferError, match='同时进行的传输过多'):
+            await manager.begin(owner, 3, 'a', '1', 'image', 'image/png', 1)
+        # 额度按用户计算
+        await manager.begin(owner, 3, 'b', '1', 'image', 'image/png', 1000)
+        await manager.abort(owner, 1)
+        await manager.begin(owner, 1, 'a', '1', 'image', 'image/png', 500)
+
+    run(check())
+
+
+def test_data_past_declared_size_discards_transfer(manager):
+    owner = object()
+
+    async def check():
+        await manager.begin(owner, 1, 'a', '1', 'image', 'image/png', 10)
+        path = manager.transfers[(owner, 1)].path
+        with pytest.raises(server.TransferError):
+            await manager.write(owner, frame(1, b'0' * 11))
+        assert manager.transfers == {} and manager.user_bytes == {}
+        assert not os.path.exists(path)
+
+    run(check())
+
+
+def test_stalled_transfers_are_reaped(tmp_path):
+    manager = server.TransferManager(server.BlobStore(str(tmp_path)), timeout=0.04)
+    owner = object()
+
+    async def check():
+        manager.start()
+        await manager.begin(owner, 1, 'a', '1', 'image', 'image/png', 10)
+        await manager.write_legacy(owner, 'a', '1', 'audio', 0, 2, 'data:')
+        await asyncio.sleep(0.2)
+        await manager.close()
+        assert manager.transfers == {} and manager.expired == 2
+
+    run(check())
+
+
+def legacy_chunks(data, size):
+    data_url = 'data:image/png;base64,' + base64.b64encode(data).decode()
+    return [data_url[i:i + size] for i in range(0, len(data_url), size)]
+
+
+def test_legacy_chunks(tmp_path):
+    manager = server.TransferManager(server.BlobStore(str(tmp_path)))
+    owner = object()
+    chunks = legacy_chunks(PNG, 40)
+
+    async def check():
+        # 分片可以乱序到达，重发的分片覆盖之前的内容
+        for index in [1, 0, 1] + list(range(2, len(chunks) - 1)):
+            assert await manager.write_legacy(owner, 'a', '1', 'image', index, len(chunks), chunks[index]) is None
+        assert manager.user_bytes['a'] == len(chunks) * server.TRANSFER_LEGACY_CHUNK_SIZE
+        assert manager.buffered_bytes() == sum(len(chunk) for chunk in chunks[:-1])
+        transfer, reference = await manager.write_legacy(owner, 'a', '1', 'image', len(chunks) - 1, len(chunks),
+                                                         chunks[-1])
+        assert transfer.kind == 'image'
+        assert reference == server.BLOB_URL_PREFIX + hashlib.sha256(PNG).hexdigest() + '.png'
+        assert manager.transfers == {} and manager.user_bytes == {}
+
+    run(check())
+
+
+@pytest.mark.parametrize('kind, chunk_index, chunk_total, chunk', [
+    ('file', 0, 2, 'x'),
+    ('message', 0, 2, 'x'),
+    ('image', 0, 0, 'x'),
+    ('image', 0, server.TRANSFER_LEGACY_MAX_CHUNKS + 1, 'x'),
+    ('image', 2, 2, 'x'),
+    ('image', 0, 2, 'x' * (server.TRANSFER_LEGACY_CHUNK_SIZE + 1)),
+    ('image', 0, 2, None)
+])
+def test_legacy_rejects_invalid_chunks(manager, kind, chunk_index, chunk_total, chunk):
+    with pytest.raises(server.TransferError):
+        run(manager.write_legacy(object(), 'a', '1', kind, chunk_index, chunk_total, chunk))
+    assert manager.transfers == {} and manager.user_bytes == {}
+
+
+def test_legacy_chunks_share_user_limits(tmp_path):
+    manager = server.TransferManager(server.BlobStore(str(tmp_path)),
+                                     user_max_bytes=3 * server.TRANSFER_LEGACY_CHUNK_SIZE, user_max_count=2)
+    owner = object()
+
+    async def check():
+        await manager.write_legacy(owner, 'a', '1', 'image', 0, 2, 'data:')
+        with pytest.raises(server.TransferError, match='传输中的数据过多'):
+            await manager.write_legacy(owner, 'a', '1', 'audio', 0, 2, 'data:')
+        await manager.begin(owner, 1, 'a', '1', 'audio', 'audio/ogg', 10)
+        with pytest.raises(server.TransferError, match='同时进行的传输过多'):
+            await manager.write_legacy(object(), 'a', '1', 'audio', 0, 1, 'data:')
+        await manager.abort(owner)
+        assert manager.transfers == {} and manager.user_bytes == {}
+
+    run(check())
@@ -0,0 +1,85 @@
+import asyncio
+
+import server
+
+
+class Database:
+    def __init__(self, rows=()):
+        self.rows = list(rows)
+        self.updates = []
+
+    async def execute(self, query, params=()):
+        return self.rows
+
+    async def executemany(self, query, rows):
+        self.updates.extend(rows)
+
+
+def counter(rooms=None, read=None):
+    unread = server.UnreadCounter(Database(), Database())
+    unread.rooms = {room_number: list(room) for room_number, room in (rooms or {}).items()}
+    unread.read = dict(read or {})
+    return unread
+
+
+def test_messages_before_joining_are_read():
+    unread = counter({'1': (10, 10, 0)})
+    state = unread.baseline('1')
+    assert state == (10, 10)
+    unread.apply('a', '1', *state)
+    unread.observe('1', 11, 'b')
+    assert unread.state('a', '1') == {'unread': 1, 'lastReadId': 10}
+
+
+def test_own_messages_are_not_unread():
+    unread = counter({'1': (10, 10, 0)}, {('a', '1'): (10, 10)})
+    assert unread.observe('1', 11, 'b') is None
+    assert unread.observe('1', 12, 'a') == (10, 11)
+    assert unread.state('a', '1') == {'unread': 1, 'lastReadId': 10}
+    assert unread._dirty == {('a', '1'): (10, 11)}
+
+
+def test_mark_read_ignores_older_positions():
+    unread = counter({'1': (5, 5, 0)}, {('a', '1'): (0, 0)})
+    assert unread.mark_read('a', '1', 3, newer=2) == (3, 3)
+    assert unread.mark_read('a', '1', 2) is None
+    # 已读位置不会超过房间中最新的消息
+    assert unread.mark_read('a', '1', 100) == (5, 5)
+    assert unread.state('a', '1')['unread'] == 0
+
+
+def test_apply_keeps_newest_state():
+    unread = counter(read={('a', '1'): (5, 5)})
+    unread.apply('a', '1', 4, 10)
+    assert unread.read[('a', '1')] == (5, 5)
+    unread.apply('a', '1', 5, 6)
+    assert unread.read[('a', '1')] == (5, 6)
+
+
+def test_expired_and_discarded_messages():
+    unread = counter({'1': (10, 10, 0)}, {('a', '1'): (2, 2)})
+    assert unread.state('a', '1')['unread'] == 8
+    unread.expire('1', 5)
+    assert unread.state('a', '1')['unread'] == 5
+    unread.discard('1', 1)
+    assert unread.state('a', '1')['unread'] == 4
+
+
+def test_unknown_membership_has_no_unread():
+    unread = counter({'1': (10, 10, 0)})
+    assert unread.state('a', '1') == {'unread': 0, 'lastReadId': 10}
+    assert unread.read == {} and unread._dirty == {}
+
+
+def test_start_sets_baseline_for_rows_without_read_count():
+    meta = Database([('a', '1', 0, None), ('b', '1', 4, 4)])
+    data = Database([('1', 10, 10, 0)])
+    unread = server.UnreadCounter(meta, data)
+
+    async def check():
+        await unread.start()
+        await unread.close()
+
+    asyncio.run(check())
+    assert unread.read == {('a', '1'): (10, 10), ('b', '1'): (4, 4)}
+    assert meta.updates == [(10, 10, 'a', '1', 10)]
@@ -0,0 +1,113 @@
+import asyncio
+import fcntl
+import os
+
+import pytest
+
+import server
+
+
+class Stream:
+    def __init__(self, *chunks):
+        self.chunks = chunks
+
+    async def iter_chunked(self, size):
+        for chunk in self.chunks:
+            yield chunk
+
+
+@pytest.fixture
+def store(tmp_path):
+    return server.UploadStore(str(tmp_path), max_size=100, user_max_count=2, user_max_bytes=150)
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_append_and_finalize(store, tmp_path):
+    upload_id = run(store.create('a', '../报告.pdf', 10))
+    assert run(store.append(upload_id, 'a', 0, Stream(b'01234'))) == 5
+    assert run(store.status(upload_id, 'a'))['offset'] == 5
+    assert run(store.append(upload_id, 'a', 5, Stream(b'56', b'789'))) == 10
+    file_name, size = run(store.finalize(upload_id, 'a'))
+    assert size == 10
+    assert file_name.endswith('/报告.pdf')
+    assert (tmp_path / file_name).read_bytes() == b'0123456789'
+    with pytest.raises(server.UploadError) as error:
+        run(store.status(upload_id, 'a'))
+    assert error.value.status == 404
+
+
+def test_append_rejects_wrong_offset(store):
+    upload_id = run(store.create('a', 'f', 10))
+    run(store.append(upload_id, 'a', 0, Stream(b'0123')))
+    with pytest.raises(server.UploadError) as error:
+        run(store.append(upload_id, 'a', 2, Stream(b'23')))
+    assert (error.value.status, error.value.offset) == (409, 4)
+
+
+def test_append_past_declared_size_keeps_earlier_data(store):
+    upload_id = run(store.create('a', 'f', 6))
+    run(store.append(upload_id, 'a', 0, Stream(b'012')))
+    with pytest.raises(server.UploadError) as error:
+        run(store.append(upload_id, 'a', 3, Stream(b'345', b'6')))
+    assert (error.value.status, error.value.offset) == (413, 3)
+    assert run(store.status(upload_id, 'a'))['offset'] == 3
+
+
+def test_finalize_incomplete_upload(store):
+    upload_id = run(store.create('a', 'f', 10))
+    run(store.append(upload_id, 'a', 0, Stream(b'0123')))
+    with pytest.raises(server.UploadError) as error:
+        run(store.finalize(upload_id, 'a'))
+    assert (error.value.status, error.value.offset) == (409, 4)
+
+
+def test_other_users_cannot_see_upload(store):
+    upload_id = run(store.create('a', 'f', 10))
+    for username in ('b', None):
+        with pytest.raises(server.UploadError) as error:
+            run(store.append(upload_id, username, 0, Stream(b'0')))
+        assert error.value.status == 404
+
+
+def test_locked_upload_is_rejected(store):
+    upload_id = run(store.create('a', 'f', 10))
+    # 模拟另一个工作进程正在写入
+    with open(store._data_path(upload_id, 'a'), 'r+b') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        with pytest.raises(server.UploadError) as error:
+            run(store.append(upload_id, 'a', 0, Stream(b'0')))
+        assert error.value.status == 409
+        # 正在写入的上传即使已过期也不会被清理
+        store.expiry = -1
+        assert store._expire() == 0
+    store.expiry = server.UPLOAD_EXPIRY
+    assert run(store.append(upload_id, 'a', 0, Stream(b'0'))) == 1
+
+
+def test_per_user_quota(store):
+    run(store.create('a', 'f1', 100))
+    with pytest.raises(server.UploadError) as error:
+        run(store.create('a', 'f2', 60))
+    assert error.value.status == 413
+    run(store.create('a', 'f2', 10))
+    with pytest.raises(server.UploadError) as error:
+        run(store.create('a', 'f3', 1))
+    assert error.value.status == 429
+    run(store.create('b', 'f1', 100))
+
+
+def test_abort_frees_quota(store):
+    upload_id = run(store.create('a', 'f1', 100))
+    run(store.abort(upload_id, 'a'))
+    run(store.create('a', 'f2', 100))
+    assert len(os.listdir(store._user_dir('a'))) == 2
+
+
+def test_expire_removes_stale_uploads(store):
+    run(store.create('a', 'f', 10))
+    store.expiry = -1
+    assert store._expire() == 1
+    assert os.listdir(store._user_dir('a')) == []